@@ -232,10 +232,24 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
              error?.name === 'AbortError';
     };
 
+    let stream: EventSource | null = null;
+    let streamOpen = false;
+    let cancelled = false;
+    // Последний статус: события потока дополняют его без запроса к /status
+    let latestStatus: StatusResponse | null = null;
+
+    const schedulePoll = () => {
+      if (intervalId) {
+        clearInterval(intervalId);
+      }
+      intervalId = streamOpen ? null : setInterval(pollStatus, pollInterval);
+    };
+
     const pollStatus = async () => {
       try {
         const token = await getToken();
         const currentStatus = await api.getStatus(runId, token || undefined);
+        latestStatus = currentStatus;
         
         // Обновляем статус и обрабатываем изменения
         handleStatusUpdate(currentStatus);
@@ -250,7 +264,7 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
         if (intervalId) {
           clearInterval(intervalId);
         }
-        intervalId = setInterval(pollStatus, pollInterval);
+        schedulePoll();
         
         // Убираем ошибку если была
         setError(null);
@@ -274,7 +288,7 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
             consecutiveErrors = 0;
             retryCount = 0;
             pollInterval = 15000; // Начинаем с 15 секунд после перерыва для плавного возобновления
-            intervalId = setInterval(pollStatus, pollInterval);
+            schedulePoll();
           }, 120000); // 2 минуты
           
           return;
@@ -318,7 +332,7 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
           if (intervalId) {
             clearInterval(intervalId);
           }
-          intervalId = setInterval(pollStatus, pollInterval);
+          schedulePoll();
         } else {
           // После превышения максимальных попыток - увеличиваем интервал но продолжаем
           setError('Соединение нестабильно. Проверяем состояние реже...');
@@ -328,7 +342,7 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
           if (intervalId) {
             clearInterval(intervalId);
           }
-          intervalId = setInterval(pollStatus, pollInterval);
+          schedulePoll();
         }
       }
     };
@@ -337,9 +351,56 @@ export function ProgressTracker({ runId, onComplete, onReset }: ProgressTrackerP
     pollStatus();
     
     // Устанавливаем первоначальный интервал
-    intervalId = setInterval(pollStatus, pollInterval);
+    schedulePoll();
+
+    // Push-обновления: пока SSE-поток открыт, периодический опрос выключен.
+    // Статус обновляется из самого события (этап, сообщение), а /status
+    // запрашивается только на завершающих этапах. При ошибке потока
+    // возвращаемся к опросу.
+    const openStream = async () => {
+      const token = await getToken();
+      if (cancelled || typeof EventSource === 'undefined') return;
+      stream = new EventSource(api.getStatusStreamUrl(runId, token || undefined));
+      stream.onopen = () => {
+        streamOpen = true;
+        schedulePoll();
+      };
+      stream.addEventListener('progress', (e) => {
+        let event: { stage?: string; message?: string | null };
+        try {
+          event = JSON.parse((e as MessageEvent).data);
+        } catch {
+          return;
+        }
+        const stage = event.stage || '';
+        if (stage === 'book_generated' || stage === 'failed' || !latestStatus) {
+          pollStatus();
+          return;
+        }
+        const photosStages = ['images_downloaded', 'building'];
+        latestStatus = {
+          ...latestStatus,
+          message: event.message || latestStatus.message,
+          stages: {
+            ...latestStatus.stages,
+            data_collected: latestStatus.stages.data_collected || stage === 'data_collected' || photosStages.includes(stage),
+            images_downloaded: latestStatus.stages.images_downloaded || photosStages.includes(stage),
+          },
+        };
+        handleStatusUpdate(latestStatus);
+      });
+      stream.onerror = () => {
+        stream?.close();
+        stream = null;
+        streamOpen = false;
+        schedulePoll();
+      };
+    };
+    openStream();
 
     return () => {
+      cancelled = true;
+      stream?.close();
       if (intervalId) {
         clearInterval(intervalId);
       }
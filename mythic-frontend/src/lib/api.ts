@@ -207,6 +207,13 @@ export const api = {
     return StatusResponseSchema.parse(await res.json());
   },
 
+  /** SSE-поток прогресса сборки (заменяет периодический опрос /status) */
+  getStatusStreamUrl(runId: string, token?: string) {
+    const url = new URL(`${BASE_URL}/status/${runId}/stream`)
+    if (token) url.searchParams.set('token', token)
+    return url.toString()
+  },
+
   /* ---------- runtime URLs (view / download) ---------- */
   getViewUrl(runId: string, token?: string) {
     const url = new URL(`${BASE_URL}/view/${runId}/book.html`)
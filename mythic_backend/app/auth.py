@@ -1,73 +1,158 @@
-import jwt
-import requests
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional, Dict, Any
+
+import httpx
+import jwt
 from fastapi import HTTPException, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.requests import HTTPConnection
 from app.config import settings
-import json
-import base64
 
 CLERK_SECRET_KEY = settings.CLERK_SECRET_KEY
 CLERK_PUBLISHABLE_KEY = settings.CLERK_PUBLISHABLE_KEY
 
 security = HTTPBearer()
 
+# Пользователь, уже определённый для этого запроса, хранится в request.state
+_MISSING = object()
+
+
+class JWKSCache:
+    """Публичные ключи Clerk (kid → ключ) с TTL и учётом ротации.
+
+    Ключи загружаются асинхронно (httpx, с таймаутом). Одновременно идёт не
+    больше одного обновления: все, кому нужен JWKS, ждут одну и ту же задачу.
+    Устаревшие ключи продолжают работать, пока в фоне идёт обновление;
+    неизвестный kid (Clerk сменил ключ) — немедленное обновление. Если
+    завершившееся обновление этого kid не принесло, следующее — не раньше
+    чем через CLERK_JWKS_MIN_REFRESH секунд. get_key() — корутина: поток
+    event loop не ждёт сеть, пока загружается JWKS.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self._keys: Dict[str, Any] = {}
+        self._fetched_at = 0.0
+        self._completed_at = 0.0
+        self._lock = threading.Lock()
+        self._inflight: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> Dict[str, Any]:
+        async with httpx.AsyncClient(timeout=settings.CLERK_HTTP_TIMEOUT) as client:
+            response = await client.get(self.url, headers={"Authorization": f"Bearer {CLERK_SECRET_KEY}"})
+            response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+            except Exception as e:
+                print(f"Пропускаю ключ JWKS {jwk.get('kid')}: {e}")
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+
+    def _shared_refresh(self) -> asyncio.Task:
+        """Текущее обновление JWKS или новое, если сейчас ничего не загружается"""
+        task = self._inflight
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(self.refresh())
+            task.add_done_callback(self._refresh_done)
+            self._inflight = task
+        return task
+
+    def _refresh_done(self, task: asyncio.Task):
+        if self._inflight is task:
+            self._inflight = None
+        self._completed_at = time.monotonic()
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Ошибка обновления JWKS: {task.exception()}")
+
+    async def get_key(self, kid: str):
+        with self._lock:
+            key = self._keys.get(kid)
+            stale = time.monotonic() - self._fetched_at > settings.CLERK_JWKS_TTL
+        if key is not None:
+            if stale:
+                self._shared_refresh()
+            return key
+        if (
+            self._inflight is None
+            and self._completed_at
+            and time.monotonic() - self._completed_at < settings.CLERK_JWKS_MIN_REFRESH
+        ):
+            # Недавнее обновление уже завершилось без этого kid
+            return None
+        try:
+            # shield: отмена одного запроса не прерывает общее обновление
+            await asyncio.shield(self._shared_refresh())
+        except Exception:
+            raise HTTPException(
+                status_code=500,
+                detail="Ошибка настройки аутентификации"
+            )
+        with self._lock:
+            return self._keys.get(kid)
+
+
 class ClerkAuth:
     def __init__(self):
-        self.jwks_url = f"https://api.clerk.dev/v1/jwks"
-        self._jwks = None
+        self.jwks = JWKSCache(settings.CLERK_JWKS_URL)
         self.enabled = bool(CLERK_SECRET_KEY and CLERK_PUBLISHABLE_KEY)
+        # sha256(token) → (exp, claims): повторная проверка того же токена — без криптографии
+        self._verified: "OrderedDict[str, tuple]" = OrderedDict()
+        self._verified_lock = threading.Lock()
 
-    def get_jwks(self):
-        if not self.enabled:
-            raise HTTPException(
-                status_code=500, 
-                detail="Аутентификация не настроена. Обратитесь к администратору."
-            )
-            
-        if not self._jwks:
-            try:
-                response = requests.get(self.jwks_url)
-                response.raise_for_status()
-                self._jwks = response.json()
-            except Exception as e:
-                print(f"Ошибка получения JWKS: {e}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Ошибка настройки аутентификации"
-                )
-        return self._jwks
+    def _cached_claims(self, token_hash: str) -> Optional[Dict[str, Any]]:
+        with self._verified_lock:
+            entry = self._verified.get(token_hash)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._verified[token_hash]
+                return None
+            self._verified.move_to_end(token_hash)
+            return entry[1]
 
-    def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
-        """Строгая проверка токена - без опции anonymous"""
+    def _remember_claims(self, token_hash: str, claims: Dict[str, Any]):
+        with self._verified_lock:
+            self._verified[token_hash] = (claims["exp"], claims)
+            self._verified.move_to_end(token_hash)
+            while len(self._verified) > settings.CLERK_TOKEN_CACHE_SIZE:
+                self._verified.popitem(last=False)
+
+    async def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
+        """Строгая проверка токена (подпись RS256 по JWKS Clerk, exp/nbf) - без опции anonymous"""
         if not self.enabled:
             raise HTTPException(
                 status_code=500,
                 detail="Аутентификация не настроена. Пожалуйста, настройте Clerk."
             )
-            
+
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        claims = self._cached_claims(token_hash)
+        if claims is not None:
+            return claims
+
         try:
-            if hasattr(jwt, 'decode'):
-                payload = jwt.decode(token, options={"verify_signature": False})
-            else:
-                parts = token.split('.')
-                if len(parts) != 3:
-                    raise HTTPException(
-                        status_code=401,
-                        detail="Неверный формат токена"
-                    )
-                payload_part = parts[1]
-                payload_part += '=' * (4 - len(payload_part) % 4)
-                payload_bytes = base64.urlsafe_b64decode(payload_part)
-                payload = json.loads(payload_bytes.decode('utf-8'))
-            
-            if "sub" not in payload: 
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = await self.jwks.get_key(kid) if kid else None
+            if key is None:
                 raise HTTPException(
                     status_code=401,
                     detail="Недействительный токен аутентификации"
                 )
-                
-            return payload
+            payload = jwt.decode(
+                token,
+                key=key,
+                algorithms=["RS256"],
+                options={"require": ["exp", "sub"], "verify_aud": False},
+                leeway=settings.CLERK_JWT_LEEWAY,
+            )
         except HTTPException:
             raise
         except Exception as e:
@@ -77,69 +162,90 @@ class ClerkAuth:
                 detail="Недействительный токен аутентификации"
             )
 
+        self._remember_claims(token_hash, payload)
+        return payload
+
 
 clerk_auth = ClerkAuth()
 
-def get_current_user(authorization: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+
+async def _memo(request: HTTPConnection, attr: str, resolve) -> Optional[Dict[str, Any]]:
+    """Пользователь определяется один раз на запрос, сколько бы раз его ни спросили."""
+    cached = getattr(request.state, attr, _MISSING)
+    if cached is _MISSING:
+        cached = await resolve()
+        setattr(request.state, attr, cached)
+    return cached
+
+
+async def get_current_user(request: Request, authorization: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
     """Обязательная аутентификация - только для зарегистрированных пользователей"""
     if not clerk_auth.enabled:
         raise HTTPException(
             status_code=500,
             detail="Аутентификация не настроена. Обратитесь к администратору."
         )
-        
+
     if not authorization:
         raise HTTPException(
-            status_code=401, 
+            status_code=401,
             detail="Требуется регистрация и вход в систему"
         )
-    
+
     token = authorization.credentials
-    user_data = clerk_auth.verify_token(token)
-    
+    user_data = await _memo(request, "clerk_user_required", lambda: clerk_auth.verify_token(token))
+
     if not user_data:
         raise HTTPException(
-            status_code=401, 
+            status_code=401,
             detail="Недействительный токен. Пожалуйста, войдите в систему заново."
         )
-    
+
     return user_data
 
-def get_optional_current_user(request: Request) -> Optional[Dict[str, Any]]:
+async def get_optional_current_user(request: Request) -> Optional[Dict[str, Any]]:
     """Опциональная зависимость для получения пользователя"""
     if not clerk_auth.enabled:
         return None
-        
+
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         return None
-    
+
     token = auth_header.split(" ")[1]
-    try:
-        return clerk_auth.verify_token(token)
-    except HTTPException:
-        return None
 
-def get_user_from_request(request: Request) -> Optional[Dict[str, Any]]:
-    """Получаем пользователя из запроса - проверяем заголовок Authorization и query параметр token"""
-    if not clerk_auth.enabled:
-        return None
-    
-    # Сначала проверяем Authorization заголовок
-    auth_header = request.headers.get("Authorization")
-    if auth_header and auth_header.startswith("Bearer "):
-        token = auth_header.split(" ")[1]
-        try:
-            return clerk_auth.verify_token(token)
-        except HTTPException:
-            pass
-    
-    # Если в заголовке нет токена, проверяем query параметр
-    token = request.query_params.get("token")
-    if token:
+    async def resolve():
         try:
-            return clerk_auth.verify_token(token)
+            return await clerk_auth.verify_token(token)
         except HTTPException:
-            pass
-    
-    return None 
\ No newline at end of file
+            return None
+
+    return await _memo(request, "clerk_user_optional", resolve)
+
+async def get_user_from_request(request: HTTPConnection) -> Optional[Dict[str, Any]]:
+    """Получаем пользователя из запроса - проверяем заголовок Authorization и query параметр token.
+    Подходит и для Request, и для WebSocket; синхронным обработчикам — через Depends."""
+    if not clerk_auth.enabled:
+        return None
+
+    async def resolve():
+        # Сначала проверяем Authorization заголовок
+        auth_header = request.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            token = auth_header.split(" ")[1]
+            try:
+                return await clerk_auth.verify_token(token)
+            except HTTPException:
+                pass
+
+        # Если в заголовке нет токена, проверяем query параметр
+        token = request.query_params.get("token")
+        if token:
+            try:
+                return await clerk_auth.verify_token(token)
+            except HTTPException:
+                pass
+
+        return None
+
+    return await _memo(request, "clerk_user", resolve)
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings 
-from typing import Optional
+from typing import Dict, Optional
 
 class Settings(BaseSettings):
     APIFY_TOKEN: str 
@@ -12,17 +12,105 @@ class Settings(BaseSettings):
     AZURE_OPENAI_API_VERSION: str = "2024-12-01-preview"
     AZURE_OPENAI_GPT4_DEPLOYMENT: str = "gpt-4.1-mini"
     
+    # Лимиты LLM-шлюза (app/services/llm_gateway.py)
+    AZURE_OPENAI_RPM: int = 300          # квота deployment'а, запросов в минуту
+    AZURE_OPENAI_TPM: int = 150000       # квота deployment'а, токенов в минуту
+    LLM_QUOTA_SHARE: float = 1.0         # доля квоты на процесс (при N воркерах ≈ 1/N)
+    LLM_MAX_CONCURRENCY: int = 16        # одновременных запросов на процесс
+    LLM_PER_BUILD_CONCURRENCY: int = 4   # одновременных запросов одной сборки
+    LLM_TIMEOUT: float = 120.0
+    LLM_MAX_RETRIES: int = 4
+
+    # Параллельная генерация глав
+    CHAPTER_CONCURRENCY: int = 4         # глав одной книги одновременно (не больше LLM_PER_BUILD_CONCURRENCY)
+    CHAPTER_TIMEOUT: float = 90.0        # бюджет на главу с повторами, секунд (без ожидания лимитов)
+
+    # Пакетный анализ фото (media_analyzer)
+    VISION_BATCH_SIZE: int = 4           # фото в одном multi-image запросе
+    VISION_IMAGE_SIZE: int = 512         # длинная сторона фото для vision, px
+
+    # Кэш ответов LLM (app/services/llm_cache.py)
+    LLM_CACHE_BACKEND: str = "sqlite"    # memory | sqlite | redis | off
+    LLM_CACHE_PATH: str = "cache/llm_cache.sqlite3"  # не в data/: она раздаётся через /runs; cache/ — общий том API и воркеров
+    LLM_CACHE_TTL: int = 7 * 24 * 3600
+    LLM_CACHE_MAX_ENTRIES: int = 20000
+    LLM_CACHE_MAX_TEMPERATURE: float = 0.9   # выше — творческие запросы, не кэшируем
+
+    # Пул рендера PDF (app/services/pdf_renderer.py)
+    PDF_RENDER_WORKERS: int = 2
+    PDF_MAX_TASKS_PER_CHILD: int = 10    # перезапуск процесса после N рендеров
+    PDF_MAX_RSS_MB: int = 1536           # потолок памяти процесса во время рендера
+    PDF_RENDER_TIMEOUT: float = 180.0
+    PDF_QUEUE_MAX: int = 32
+
+    # Превью книги для анонимного просмотра (app/services/book_variants.py)
+    BOOK_PREVIEW_PAGES: int = 10         # страниц классической книги без авторизации
+
+    # Шаблоны книг (app/services/template_env.py)
+    TEMPLATE_CACHE_DIR: str = "/tmp/mythic-jinja-cache"   # байткод Jinja2, вне data/
+    TEMPLATE_AUTO_RELOAD: bool = True    # перечитывать изменённые шаблоны без рестарта
+
+    # Смена формата готовой книги без повторной генерации (app/services/book_convert.py)
+    BOOK_CONVERT_ENABLED: bool = True
+    BOOK_CONVERT_MAX_TOKENS: int = 700   # дописать подписи к фото / финальное послание
+
+    # Производные размеры фото (app/services/image_derivatives.py); vision — VISION_IMAGE_SIZE
+    IMAGE_WEB_SIZE: int = 700            # для HTML-книги и PDF, px по длинной стороне
+    IMAGE_DERIVATIVE_WORKERS: int = 2    # процессов декодирования и ресайза
+    PHOTO_DUP_HAMMING: int = 10          # pHash ближе этого — одно и то же фото
+
+    # Клиент Apify REST API и чтение датасета страницами (app/services/apify_client.py)
+    APIFY_API_BASE: str = "https://api.apify.com/v2"
+    APIFY_TIMEOUT: float = 30.0          # таймаут запроса к API, с
+    APIFY_CONNECT_TIMEOUT: float = 5.0
+    APIFY_MAX_CONNECTIONS: int = 20      # пул соединений на процесс
+    APIFY_RETRIES: int = 3               # повторы сетевых ошибок и 429/5xx
+    APIFY_PAGE_SIZE: int = 50
+    APIFY_PAGE_CONCURRENCY: int = 4
+    SCRAPE_CACHE_TTL: int = 6 * 3600     # сколько результат скрапинга профиля переиспользуется, с (0 — выкл.)
+
+    # Загрузка фото (app/services/downloader.py)
+    DOWNLOAD_MAX_IMAGES: int = 15
+    DOWNLOAD_MAX_BYTES: int = 20 * 1024 * 1024   # больше — заглушка вместо фото
+    DOWNLOAD_HEAD_CHECK: bool = True     # HEAD с проверкой Content-Length до GET
+    DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+    DOWNLOAD_PER_HOST_CONCURRENCY: int = 4
+    DOWNLOAD_MAX_CONNECTIONS: int = 16
+    DOWNLOAD_MAX_KEEPALIVE: int = 8
+    DOWNLOAD_TIMEOUT: float = 30.0
+    DOWNLOAD_CONNECT_TIMEOUT: float = 10.0
+    DOWNLOAD_RETRIES: int = 3
+    
     # Legacy OpenAI (if needed as backup)
     OPENAI_API_KEY: Optional[str] = None
     
     GOOGLE_API_KEY: str
     CLERK_SECRET_KEY: str
     CLERK_PUBLISHABLE_KEY: str
+    # Проверка JWT Clerk (app/auth.py)
+    CLERK_JWKS_URL: str = "https://api.clerk.com/v1/jwks"
+    CLERK_JWKS_TTL: int = 3600           # как долго ключи считаются свежими, с
+    CLERK_JWKS_MIN_REFRESH: float = 30.0 # не чаще раза в N секунд при неизвестном kid
+    CLERK_HTTP_TIMEOUT: float = 5.0
+    CLERK_TOKEN_CACHE_SIZE: int = 2048   # проверенных токенов в памяти (до их exp)
+    CLERK_JWT_LEEWAY: int = 10           # допуск расхождения часов, с
     
     # Database configuration
     DATABASE_URL:str
     ASYNC_DATABASE_URL: Optional[str]=None
 
+    # Redis и очередь задач сборки
+    REDIS_URL: str = "redis://redis:6379/0"
+    WORKER_CONCURRENCY: int = 2
+    JOB_VISIBILITY_TIMEOUT: int = 900   # секунд до повторной выдачи задачи
+    JOB_MAX_RETRIES: int = 3
+    JOB_RETRY_BACKOFF: float = 10.0     # базовая задержка перед повтором, с
+    WEBHOOK_DEDUP_TTL: int = 24 * 3600  # сколько помним runId вебхука Apify (идемпотентность), с
+
+    # Сколько сборок каждого стиля выполняется одновременно в одном процессе
+    STYLE_BUILD_CONCURRENCY: Dict[str, int] = {"romantic": 2, "fantasy": 2, "humor": 2}
+    STYLE_BUILD_DEFAULT_CONCURRENCY: int = 1
+
     class Config:
         env_file = ".env"
     
@@ -1,6 +1,7 @@
 # app/main.py
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, Depends
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -28,8 +29,6 @@ class NormalizePathMiddleware(BaseHTTPMiddleware):
         return response
 
 import asyncio
-from app.services.image_processor import process_folder
-from app.services.text_collector import collect_texts
 from app.styles import build_book
 from app.auth import get_current_user, get_optional_current_user, get_user_from_request
 from app.database import get_db, create_tables, get_optional_db
@@ -40,19 +39,47 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import AnyUrl, BaseModel
 from pathlib import Path
 import json, logging, random, datetime, uuid, shutil
+from collections import OrderedDict
 import time
 
 from app.config import settings
-from app.services.apify_client import run_actor, fetch_run, fetch_items
-from app.services.downloader import download_photos
+from app.services import apify_client
+from app.services.apify_client import run_actor
+from app.services.ingest_pipeline import claim_webhook, ingest_run
+from app.services.job_queue import enqueue, queue_stats
+from app.services.build_pipeline import run_full_build
+from app.services.build_executor import build_executor
+from app.services.llm_gateway import llm_gateway
+from app.services.llm_cache import llm_cache
+from app.services.pdf_service import QUEUE_FULL_RETRY_AFTER, ensure_pdf, pdf_is_fresh
+from app.services.pdf_renderer import PdfQueueFullError, get_pdf_pool
+from app.services import assets, book_document, book_variants, http_cache, progress, run_manifest, scrape_cache, template_env
 from app.auth import clerk_auth
 
 log = logging.getLogger("api")
 app = FastAPI(title="Романтическая Летопись Любви", description="Создает красивые романтические книги на основе Instagram профилей для ваших любимых")
 
-# Простой кэш для статусов
-status_cache = {}
+@app.on_event("startup")
+async def prime_auth_keys():
+    """Ключи Clerk загружаем заранее, чтобы первый запрос не ждал JWKS"""
+    if clerk_auth.enabled:
+        try:
+            await clerk_auth.jwks.refresh()
+        except Exception as e:
+            log.warning(f"JWKS Clerk не загружены при старте: {e}")
+
+@app.on_event("startup")
+async def warm_up_templates():
+    """Шаблоны книг компилируются при старте, а не на первой сборке"""
+    try:
+        await asyncio.to_thread(template_env.warm_up)
+    except Exception as e:
+        log.warning(f"Шаблоны книг не скомпилированы при старте: {e}")
+
+# Простой кэш для статусов (ограничен по размеру — старые run_id вытесняются)
+status_cache: "OrderedDict[str, tuple]" = OrderedDict()
 CACHE_TTL = 5  # 5 секунд
+STATUS_CACHE_MAX = 1000
 
 def get_cached_status(run_id: str):
     """Получить кэшированный статус"""
@@ -67,6 +94,9 @@ def get_cached_status(run_id: str):
 def set_cached_status(run_id: str, data: dict):
     """Установить кэшированный статус"""
     status_cache[run_id] = (time.time(), data)
+    status_cache.move_to_end(run_id)
+    while len(status_cache) > STATUS_CACHE_MAX:
+        status_cache.popitem(last=False)
 
 app.add_middleware(NormalizePathMiddleware)
 app.add_middleware(
@@ -124,12 +154,25 @@ def health_check():
             "error": f"System metrics unavailable: {str(e)}"
         }
 
+@app.get("/health/queue")
+async def queue_health():
+    """Глубина очереди сборок (queued / processing / delayed / dead), загрузка пулов стилей, LLM-шлюза и клиента Apify"""
+    builds = build_executor.metrics()
+    llm = {**llm_gateway.stats, "cache": llm_cache.metrics()}
+    pdf = get_pdf_pool().metrics()
+    apify = apify_client.metrics()
+    try:
+        return {"status": "ok", "queue": await queue_stats(), "builds": builds, "llm": llm, "pdf": pdf, "apify": apify}
+    except Exception as e:
+        return {"status": "unavailable", "error": str(e), "builds": builds, "llm": llm, "pdf": pdf, "apify": apify}
+
 # ───────────── /start-scrape ────────────────────────────────
 @app.get("/start-scrape")
 async def start_scrape(
     url: AnyUrl,
     username: str,  # Добавляем обязательный параметр username
     style: str = 'romantic',
+    refresh: bool = False,  # True — не брать недавний результат из кэша скрапинга
     request: Request = None,
     db: AsyncSession | None = Depends(get_optional_db)
 ):
@@ -139,7 +182,7 @@ async def start_scrape(
     # Проверяем авторизацию опционально
     current_user = None
     try:
-        current_user = get_user_from_request(request) if request else None
+        current_user = await get_user_from_request(request) if request else None
     except Exception as e:
         log.warning(f"Error getting user from request: {e}")
         current_user = None
@@ -170,8 +213,14 @@ async def start_scrape(
         ),
     }
 
-    run = await run_actor(run_input, webhooks=[webhook])
-    run_id = run["id"]
+    # Тот же профиль с тем же run_input недавно скрапили — берём готовые данные
+    scrape_key = scrape_cache.make_key(clean_url, run_input)
+    cached_from = None if refresh else await scrape_cache.lookup(scrape_key)
+    if cached_from:
+        run_id = uuid.uuid4().hex
+    else:
+        run = await run_actor(run_input, webhooks=[webhook])
+        run_id = run["id"]
     
     # Создаем сессию обработки в БД только для авторизованных пользователей
     if is_authenticated and db is not None:
@@ -203,131 +252,112 @@ async def start_scrape(
     except Exception as e:
         print(f"❌ Не удалось сохранить стиль: {e}")
     
+    run_manifest.set_fields(
+        run_id,
+        owner={k: user_meta[k] for k in ("user_id", "username", "is_authenticated")},
+        style=style,
+        scrapeKey=scrape_key,
+    )
+    if cached_from:
+        await scrape_cache.apply_hit(cached_from, run_id)
+        log.info("Scrape cache hit runId=%s (from %s) for user=%s", run_id, cached_from, user_identifier)
+        return {"runId": run_id, "cached": True, "message": "Начинаю исследовать вашу личность... Это займет несколько минут"}
+    progress.publish(run_id, "scrape_started", message="Собираю данные профиля")
     log.info("Actor started runId=%s for user=%s (authenticated=%s)", run_id, user_identifier, is_authenticated)
     return {"runId": run_id, "message": "Начинаю исследовать вашу личность... Это займет несколько минут"}
 
 
-@app.post("/webhook/apify")
+@app.post("/webhook/apify", status_code=202)
 async def apify_webhook(request: Request, background: BackgroundTasks):
+    """Подтверждаем вебхук сразу: приём датасета и загрузка фото — задача очереди ``ingest``"""
     try:
         payload = await request.json()
     except Exception:
         payload = {}
+    if not isinstance(payload, dict):
+        raise HTTPException(400, "payload must be a JSON object")
 
     run_id = payload.get("runId") or request.headers.get("x-apify-run-id")
-    if not run_id:
+    if not run_id or not isinstance(run_id, str) or not re.fullmatch(r"[\w-]+", run_id):
         raise HTTPException(400, "runId missing")
-
     dataset_id = payload.get("datasetId")
-    if not dataset_id:
-        run = await fetch_run(run_id)
-        dataset_id = run.get("defaultDatasetId")         
 
-    if not dataset_id:
-        raise HTTPException(500, "datasetId unresolved")
+    # Apify повторяет вебхук — второй раз тот же runId не обрабатываем
+    if not await claim_webhook(run_id):
+        log.info(f"Повторный вебхук для {run_id} — пропускаю")
+        return JSONResponse({"status": "duplicate", "runId": run_id}, status_code=202)
 
-    items = await fetch_items(dataset_id)
-    run_dir = Path("data") / run_id
-    run_dir.mkdir(parents=True, exist_ok=True)
-    (run_dir / "posts.json").write_text(json.dumps(items, ensure_ascii=False, indent=2))
+    try:
+        job_id = await enqueue("ingest", {"run_id": run_id, "dataset_id": dataset_id})
+    except Exception as e:
+        log.warning(f"Очередь задач недоступна ({e}), приём {run_id} будет выполнен в API-процессе")
+        background.add_task(ingest_run, run_id, dataset_id)
+        job_id = None
+    progress.publish(run_id, "ingesting", message="Данные приняты, обрабатываю")
 
-    # --- качаем картинки ---------------------------------------------------------------
-    images_dir = run_dir / "images"
-    background.add_task(download_photos, items, images_dir)
+    return JSONResponse({
+        "status": "accepted",
+        "runId": run_id,
+        "jobId": job_id,
+        "message": "Собираю данные, чтобы понять вашу душу... Скоро начну создавать книгу",
+    }, status_code=202)
 
-    log.info(f"Webhook для {run_id} завершен. Данные получены, изображения загружаются в фоне.")
 
-    return {"status": "processing", "runId": run_id, "message": "Собираю данные, чтобы понять вашу душу... Скоро начну создавать книгу"}
+def _has_run_access(manifest: dict, current_user: dict | None) -> bool:
+    """Владелец книги или любой авторизованный пользователь Clerk; без авторизации —
+    доступ по знанию run_id (как и раньше)"""
+    owner_id = (manifest.get("owner") or {}).get("user_id")
+    if not owner_id or not current_user or not current_user.get("sub"):
+        return True
+    current_user_id = current_user.get("sub")
+    return owner_id == current_user_id or current_user_id.startswith("user_")
 
 
-@app.get("/status/{run_id}")
-def status(run_id: str, request: Request):
-    """Проверить статус создания книги - доступно для всех, но с проверкой прав доступа"""
-    
-    # Получаем пользователя опционально
-    current_user = None
+async def _optional_user(request) -> dict | None:
+    """Пользователь из заголовка/?token=, None если не авторизован"""
     try:
-        current_user = get_user_from_request(request)
+        return await get_user_from_request(request)
     except Exception as e:
         log.warning(f"Error getting user from request in status check: {e}")
-        current_user = None
-    
+        return None
+
+
+@app.get("/status/{run_id}")
+async def status(run_id: str, request: Request):
+    """Проверить статус создания книги - доступно для всех, но с проверкой прав доступа"""
+    return await _status_for(run_id, request)
+
+
+async def _status_for(run_id: str, conn) -> dict:
+    """Статус с учётом пользователя из Request/WebSocket (снимок — в пуле потоков)"""
+    return await run_in_threadpool(_status_snapshot, run_id, await _optional_user(conn))
+
+
+def _status_snapshot(run_id: str, current_user: dict | None) -> dict:
+    """Текущий статус run_id (HTTPException 404/403, если нет книги или доступа)"""
     # Проверяем кэш
     cached_status = get_cached_status(run_id)
     if cached_status:
         log.info(f"Status cache hit for {run_id}")
         return cached_status
     
-    run_dir = Path("data") / run_id
-    
-    # Быстрая проверка существования директории
-    if not run_dir.exists():
+    # Все данные статуса — из маленького манифеста, без чтения posts.json
+    manifest = run_manifest.load(run_id)
+    if manifest is None:
         raise HTTPException(404, "Run not found")
     
     # Проверяем права доступа к этой книге
-    user_meta_file = run_dir / "user_meta.json"
-    has_access = False
-    
-    if user_meta_file.exists():
-        try:
-            user_meta = json.loads(user_meta_file.read_text(encoding="utf-8"))
-            stored_user_id = user_meta.get("user_id")
-            is_authenticated = user_meta.get("is_authenticated", False)
-            
-            if current_user and current_user.get("sub"):
-                current_user_id = current_user.get("sub")
-                # Пользователь имеет доступ если это его книга
-                if stored_user_id == current_user_id:
-                    has_access = True
-                # Или если у него есть права авторизованного пользователя
-                elif current_user_id and current_user_id.startswith("user_"):
-                    has_access = True
-            else:
-                # Для неавторизованных пользователей разрешаем просмотр статуса их книг
-                # (они могут получить доступ, зная run_id)
-                has_access = True
-        except Exception as e:
-            log.warning(f"Error reading user meta for run {run_id}: {e}")
-            # В случае ошибки разрешаем доступ (обратная совместимость)
-            has_access = True
-    else:
-        # Если нет метаданных пользователя - разрешаем доступ (старые книги)
-        has_access = True
-    
-    if not has_access:
+    if not _has_run_access(manifest, current_user):
         raise HTTPException(403, "Доступ к этой книге запрещен")
     
-    # Кэшируем результаты проверки файлов
-    posts_json = run_dir / "posts.json"
-    images_dir = run_dir / "images"
-    html_file = run_dir / "book.html"
-    pdf_file = run_dir / "book.pdf"
-    style_file = run_dir / "style.txt"
-    format_file = run_dir / "format.txt"
-    
     current_user_id = current_user.get('sub') if current_user else 'anonymous'
     log.info(f"Status check for {run_id} by user {current_user_id}")
     
-    # Быстрые проверки без лишних операций
-    data_collected = posts_json.exists()
-    images_downloaded = images_dir.exists() and any(images_dir.glob("*"))
-    book_generated = html_file.exists()
-
-    # Читаем стиль книги (с кэшированием)
-    book_style = "romantic"  # по умолчанию
-    if style_file.exists():
-        try:
-            book_style = style_file.read_text(encoding="utf-8").strip()
-        except:
-            pass
-
-    # Читаем формат книги
-    book_format = "classic"
-    if format_file.exists():
-        try:
-            book_format = format_file.read_text(encoding="utf-8").strip()
-        except:
-            pass
+    data_collected = manifest["stages"]["data_collected"]
+    images_downloaded = manifest["stages"]["images_downloaded"]
+    book_generated = manifest["stages"]["book_generated"]
+    book_style = manifest.get("style") or "romantic"
+    book_format = manifest.get("format") or "classic"
 
     # Оптимизированные сообщения
     message = "Начинаю путешествие по вашему профилю..."
@@ -408,27 +438,14 @@ def status(run_id: str, request: Request):
     }
     
     # Добавляем файлы только если они существуют
-    if html_file.exists():
+    if manifest["files"].get("html"):
         status_info["files"]["html"] = f"/view/{run_id}/book.html"
     
-    if pdf_file.exists():
+    if manifest["files"].get("pdf"):
         status_info["files"]["pdf"] = f"/download/{run_id}/book.pdf"
     
-    # Добавляем информацию о профиле только если нужно
-    if data_collected and posts_json.exists():
-        try:
-            posts_data = json.loads(posts_json.read_text(encoding="utf-8"))
-            if posts_data:
-                profile = posts_data[0]
-                status_info["profile"] = {
-                    "username": profile.get("username"),
-                    "fullName": profile.get("fullName"),
-                    "followers": profile.get("followersCount"),
-                    "posts": len(profile.get("latestPosts", [])),
-                    "stories": len(profile.get("stories", []))
-                }
-        except:
-            pass
+    if manifest.get("profile"):
+        status_info["profile"] = manifest["profile"]
     
     # Кэшируем результат
     set_cached_status(run_id, status_info)
@@ -437,12 +454,75 @@ def status(run_id: str, request: Request):
     return status_info
 
 
+# ───────────── /status/{run_id}/stream (SSE) и /ws ─────────────
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _progress_events(run_id: str, snapshot: dict):
+    """Снимок статуса, последнее событие прогресса, затем события до завершения"""
+    yield "status", snapshot
+    if snapshot["stages"]["book_generated"]:
+        last = await run_in_threadpool(progress.last_event, run_id)
+        if last:
+            yield "progress", last
+        return
+    # subscribe() сначала подписывается, потом отдаёт последнее событие —
+    # завершающее событие между этими шагами не потеряется
+    async for event in progress.subscribe(run_id):
+        if event is None:
+            yield "ping", None
+            continue
+        yield "progress", event
+        if event["stage"] in progress.TERMINAL_STAGES:
+            return
+
+
+@app.get("/status/{run_id}/stream")
+async def status_stream(run_id: str, request: Request):
+    """Прогресс сборки книги через Server-Sent Events вместо опроса /status"""
+    snapshot = await _status_for(run_id, request)
+
+    async def event_source():
+        async for event, data in _progress_events(run_id, snapshot):
+            if await request.is_disconnected():
+                break
+            # Комментарий SSE держит соединение живым через прокси
+            yield ": keep-alive\n\n" if data is None else _sse(event, data)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket("/status/{run_id}/ws")
+async def status_ws(websocket: WebSocket, run_id: str):
+    """Тот же поток прогресса через WebSocket (токен — в ?token=)"""
+    try:
+        snapshot = await _status_for(run_id, websocket)
+    except HTTPException as e:
+        await websocket.close(code=4404 if e.status_code == 404 else 4403)
+        return
+    await websocket.accept()
+    try:
+        async for event, data in _progress_events(run_id, snapshot):
+            if data is None:
+                await websocket.send_json({"event": "ping"})
+            else:
+                await websocket.send_json({"event": event, "data": data})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
 # ───────────── /download/{run_id}/{filename} ─────────────
 @app.get("/download/{run_id}/{filename}")
-def download_file(run_id: str, filename: str, request: Request):
+def download_file(run_id: str, filename: str, request: Request,
+                  current_user: dict | None = Depends(get_user_from_request)):
     """Скачивание готовых файлов (PDF, HTML) - только для авторизованных пользователей"""
-    # Проверяем аутентификацию из любого источника
-    current_user = get_user_from_request(request)
+    # Аутентификация из любого источника — зависимость get_user_from_request
     if not current_user:
         raise HTTPException(401, "Необходима авторизация для скачивания файлов")
     
@@ -454,153 +534,100 @@ def download_file(run_id: str, filename: str, request: Request):
     
     log.info(f"File download {filename} for run {run_id} by user {current_user.get('sub')}")
     
+    # HTML для скачивания — самодостаточный, с фото внутри (работает офлайн)
+    if filename == "book.html":
+        file_path = assets.export_self_contained(run_dir)
+    
     # Определяем MIME тип
     media_type = "application/pdf" if filename.endswith(".pdf") else "text/html"
     
+    return http_cache.file_response(request, file_path, media_type, filename=filename,
+                                    ranges=media_type == "application/pdf")
+
+@app.get("/assets/{run_id}/{name}")
+def get_asset(run_id: str, name: str):
+    """Фото книги. Имя — хэш содержимого, поэтому кэшируем навсегда"""
+    path = assets.resolve(run_id, name)
+    if path is None:
+        raise HTTPException(404, "Файл не найден")
     return FileResponse(
-        path=file_path,
-        media_type=media_type,
-        filename=filename
+        path=path,
+        media_type=assets.MEDIA_TYPES[path.suffix.lstrip(".")],
+        headers={"Cache-Control": assets.CACHE_CONTROL},
     )
 
-# Функция для ограничения книги первыми страницами
-def limit_book_pages(html_content: str, max_pages: int = 10) -> str:
-    """Ограничивает HTML книгу первыми max_pages страницами"""
-    try:
-        from bs4 import BeautifulSoup
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Находим все страницы книги
-        book_pages = soup.find_all('div', class_='book-page')
-        
-        if len(book_pages) <= max_pages:
-            return html_content  # Если страниц меньше лимита, возвращаем как есть
-        
-        # Оставляем только первые max_pages страниц
-        for i, page in enumerate(book_pages):
-            if i >= max_pages:
-                page.decompose()  # Удаляем страницу из DOM
-        
-        # Создаем страницу с сообщением о необходимости авторизации
-        auth_message_html = """
-        <div style="display: flex; flex-direction: column; justify-content: center; align-items: center; height: 100vh; text-align: center; font-family: 'Playfair Display', serif; background-color: #fff; color: #333;">
-            <h2 style="font-size: 2em; margin-bottom: 1em; color: #333;">📚 Для продолжения чтения</h2>
-            <p style="font-size: 1.2em; margin-bottom: 1.5em; color: #666; max-width: 400px; line-height: 1.6;">
-                Это только первые 10 страниц вашей книги. Чтобы прочитать всю историю, войдите в систему или зарегистрируйтесь.
-            </p>
-            <a href="/" style="background-color: #333; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; font-size: 1.1em; margin-top: 1em;">
-                Войти в систему
-            </a>
-        </div>
-        """
-        
-        auth_message_page = soup.new_tag('div')
-        auth_message_page['class'] = 'book-page auth-required-page'
-        auth_message_page.append(BeautifulSoup(auth_message_html, 'html.parser'))
-        
-        # Находим body и добавляем страницу авторизации
-        body = soup.find('body')
-        if body:
-            body.append(auth_message_page)
-        
-        return str(soup)
-        
-    except Exception as e:
-        log.error(f"Error limiting book pages: {e}")
-        return html_content  # В случае ошибки возвращаем оригинал
-
 @app.get("/view/{run_id}/book.html")
-def view_book_html(run_id: str, request: Request):
+def view_book_html(run_id: str, request: Request,
+                   current_user: dict | None = Depends(get_user_from_request)):
     """Просмотр HTML книги — с ограничением для неавторизованных пользователей только для классических книг"""
-    current_user = get_user_from_request(request)
     
     run_dir = Path("data") / run_id
     html_file = run_dir / "book.html"
-    user_meta_file = run_dir / "user_meta.json"
-    format_file = run_dir / "format.txt"
+    manifest = run_manifest.load(run_id)
     
-    if not html_file.exists():
+    if manifest is None or not html_file.exists():
         raise HTTPException(404, "Книга не найдена")
     
-    html_content = html_file.read_text(encoding="utf-8")
-    
-    # Определяем формат книги
-    book_format = "classic"  # По умолчанию классический формат
-    if format_file.exists():
-        try:
-            book_format = format_file.read_text(encoding="utf-8").strip()
-        except Exception:
-            pass
-    
-    # Проверяем права доступа
-    is_authorized = False
-    
-    if current_user:
-        # Если пользователь авторизован, проверяем права доступа
-        try:
-            if user_meta_file.exists():
-                user_meta = json.loads(user_meta_file.read_text(encoding="utf-8"))
-                stored_user_id = user_meta.get("user_id")
-                current_user_id = current_user.get("sub")
-                
-                # Пользователь имеет доступ если это его книга
-                if stored_user_id == current_user_id:
-                    is_authorized = True
-                # Или если у него есть права авторизованного пользователя (может смотреть все книги)
-                elif current_user_id and current_user_id.startswith("user_"):
-                    is_authorized = True
-        except Exception as e:
-            log.warning(f"Error checking user access: {e}")
+    # Формат книги и владелец — из манифеста
+    book_format = manifest.get("format") or "classic"
+    is_authorized = bool(current_user and manifest.get("owner")) and _has_run_access(manifest, current_user)
     
-    # Применяем ограничения только для классических книг
-    # Flipbook всегда показывается полностью
+    # Flipbook всегда показывается полностью; классическая книга без
+    # авторизации — готовый вариант с первыми страницами (считается при сборке)
     if book_format == "flipbook":
         log.info(f"Full flipbook view for run {run_id} - no restrictions applied")
-        return HTMLResponse(html_content)
-    
-    # Для классических книг - проверяем авторизацию
-    if not is_authorized:
-        html_content = limit_book_pages(html_content, max_pages=10)
-        log.info(f"Classic book view limited to 10 pages for run {run_id}")
+    elif not is_authorized:
+        html_file = book_variants.ensure_preview(run_dir)
+        log.info(f"Classic book preview for run {run_id}")
     else:
         log.info(f"Full classic book view for run {run_id} by user {current_user.get('sub') if current_user else 'unknown'}")
     
-    return HTMLResponse(html_content)
+    return http_cache.file_response(request, html_file, "text/html; charset=utf-8",
+                                    headers={"Vary": "Authorization"})
 
 @app.post("/generate-pdf/{run_id}")
 async def generate_pdf(run_id: str, current_user: dict = Depends(get_current_user)):
     """Генерация PDF из HTML книги - только для авторизованных пользователей"""
     run_dir = Path("data") / run_id
     html_file = run_dir / "book.html"
-    pdf_file = run_dir / "book.pdf"
     
     if not html_file.exists():
         raise HTTPException(404, "Исходная HTML книга не найдена, не могу сгенерировать PDF.")
     
-    if pdf_file.exists():
+    if pdf_is_fresh(run_dir):
         return {"status": "exists", "message": "PDF уже создан", "download_url": f"/download/{run_id}/book.pdf"}
     
     log.info(f"PDF generation requested for run {run_id} by user {current_user.get('sub')}")
     
-    # Поскольку fpdf2 требует исходных данных, мы перезапускаем часть процесса сборки книги
-    # Это не оптимально, но гарантирует, что PDF будет создан с теми же данными
+    # PDF рендерится из уже сохранённого book.html — без повторной сборки и вызовов LLM
     try:
-        images_dir = run_dir / "images"
-        imgs = await process_folder(images_dir)
-        comments = collect_texts(run_dir / "posts.json")
-        user_id = current_user.get("sub")
-
-        # Эта функция теперь также создает PDF
-        build_book(run_id, imgs, comments, "classic", user_id)
+        await ensure_pdf(run_id)
+    except FileNotFoundError:
+        raise HTTPException(404, "Исходная HTML книга не найдена, не могу сгенерировать PDF.")
+    except PdfQueueFullError:
+        raise HTTPException(503, "Сервер создаёт много PDF, попробуйте чуть позже.",
+                            headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER)})
+    except Exception as e:
+        log.error(f"Error rendering PDF for {run_id}: {e}")
+        raise HTTPException(500, f"Ошибка при создании PDF: {e}")
+    
+    return {"status": "success", "message": "PDF успешно создан", "download_url": f"/download/{run_id}/book.pdf"}
 
-        if pdf_file.exists():
-             return {"status": "success", "message": "PDF успешно создан", "download_url": f"/download/{run_id}/book.pdf"}
-        else:
-            raise HTTPException(500, "Ошибка создания PDF: файл не был сохранен.")
 
+@app.post("/rerender/{run_id}")
+async def rerender_book(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Пересборка HTML, превью и PDF из сохранённого документа книги (book.json) — без вызовов LLM"""
+    if not re.fullmatch(r"[\w-]+", run_id):
+        raise HTTPException(400, "Некорректный runId")
+    log.info(f"Re-render requested for run {run_id} by user {current_user.get('sub')}")
+    try:
+        doc = await book_document.rerender(run_id)
     except Exception as e:
-        log.error(f"Error creating PDF via build_romantic_book: {e}")
-        raise HTTPException(500, f"Ошибка при создании PDF: {e}")
+        log.error(f"Error re-rendering book {run_id}: {e}")
+        raise HTTPException(500, f"Ошибка пересборки книги: {e}")
+    if doc is None:
+        raise HTTPException(404, "Документ книги не найден — эту книгу можно только собрать заново.")
+    return {"status": "success", "runId": run_id, "format": doc.format, "chapters": len(doc.chapters)}
 
 
 # ───────────── / (главная страница) ─────────────────────
@@ -1746,7 +1773,7 @@ def status_page(runId: str):
 async def create_book(request: Request, background: BackgroundTasks):
     """Создает книгу в фоновом режиме - теперь доступно и без авторизации"""
     # Получаем пользователя опционально
-    current_user = get_user_from_request(request)
+    current_user = await get_user_from_request(request)
     
     try:
         payload = await request.json()
@@ -1764,35 +1791,28 @@ async def create_book(request: Request, background: BackgroundTasks):
     if not run_id:
         raise HTTPException(400, "runId is required")
 
-    # Проверяем метаданные пользователя из файла
-    run_dir = Path("data") / run_id
-    user_meta_file = run_dir / "user_meta.json"
-    
-    if not user_meta_file.exists():
+    # Проверяем метаданные пользователя из манифеста
+    manifest = run_manifest.load(run_id)
+    if manifest is None or not manifest.get("owner"):
         raise HTTPException(404, "Книга не найдена или недоступна")
-    
-    try:
-        user_meta = json.loads(user_meta_file.read_text(encoding="utf-8"))
-        stored_user_id = user_meta.get("user_id")
-        is_authenticated = user_meta.get("is_authenticated", False)
-    except Exception:
-        raise HTTPException(500, "Ошибка чтения метаданных книги")
+    stored_user_id = manifest["owner"].get("user_id")
 
     # Сохраняем формат книги
     (Path("data") / run_id / "format.txt").write_text("classic", encoding="utf-8")
+    run_manifest.set_fields(run_id, format="classic")
     
     # Запускаем полную сборку в фоне
     # Передаем пользователя или None для неавторизованных
     user_for_build = current_user if current_user else {"sub": stored_user_id}
-    background.add_task(run_full_build, run_id, "classic", user_for_build)
+    job_id = await _schedule_build(background, run_id, "classic", user_for_build)
     
-    return {"status": "ok", "runId": run_id, "message": "Начинаю создавать вашу книгу..."}
+    return {"status": "ok", "runId": run_id, "jobId": job_id, "message": "Начинаю создавать вашу книгу..."}
 
 @app.post("/create-flipbook")
 async def create_flipbook(request: Request, background: BackgroundTasks):
     """Создает flipbook в фоновом режиме - теперь доступно и без авторизации"""
     # Получаем пользователя опционально
-    current_user = get_user_from_request(request)
+    current_user = await get_user_from_request(request)
     
     payload = await request.json()
     run_id = payload.get("runId")
@@ -1800,71 +1820,31 @@ async def create_flipbook(request: Request, background: BackgroundTasks):
     if not run_id:
         raise HTTPException(400, "runId is required")
     
-    # Проверяем метаданные пользователя из файла
-    run_dir = Path("data") / run_id
-    user_meta_file = run_dir / "user_meta.json"
-    
-    if not user_meta_file.exists():
+    # Проверяем метаданные пользователя из манифеста
+    manifest = run_manifest.load(run_id)
+    if manifest is None or not manifest.get("owner"):
         raise HTTPException(404, "Книга не найдена или недоступна")
-    
-    try:
-        user_meta = json.loads(user_meta_file.read_text(encoding="utf-8"))
-        stored_user_id = user_meta.get("user_id")
-        is_authenticated = user_meta.get("is_authenticated", False)
-    except Exception:
-        raise HTTPException(500, "Ошибка чтения метаданных книги")
+    stored_user_id = manifest["owner"].get("user_id")
         
     # Сохраняем формат книги
     (Path("data") / run_id / "format.txt").write_text("flipbook", encoding="utf-8")
+    run_manifest.set_fields(run_id, format="flipbook")
 
     # Запускаем полную сборку в фоне
     # Передаем пользователя или None для неавторизованных
     user_for_build = current_user if current_user else {"sub": stored_user_id}
-    background.add_task(run_full_build, run_id, "flipbook", user_for_build)
-
-    return {"status": "ok", "runId": run_id, "message": "Начинаю создавать ваш флипбук..."}
-
-async def run_full_build(run_id: str, book_format: str, user: dict):
-    """
-    Полный асинхронный процесс сборки книги: ожидание фото, сборка текста и HTML.
-    """
-    run_dir = Path("data") / run_id
-    images_dir = run_dir / "images"
+    job_id = await _schedule_build(background, run_id, "flipbook", user_for_build)
 
-    # Если формат flipbook — удаляем старый book.html перед генерацией
-    if book_format == "flipbook":
-        book_html = run_dir / "book.html"
-        if book_html.exists():
-            book_html.unlink()
+    return {"status": "ok", "runId": run_id, "jobId": job_id, "message": "Начинаю создавать ваш флипбук..."}
 
-    # 1. Ждем завершения загрузки изображений (с таймаутом)
+async def _schedule_build(background: BackgroundTasks, run_id: str, book_format: str, user: dict) -> str | None:
+    """Ставит сборку в очередь воркеров; если Redis недоступен — собираем в фоне API-процесса."""
     try:
-        await asyncio.wait_for(wait_for_images(images_dir), timeout=300.0)
-    except asyncio.TimeoutError:
-        print(f"❌ Таймаут ожидания изображений для {run_id}")
-        return
-
-    # 2. Собираем данные
-    posts_file = run_dir / "posts.json"
-    posts_data = json.loads(posts_file.read_text(encoding="utf-8"))
-    
-    style_file = run_dir / "style.txt"
-    style = style_file.read_text(encoding="utf-8").strip() if style_file.exists() else "romantic"
-
-    images = sorted([str(p) for p in images_dir.glob("*")])[:30]
-    comments = [p.get('caption', '') for p in posts_data]
-
-    user_id = user.get("sub")
-    
-    # 3. Вызываем новый асинхронный диспетчер
-    await build_book(style, run_id, images, comments, book_format, user_id)
-    print(f"✅ Полная сборка для {run_id} (формат: {book_format}) завершена.")
-
-async def wait_for_images(images_dir: Path):
-    """Асинхронно ждет появления файлов в папке с изображениями."""
-    while not images_dir.exists() or not any(images_dir.iterdir()):
-        await asyncio.sleep(5)
-    print(f"✅ Изображения в {images_dir} обнаружены.")
+        return await enqueue("build", {"run_id": run_id, "book_format": book_format, "user": user})
+    except Exception as e:
+        log.warning(f"Очередь задач недоступна ({e}), сборка {run_id} будет выполнена в API-процессе")
+        background.add_task(run_full_build, run_id, book_format, user)
+        return None
 
 # Модели для работы с книгами пользователя
 class SaveBookRequest(BaseModel):
@@ -1906,9 +1886,8 @@ async def save_book_to_library(
     run_id = request.run_id
     
     # Проверяем, что книга существует и завершена
-    run_dir = Path("data") / run_id
-    html_file = run_dir / "book.html"
-    if not html_file.exists():
+    manifest = run_manifest.load(run_id)
+    if not manifest or not manifest["files"].get("html"):
         raise HTTPException(404, "Книга не найдена или еще не готова")
     
     # Создаем или получаем существующую книгу
@@ -1971,7 +1950,7 @@ async def delete_book(
 async def view_saved_book(book_id: str, request: Request, db: AsyncSession = Depends(get_db)):
     """Просмотр сохраненной книги"""
     # Проверяем аутентификацию из любого источника (включая токен из URL)
-    current_user = get_user_from_request(request)
+    current_user = await get_user_from_request(request)
     if not current_user:
         raise HTTPException(401, "Необходима авторизация для просмотра книги")
     
@@ -1985,7 +1964,8 @@ async def view_saved_book(book_id: str, request: Request, db: AsyncSession = Dep
         raise HTTPException(404, "HTML файл книги не найден")
     
     log.info(f"Saved book view for book {book_id} by user {clerk_user_id}")
-    return HTMLResponse(Path(book.html_path).read_text(encoding="utf-8"))
+    return await run_in_threadpool(http_cache.file_response, request, Path(book.html_path),
+                                   "text/html; charset=utf-8")
 
 @app.get("/books/{book_id}/download/{filename}")
 async def download_saved_book(
@@ -1996,7 +1976,7 @@ async def download_saved_book(
 ):
     """Скачать файл сохраненной книги"""
     # Проверяем аутентификацию из любого источника (включая токен из URL)
-    current_user = get_user_from_request(request)
+    current_user = await get_user_from_request(request)
     if not current_user:
         raise HTTPException(401, "Необходима авторизация для скачивания файла")
     
@@ -2019,6 +1999,9 @@ async def download_saved_book(
     
     log.info(f"Saved book download {filename} for book {book_id} by user {clerk_user_id}")
     
+    if filename == "book.html":
+        file_path = await run_in_threadpool(assets.export_self_contained, file_path.parent)
+    
     # Определяем MIME тип
     if filename.endswith('.pdf'):
         media_type = 'application/pdf'
@@ -2027,11 +2010,8 @@ async def download_saved_book(
     else:
         media_type = 'application/octet-stream'
     
-    return FileResponse(
-        path=file_path,
-        filename=filename,
-        media_type=media_type
-    )
+    return await run_in_threadpool(http_cache.file_response, request, file_path, media_type,
+                                   filename=filename, ranges=media_type == 'application/pdf')
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # POLAR PAYMENT ENDPOINTS
@@ -1,58 +1,189 @@
 from __future__ import annotations
-import anyio, logging
-from apify_client import ApifyClient
-from apify_client._errors import ApifyApiError
+import asyncio, base64, json, logging, time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
 from app.config import settings
 
 log = logging.getLogger("apify")
-_client = ApifyClient(settings.APIFY_TOKEN)
 
+# Apify REST API v2 через общий пул keep-alive соединений httpx: запуск актора
+# возвращает runId сразу (без ожидания конца прогона), поток пула не занимается.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ApifyApiError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Apify API {status_code}: {message}")
+        self.status_code = status_code
+
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+# операция → счётчики для /health/queue
+_metrics: Dict[str, Dict[str, float]] = {}
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Общий клиент на event loop процесса (API или воркер)."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=settings.APIFY_API_BASE,
+            headers={"Authorization": f"Bearer {settings.APIFY_TOKEN}"},
+            limits=httpx.Limits(max_connections=settings.APIFY_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.APIFY_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(settings.APIFY_TIMEOUT, connect=settings.APIFY_CONNECT_TIMEOUT),
+        )
+        _client_loop = loop
+    return _client
+
+
+def metrics() -> Dict[str, Dict[str, float]]:
+    return {op: dict(m) for op, m in _metrics.items()}
+
+
+def _record(op: str, seconds: float, error: bool, retries: int):
+    m = _metrics.setdefault(op, {"requests": 0, "errors": 0, "retries": 0,
+                                 "total_s": 0.0, "last_s": 0.0, "max_s": 0.0})
+    m["requests"] += 1
+    m["errors"] += int(error)
+    m["retries"] += retries
+    m["total_s"] = round(m["total_s"] + seconds, 3)
+    m["last_s"] = round(seconds, 3)
+    m["max_s"] = max(m["max_s"], round(seconds, 3))
+
+
+async def _request(op: str, method: str, path: str, idempotent: bool = True, **kwargs: Any) -> Any:
+    """Запрос к API с повтором сетевых ошибок и 429/5xx; возвращает разобранный JSON.
+
+    Неидемпотентный запрос (запуск актора) повторяется, только если сервер
+    его точно не выполнил: 429 или ошибка установки соединения.
+    """
+    retry_statuses = RETRY_STATUSES if idempotent else {429}
+    retry_errors = httpx.TransportError if idempotent else httpx.ConnectError
+    started = time.perf_counter()
+    attempt = 0
+    try:
+        while True:
+            try:
+                response = await _get_client().request(method, path, **kwargs)
+                if response.status_code not in retry_statuses or attempt >= settings.APIFY_RETRIES:
+                    break
+            except retry_errors as e:
+                if attempt >= settings.APIFY_RETRIES:
+                    raise
+                log.warning("Apify %s: %s, повтор", op, e)
+            attempt += 1
+            await asyncio.sleep(min(2 ** attempt * 0.5, 10))
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error", {}).get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise ApifyApiError(response.status_code, message[:300])
+        body = response.json()
+    except Exception:
+        _record(op, time.perf_counter() - started, True, attempt)
+        raise
+    _record(op, time.perf_counter() - started, False, attempt)
+    return body
+
+
+def _actor_path() -> str:
+    # В URL API имя актора пишется как username~actor-name
+    return settings.ACTOR_ID.replace("/", "~")
 
 
 def _normalize_webhooks(webhooks: list[dict]) -> list[dict]:
     out = []
     for wh in webhooks:
-        out.append(
-            {
-                "event_types":     wh.get("event_types") or wh.get("eventTypes"),
-                "request_url":     wh.get("request_url") or wh.get("requestUrl"),
-                "payload_template": wh.get("payload_template") or wh.get("payloadTemplate"),
-                "idempotency_key": wh.get("idempotency_key") or wh.get("idempotencyKey"),
-            }
-        )
+        item = {
+            "eventTypes":      wh.get("event_types") or wh.get("eventTypes"),
+            "requestUrl":      wh.get("request_url") or wh.get("requestUrl"),
+            "payloadTemplate": wh.get("payload_template") or wh.get("payloadTemplate"),
+            "idempotencyKey":  wh.get("idempotency_key") or wh.get("idempotencyKey"),
+        }
+        out.append({k: v for k, v in item.items() if v is not None})
     return out
 
 
 async def run_actor(run_input: dict, webhooks: list[dict] | None = None) -> dict:
-    """Запускаем Actor без блокировки event-loop."""
-    def _sync():
-        act = _client.actor(settings.ACTOR_ID)
-        return act.call(
-            run_input=run_input,
-            webhooks=_normalize_webhooks(webhooks) if webhooks else None,
-        )
-    return await anyio.to_thread.run_sync(_sync)
+    """Запускаем Actor и сразу возвращаем объект Run (о завершении сообщит вебхук)."""
+    params = {}
+    if webhooks:
+        encoded = json.dumps(_normalize_webhooks(webhooks)).encode()
+        params["webhooks"] = base64.b64encode(encoded).decode()
+    body = await _request("run_actor", "POST", f"/acts/{_actor_path()}/runs",
+                          idempotent=False, params=params, json=run_input)
+    return body["data"]
 
 
 async def fetch_run(run_id: str) -> dict:
-    """Получаем объект Run по runId (блокирующий SDK в пуле потоков)."""
-    return await anyio.to_thread.run_sync(lambda: _client.run(run_id).get())
+    """Получаем объект Run по runId."""
+    return (await _request("fetch_run", "GET", f"/actor-runs/{run_id}"))["data"]
 
 
-async def fetch_items(dataset_id: str, retries: int = 10, delay: float = 2.0) -> list[dict]:
-    """Скачиваем все items; повторяем, пока датасет не станет доступен."""
+async def _wait_dataset(dataset_id: str, retries: int, delay: float) -> dict | None:
+    """Метаданные датасета; ждём, пока он станет доступен."""
     for attempt in range(1, retries + 1):
         try:
-            return await anyio.to_thread.run_sync(
-                lambda: _client.dataset(dataset_id).list_items().items
-            )
+            info = (await _request("dataset", "GET", f"/datasets/{dataset_id}")).get("data")
+            if info is not None:
+                return info
         except ApifyApiError as err:
-            if getattr(err, "status_code", None) != 404:
+            if err.status_code != 404:
                 log.error("Apify error: %s", err)
                 raise
-            log.warning("Dataset %s not ready (try %s/%s) — wait %.1fs",
-                        dataset_id, attempt, retries, delay)
-            await anyio.sleep(delay)
-            delay *= 1.5
+        log.warning("Dataset %s not ready (try %s/%s) — wait %.1fs",
+                    dataset_id, attempt, retries, delay)
+        await asyncio.sleep(delay)
+        delay *= 1.5
     log.error("Dataset %s not found after %s retries", dataset_id, retries)
-    return []
+    return None
+
+
+async def _fetch_page(dataset_id: str, offset: int, limit: int) -> list[dict]:
+    return await _request("dataset_items", "GET", f"/datasets/{dataset_id}/items",
+                          params={"offset": offset, "limit": limit, "clean": "true", "format": "json"})
+
+
+async def iter_item_pages(dataset_id: str, page_size: int | None = None,
+                          retries: int = 10, delay: float = 2.0) -> AsyncIterator[list[dict]]:
+    """Страницы датасета (offset/limit) по порядку. Известные по itemCount
+    страницы запрашиваются параллельно окном APIFY_PAGE_CONCURRENCY, дальше —
+    последовательно, пока страница не придёт неполной."""
+    info = await _wait_dataset(dataset_id, retries, delay)
+    if info is None:
+        return
+    page_size = page_size or settings.APIFY_PAGE_SIZE
+    total = info.get("itemCount") or 0
+    window: deque[asyncio.Task] = deque()
+    offset = 0
+    last_size = page_size
+    try:
+        for offset in range(0, total, page_size):
+            window.append(asyncio.create_task(_fetch_page(dataset_id, offset, page_size)))
+            if len(window) >= settings.APIFY_PAGE_CONCURRENCY:
+                page = await window.popleft()
+                last_size = len(page)
+                yield page
+        while window:
+            page = await window.popleft()
+            last_size = len(page)
+            yield page
+        # itemCount мог отстать от реального размера датасета
+        offset = offset + page_size if total else 0
+        while last_size == page_size:
+            page = await _fetch_page(dataset_id, offset, page_size)
+            last_size = len(page)
+            if page:
+                yield page
+            offset += page_size
+    finally:
+        for task in window:
+            task.cancel()
+
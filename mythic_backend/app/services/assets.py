@@ -0,0 +1,136 @@
+# app/services/assets.py
+"""Фотографии книги как статические файлы вместо base64 внутри book.html.
+
+Сборщики стилей сохраняют обработанное фото один раз:
+  data/<run_id>/assets/<sha256[:20]>.jpg
+и вставляют в HTML ссылку ``{BACKEND_BASE}/assets/<run_id>/<имя>``. Имя —
+хэш содержимого, поэтому файл по этому адресу никогда не меняется и
+отдаётся с ``Cache-Control: immutable`` (см. GET /assets/{run_id}/{name}):
+book.html весит килобайты, а фото браузер скачивает один раз.
+
+Самодостаточный режим (PDF, офлайн-скачивание):
+  ▸ inline_assets() — подставляет data URL вместо ссылок на ассеты;
+  ▸ export_self_contained() — book.offline.html для скачивания, пересобирается
+    только если book.html новее;
+  ▸ local_path() — путь к файлу ассета по URL, им пользуется url_fetcher
+    рендера PDF, чтобы не ходить за фото по HTTP.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import logging
+import os
+import re
+import threading
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+from app.config import settings
+from app.services import image_derivatives
+from app.services.image_derivatives import derivative_path
+
+log = logging.getLogger("assets")
+
+ASSETS_DIRNAME = "assets"
+OFFLINE_NAME = "book.offline.html"
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+DIGEST_LEN = 20
+
+MEDIA_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+_NAME_RE = re.compile(r"^[0-9a-f]{%d}\.(jpg|png|webp)$" % DIGEST_LEN)
+_URL_RE = re.compile(
+    r"(?:https?://[^\s\"'()]*?)?/assets/(?P<run_id>[\w-]+)/(?P<name>[0-9a-f]{%d}\.(?:jpg|png|webp))" % DIGEST_LEN
+)
+
+
+def assets_dir(run_dir: Path) -> Path:
+    return run_dir / ASSETS_DIRNAME
+
+
+def asset_url(run_id: str, name: str) -> str:
+    return f"{settings.BACKEND_BASE.rstrip('/')}/assets/{run_id}/{name}"
+
+
+def store_bytes(run_dir: Path, data: bytes, ext: str = "jpg") -> str:
+    """Сохраняет байты под именем-хэшем (если такого файла ещё нет) и возвращает URL."""
+    name = f"{hashlib.sha256(data).hexdigest()[:DIGEST_LEN]}.{ext}"
+    target = assets_dir(run_dir) / name
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, target)
+    return asset_url(run_dir.name, name)
+
+
+def store_image(run_dir: Path, img: Image.Image, quality: int = 90) -> str:
+    """Сохраняет уже обработанное PIL-изображение как JPEG-ассет."""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return store_bytes(run_dir, buffer.getvalue())
+
+
+def store_file(run_dir: Path, path: Path, size: str = "web", quality: int = 88) -> str:
+    """Фото из images/ → ассет нужного размера. Готовая производная
+    (app/services/image_derivatives.py) копируется без декодирования."""
+    derived = derivative_path(path, size)
+    if derived != path:
+        return store_bytes(run_dir, derived.read_bytes())
+    max_side = image_derivatives.sizes()[size]
+    with Image.open(path) as img:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return store_image(run_dir, img, quality=quality)
+
+
+def resolve(run_id: str, name: str) -> Optional[Path]:
+    """Файл ассета по имени из URL или None (в том числе для чужих имён)."""
+    if not _NAME_RE.match(name) or "/" in run_id or run_id.startswith("."):
+        return None
+    path = assets_dir(Path("data") / run_id) / name
+    return path if path.is_file() else None
+
+
+def local_path(url: str) -> Optional[Path]:
+    """Локальный файл для URL ассета (любой хост) или None."""
+    match = _URL_RE.fullmatch(url)
+    if not match:
+        return None
+    return resolve(match.group("run_id"), match.group("name"))
+
+
+def _data_url(path: Path) -> str:
+    media_type = MEDIA_TYPES[path.suffix.lstrip(".")]
+    return f"data:{media_type};base64,{base64.b64encode(path.read_bytes()).decode()}"
+
+
+def inline_assets(html: str) -> str:
+    """Самодостаточный HTML: ссылки на ассеты заменяются data URL."""
+    cache = {}
+
+    def replace(match: re.Match) -> str:
+        url = match.group(0)
+        if url not in cache:
+            path = resolve(match.group("run_id"), match.group("name"))
+            cache[url] = _data_url(path) if path else url
+        return cache[url]
+
+    return _URL_RE.sub(replace, html)
+
+
+def export_self_contained(run_dir: Path) -> Path:
+    """book.offline.html рядом с book.html; пересобирается, только если book.html новее."""
+    html_file = run_dir / "book.html"
+    offline_file = run_dir / OFFLINE_NAME
+    if offline_file.exists() and offline_file.stat().st_mtime >= html_file.stat().st_mtime:
+        return offline_file
+    tmp = offline_file.with_name(f"{OFFLINE_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(inline_assets(html_file.read_text(encoding="utf-8")), encoding="utf-8")
+    os.replace(tmp, offline_file)
+    log.info("self-contained export written: %s", offline_file)
+    return offline_file
@@ -4,7 +4,12 @@ from io import BytesIO
 from pathlib import Path
 from PIL import Image, ImageFilter, ImageEnhance, ImageDraw, ImageFont
 from app.services.llm_client import strip_cliches, analyze_photo_for_memoir, generate_memoir_chapter
-from typing import List, Tuple, Optional
+from app.services.llm_gateway import llm_gateway, request_timeout
+from app.services import assets, book_document, posts_store
+from app.services.image_derivatives import derivative_path, vision_data_url
+from app.services.photo_selection import select_best
+from app.services.book_document import BookChapter, BookDocument
+from typing import Iterable, List, Tuple, Optional
 import random
 import time
 import re
@@ -38,15 +43,13 @@ async def generate_fantasy_book_agent(chapter_configs: List[dict], context_data:
     async def generate_chapter_async(config: dict, fallback: str) -> FantasyChapter:
         """Генерирует одну главу асинхронно с таймаутом"""
         try:
-            # Таймаут 20 секунд на главу
-            chapter_text = await asyncio.wait_for(
-                async_generate_memoir_chapter("fantasy_chapter", {
+            # 20 секунд на главу вместе с повторами (ожидание лимитов шлюза не считается)
+            with request_timeout(20.0):
+                chapter_text = await async_generate_memoir_chapter("fantasy_chapter", {
                     'prompt': config['prompt'],
                     'context': context_data,
                     'style': 'epic_fantasy'
-                }),
-                timeout=20.0
-            )
+                })
             
             # Проверяем качество результата
             if not chapter_text or len(chapter_text.strip()) < 100:
@@ -62,13 +65,6 @@ async def generate_fantasy_book_agent(chapter_configs: List[dict], context_data:
                 text=chapter_text
             )
             
-        except asyncio.TimeoutError:
-            print(f"⏰ Таймаут для главы '{config['title']}', использую fallback")
-            return FantasyChapter(
-                key=config['key'],
-                title=config['title'],
-                text=fallback
-            )
         except Exception as e:
             print(f"💔 Ошибка генерации главы '{config['title']}': {e}")
             return FantasyChapter(
@@ -93,14 +89,12 @@ async def generate_fantasy_book_agent(chapter_configs: List[dict], context_data:
     try:
         final_prompt = f"Напиши короткое финальное послание для фэнтези-книги о {context_data.get('full_name', 'герое')}."
         
-        final_message = await asyncio.wait_for(
-            async_generate_memoir_chapter("final_message", {
+        with request_timeout(10.0):
+            final_message = await async_generate_memoir_chapter("final_message", {
                 'prompt': final_prompt,
                 'context': context_data,
                 'style': 'epic_fantasy'
-            }),
-            timeout=10.0
-        )
+            })
         
         if not final_message or len(final_message.strip()) < 10:
             final_message = "Пусть твоя сага будет вечной, а имя — вписано в Книгу Героев!"
@@ -160,11 +154,91 @@ def run_fantasy_book_agent_sync(chapter_configs: List[dict], context_data: dict,
             final_message="Пусть твоя сага будет вечной, а имя — вписано в Книгу Героев!"
         )
 
+# Асинхронный агент для романтической книги: все главы + финальное послание параллельно
+async def generate_romantic_chapters_agent(chapter_configs: List[dict], context_data: dict,
+                                           quick_fallbacks: dict, final_prompt: str,
+                                           final_fallback: str) -> Tuple[dict, str]:
+    """Генерирует главы романтической книги параллельно (не более CHAPTER_CONCURRENCY
+    одновременно, CHAPTER_TIMEOUT на главу вместе с повторами — очередь к лимитам
+    шлюза в таймаут не входит). Возвращает (chapters, final_message) с главами в
+    порядке chapter_configs."""
+    from app.config import settings
+    from app.services import llm_client
+    from app.services.llm_gateway import current_build
+    from app.services.progress import publish
+
+    # Больше глав, чем слотов сборки в шлюзе, одновременно всё равно не пойдёт
+    semaphore = asyncio.Semaphore(min(settings.CHAPTER_CONCURRENCY, settings.LLM_PER_BUILD_CONCURRENCY))
+    run_id = current_build.get()
+    done = 0
+
+    def report(config: dict):
+        # Главы занимают диапазон 40–90% общего прогресса сборки
+        nonlocal done
+        done += 1
+        if run_id:
+            publish(run_id, "building", 40 + 50 * done // len(chapter_configs),
+                    message=f"Глава «{config['title']}» готова")
+
+    async def generate_chapter_async(config: dict, fallback: str) -> str:
+        try:
+            return await write_chapter(config, fallback)
+        finally:
+            report(config)
+
+    async def write_chapter(config: dict, fallback: str) -> str:
+        async with semaphore:
+            chapter_start = time.time()
+            try:
+                with request_timeout(settings.CHAPTER_TIMEOUT):
+                    generated_content = await llm_client.async_generate_memoir_chapter("romantic_book_chapter", {
+                        'prompt': config['prompt'],
+                        'context': context_data,
+                        'style': 'romantic_personal_gift'
+                    })
+            except Exception as e:
+                print(f"💔 Ошибка генерации главы '{config['title']}': {e}")
+                return fallback
+
+            # Проверяем качество результата
+            if len(generated_content.strip()) < 100:  # Если слишком короткий ответ
+                print(f"⚡ Короткий ответ для '{config['title']}', использую fallback")
+                return fallback
+
+            print(f"✅ Глава '{config['title']}' готова за {time.time() - chapter_start:.1f}с")
+            # Применяем форматирование: абзацы + выделения
+            return format_chapter_text(strip_cliches(generated_content))
+
+    async def generate_final_async() -> str:
+        try:
+            with request_timeout(settings.CHAPTER_TIMEOUT):
+                final_message = await llm_client.async_generate_memoir_chapter("final_message", {
+                    'prompt': final_prompt,
+                    'context': context_data,
+                    'style': 'poetic_farewell'
+                })
+            return final_message if final_message and final_message.strip() else final_fallback
+        except Exception as e:
+            print(f"💔 Ошибка генерации финального послания: {e}")
+            return final_fallback
+
+    print(f"🚀 Запускаю параллельную генерацию {len(chapter_configs)} глав...")
+    results = await asyncio.gather(
+        *[
+            generate_chapter_async(config, quick_fallbacks.get(config['key'], f"Глава о {config['title'].lower()} полна восхищения и теплых слов."))
+            for config in chapter_configs
+        ],
+        generate_final_async(),
+    )
+    chapters = {config['key']: text for config, text in zip(chapter_configs, results)}
+    return chapters, results[-1]
+
 # Асинхронная версия generate_memoir_chapter
 async def async_generate_memoir_chapter(chapter_type: str, params: dict) -> str:
     """Асинхронная версия generate_memoir_chapter"""
     try:
-        from app.services.llm_client import async_client, settings
+        from app.config import settings
+        from app.services.llm_cache import llm_cache, make_key
         
         prompt = params.get('prompt', '')
         context = params.get('context', {})
@@ -174,28 +248,35 @@ async def async_generate_memoir_chapter(chapter_type: str, params: dict) -> str:
         system_message = f"Ты — мастер эпического фэнтези. Создавай тексты в стиле {style}."
         user_message = f"{prompt}"
         
-        response = await async_client.chat.completions.create(
-            model=settings.AZURE_OPENAI_GPT4_DEPLOYMENT,
-            messages=[
+        use_cache = llm_cache.enabled_for(0.7)
+        if use_cache:
+            cache_key = make_key(settings.AZURE_OPENAI_GPT4_DEPLOYMENT, system_message, user_message, None, 0.7, 800)
+            cached = await llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        result = await llm_gateway.complete_text(
+            [
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_message}
             ],
             temperature=0.7,
             max_tokens=800  # Минимальный лимит токенов
         )
-        
-        result = response.choices[0].message.content.strip()
+        if result and use_cache:
+            await llm_cache.set(cache_key, result)
         return result if result else ""
         
     except Exception as e:
         print(f"❌ Ошибка async_generate_memoir_chapter: {e}")
         return ""
 
-def analyze_profile_data(posts_data: list) -> dict:
-    if not posts_data:
+def analyze_profile_data(posts_data: Iterable[dict]) -> dict:
+    # Достаточно первого item (профиль) — из ленивого итератора posts_store
+    # читается только он
+    profile = next(iter(posts_data or ()), None)
+    if not profile:
         return {}
-    
-    profile = posts_data[0]
     posts = profile.get("latestPosts", [])
     
     analysis = {
@@ -276,13 +357,9 @@ def build_romantic_book(run_id: str, images: list[Path], texts: str, book_format
     try:
         
         run_dir = Path("data") / run_id
-        posts_json = run_dir / "posts.json"
         images_dir = run_dir / "images"
         
-        if posts_json.exists():
-            posts_data = json.loads(posts_json.read_text(encoding="utf-8"))
-        else:
-            posts_data = []
+        posts_data = posts_store.iter_items(run_dir)  # ленивый итератор по posts.ndjson
         
         
         analysis = analyze_profile_data(posts_data)
@@ -318,19 +395,17 @@ def build_romantic_book(run_id: str, images: list[Path], texts: str, book_format
         
         # Генерируем контент в зависимости от формата
         content = {"format": "literary"}  
-        html = create_literary_instagram_book_html(content, analysis, actual_images)
-        
         out = Path("data") / run_id
         out.mkdir(parents=True, exist_ok=True)
         
         html_file = out / "book.html"
-        html_file.write_text(html, encoding="utf-8")
+        create_literary_instagram_book_html(content, analysis, actual_images, html_file)
         
         # Генерируем PDF версию
         try:
             pdf_file = out / "book.pdf"
-            # Создаем красивый PDF из HTML контента с помощью WeasyPrint
-            create_pdf_with_weasyprint(pdf_file, html)
+            # Создаем красивый PDF из HTML книги с помощью WeasyPrint
+            create_pdf_with_weasyprint(pdf_file, html_path=html_file)
             print(f"📄 Красивая PDF версия создана: {pdf_file}")
         except Exception as pdf_error:
             print(f"❌ Ошибка создания PDF: {pdf_error}")
@@ -378,7 +453,7 @@ def build_romantic_book(run_id: str, images: list[Path], texts: str, book_format
                         user_library_dir.mkdir(parents=True, exist_ok=True)
                         
                         # Копируем файлы книги
-                        for file in ["book.html", "book.pdf", "posts.json"]:
+                        for file in ["book.html", "book.json", "book.pdf", "posts.ndjson", "posts.json"]:
                             source_file = source_dir / file
                             if source_file.exists():
                                 shutil.copy2(source_file, user_library_dir / file)
@@ -585,18 +660,9 @@ def analyze_photo_for_gender(img_path: Path) -> str:
     try:
         from app.services.llm_client import generate_text
         
-        with Image.open(img_path) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Уменьшаем размер для анализа
-            img.thumbnail((400, 400), Image.Resampling.LANCZOS)
-            
-            buffer = BytesIO()
-            img.save(buffer, format='JPEG', quality=80)
-            img_str = base64.b64encode(buffer.getvalue()).decode()
-            img_data = f"data:image/jpeg;base64,{img_str}"
-            
+        # Готовая vision-производная (512px), без повторного декодирования оригинала
+        img_data = vision_data_url(img_path)
+        if img_data:
             prompt = """Проанализируй это фото и определи пол человека. 
             
             Ответь ТОЛЬКО одним словом:
@@ -614,6 +680,7 @@ def analyze_photo_for_gender(img_path: Path) -> str:
                 return "male"
             else:
                 return "unknown"
+        return "unknown"
                 
     except Exception as e:
         print(f"❌ Ошибка анализа пола по фото: {e}")
@@ -865,8 +932,8 @@ def analyze_name_for_gender(name: str) -> str:
     
     return "unknown"
 
-def create_literary_instagram_book_html(content: dict, analysis: dict, images: list[Path]) -> str:
-    """Создает HTML романтическую книгу-подарок от человека к человеку"""
+def create_literary_instagram_book_html(content: dict, analysis: dict, images: list[Path], output_path: Path) -> Path:
+    """Создает HTML романтическую книгу-подарок от человека к человеку, сохраняет её документ (book.json) и пишет HTML в output_path"""
     
     # Используем fullName как основное имя
     full_name = analysis.get('full_name', analysis.get('username', 'дорогой человек'))
@@ -894,25 +961,18 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
                 'alt': post.get('alt', '')
             })
     
-    # AI-анализ для первых 3 рилсов
-    from app.services.media_analyzer import MediaAnalysisRequest, analyze_media_item
+    # Запросы на AI-анализ для первых 3 рилсов — выполняются одним этапом вместе с фото
+    from app.services.media_analyzer import MediaAnalysisRequest, analyze_media_batch
+    reel_requests = [
+        MediaAnalysisRequest(
+            image_path=None,
+            caption=reel.get('caption',''),
+            alt_text=reel.get('alt',''),
+            media_type='reel'
+        )
+        for reel in video_content[:3]
+    ]
     analyzed_reels = []
-    for reel in video_content[:3]:
-        try:
-            req = MediaAnalysisRequest(
-                image_path=None,
-                caption=reel.get('caption',''),
-                alt_text=reel.get('alt',''),
-                media_type='reel'
-            )
-            res = analyze_media_item(req)
-            reel['analysis'] = res.description
-            reel['mood'] = res.mood
-            analyzed_reels.append(reel)
-        except Exception as e:
-            print(f"media_analyzer reel error: {e}")
-            reel['analysis'] = 'Динамичный момент, наполненный энергией'
-            analyzed_reels.append(reel)
     
     # Обрабатываем изображения (РАНДОМНЫЙ выбор - не подряд!)
     processed_images = []
@@ -920,30 +980,14 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
     selected_photo_data = []  # Данные о выбранных фото для анализа
     
     if images:
-        # НОВАЯ ЛОГИКА: РАНДОМНЫЙ выбор 7 фото из всего массива
-        import random
-        
         total_images = len(images)
         print(f"📸 Всего фото в профиле: {total_images}")
         
-        if total_images >= 7:
-            # Если фото много - берем 7 случайных без повторов
-            selected_indices = random.sample(range(total_images), 7)
-            selected_indices.sort()  # Сортируем для красивого вывода
-        elif total_images >= 4:
-            # Если фото мало - берем все + добавляем случайные дубли до 7
-            selected_indices = list(range(total_images))
-            while len(selected_indices) < 7:
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
-        else:
-            # Если фото очень мало - дублируем случайным образом до 7
-            selected_indices = []
-            for _ in range(7):
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
+        # До 7 лучших различных фото: дубли схлопнуты, порядок — по качеству
+        # (резкость, экспозиция, лицо в кадре); LLM-анализ тратится только на них
+        selected_indices = select_best(images, 7)
         
-        print(f"📸 Рандомный выбор: из {total_images} выбрал позиции {selected_indices}")
+        print(f"📸 Отобраны лучшие фото: из {total_images} выбрал позиции {selected_indices}")
         
         # Анализируем первое ВЫБРАННОЕ фото для определения пола
         if images and selected_indices and images[selected_indices[0]].exists():
@@ -951,12 +995,14 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
             detected_gender = analyze_photo_for_gender(images[selected_indices[0]])
             print(f"✅ Определен пол: {detected_gender}")
         
-        # Обрабатываем выбранные фотографии (7 штук рандомно)
+        # Обрабатываем выбранные фотографии
+        prepared_photos = []
         for i, idx in enumerate(selected_indices):
             img_path = images[idx]
             if img_path.exists():
                 try:
-                    with Image.open(img_path) as img:
+                    # Производная web (700px) — оригинал уже декодирован на этапе загрузки
+                    with Image.open(derivative_path(img_path, "web")) as img:
                         if img.mode != 'RGB':
                             img = img.convert('RGB')
                         
@@ -970,64 +1016,72 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
                         enhancer = ImageEnhance.Color(img)
                         img = enhancer.enhance(1.1)
                         
-                        buffer = BytesIO()
-                        img.save(buffer, format='JPEG', quality=90)
-                        img_str = base64.b64encode(buffer.getvalue()).decode()
-                        processed_images.append(f"data:image/jpeg;base64,{img_str}")
-                        
-                        # ИИ анализ фото для генерации описания (исправленный)
-                        photo_analysis = ""
-                        try:
-                            print(f"🧠 ИИ анализирует фото #{idx+1} для создания описания...")
-                            
-                            # Попробуем разные способы импорта
-                            try:
-                                from app.services.media_analyzer import MediaAnalysisRequest, analyze_media_item
-                                req = MediaAnalysisRequest(image_path=img_path)
-                                ai_result = analyze_media_item(req)
-                                photo_analysis = ai_result.description
-                                print(f"✅ ИИ анализ через media_analyzer: {photo_analysis[:50]}...")
-                            except Exception as import_error:
-                                print(f"⚠️ media_analyzer недоступен: {import_error}")
-                                
-                                # Fallback: используем прямой анализ через LLM
-                                try:
-                                    photo_analysis = analyze_photo_for_memoir(img_path, f"Instagram профиль @{username}", "first_impression")
-                                    print(f"✅ ИИ анализ через memoir: {photo_analysis[:50]}...")
-                                except:
-                                    photo_analysis = ""
-                            
-                            # Обрезаем описание если оно слишком длинное
-                            if photo_analysis and len(photo_analysis) > 120:
-                                photo_analysis = photo_analysis[:117] + "..."
-                                
-                        except Exception as e:
-                            print(f"❌ Ошибка ИИ анализа фото #{idx+1}: {e}")
-                            photo_analysis = ""
-                        
-                        # Если ИИ анализ не сработал - используем качественные fallback'ы
-                        if not photo_analysis or len(photo_analysis.strip()) < 10:
-                            print(f"⚡ Использую fallback описание для фото #{idx+1}")
-                            fallback_descriptions = [
-                                "Естественная красота в каждой детали",
-                                "Взгляд, полный глубины и искренности", 
-                                "Особая атмосфера и харизма",
-                                "Эмоции, которые говорят без слов",
-                                "Магнетическая энергетика личности",
-                                "Грация и стиль в каждом движении",
-                                "Момент совершенства, застывший в кадре"
-                            ]
-                            photo_analysis = fallback_descriptions[i % len(fallback_descriptions)]
-                        
-                        selected_photo_data.append({
-                            'index': idx + 1,  # Номер фото в профиле
-                            'analysis': photo_analysis,
-                            'image': f"data:image/jpeg;base64,{img_str}"
-                        })
-                        
-                        print(f"✅ Обработано фото #{idx+1} из профиля: '{photo_analysis[:30]}...'")
+                        # Фото сохраняется ассетом под хэшем содержимого — в HTML только ссылка
+                        img_url = assets.store_image(img_path.parent.parent, img, quality=90)
+                        processed_images.append(img_url)
+                        prepared_photos.append((i, idx, img_path, img_url))
                 except Exception as e:
                     print(f"❌ Ошибка обработки изображения {img_path}: {e}")
+        
+        # ИИ анализ всех выбранных фото (и рилсов) одним параллельным этапом;
+        # повторно выбранные фото анализируются один раз
+        unique_paths = list(dict.fromkeys(img_path for _, _, img_path, _ in prepared_photos))
+        print(f"🧠 ИИ анализирует {len(unique_paths)} фото и {len(reel_requests)} рилсов...")
+        try:
+            batch_results = analyze_media_batch(
+                reel_requests + [MediaAnalysisRequest(image_path=p) for p in unique_paths]
+            )
+        except Exception as e:
+            print(f"❌ Ошибка пакетного ИИ анализа: {e}")
+            batch_results = []
+        reel_results = batch_results[:len(reel_requests)]
+        photo_results = dict(zip(unique_paths, batch_results[len(reel_requests):]))
+        
+        for i, idx, img_path, img_url in prepared_photos:
+            result = photo_results.get(img_path)
+            photo_analysis = result.description if result else ""
+            
+            # Обрезаем описание если оно слишком длинное
+            if photo_analysis and len(photo_analysis) > 120:
+                photo_analysis = photo_analysis[:117] + "..."
+            
+            # Если ИИ анализ не сработал - используем качественные fallback'ы
+            if not photo_analysis or len(photo_analysis.strip()) < 10:
+                print(f"⚡ Использую fallback описание для фото #{idx+1}")
+                fallback_descriptions = [
+                    "Естественная красота в каждой детали",
+                    "Взгляд, полный глубины и искренности", 
+                    "Особая атмосфера и харизма",
+                    "Эмоции, которые говорят без слов",
+                    "Магнетическая энергетика личности",
+                    "Грация и стиль в каждом движении",
+                    "Момент совершенства, застывший в кадре"
+                ]
+                photo_analysis = fallback_descriptions[i % len(fallback_descriptions)]
+            
+            selected_photo_data.append({
+                'index': idx + 1,  # Номер фото в профиле
+                'analysis': photo_analysis,
+                'image': img_url
+            })
+            
+            print(f"✅ Обработано фото #{idx+1} из профиля: '{photo_analysis[:30]}...'")
+    elif reel_requests:
+        try:
+            reel_results = analyze_media_batch(reel_requests)
+        except Exception as e:
+            print(f"❌ Ошибка ИИ анализа рилсов: {e}")
+            reel_results = []
+    else:
+        reel_results = []
+    
+    for n, reel in enumerate(video_content[:3]):
+        if n < len(reel_results):
+            reel['analysis'] = reel_results[n].description
+            reel['mood'] = reel_results[n].mood
+        else:
+            reel['analysis'] = 'Динамичный момент, наполненный энергией'
+        analyzed_reels.append(reel)
     
     # Helper function for safely getting photo analysis from the list
     def get_safe_photo_analysis(index: int, fallback_text: str) -> str:
@@ -1132,9 +1186,8 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
         }
     ]
     
-    # Генерируем каждую главу через ИИ (БЫСТРО)
+    # Генерируем все главы через ИИ параллельно
     start_time = time.time()
-    max_generation_time = 120  # Максимум 2 минуты на всю книгу
     
     # Быстрые fallback тексты для каждой главы
     quick_fallbacks = {
@@ -1159,55 +1212,8 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
         'gratitude_wishes': f"{full_name}, эта книга подходит к концу, но восхищение остается навсегда. Продолжай быть собой, продолжай фотографировать мир таким, каким ты его видишь. Желаю тебе любви, счастья и ярких моментов. Спасибо за то, что ты есть. Твой поклонник."
     }
     
-    for config in chapter_configs:
-        # Проверяем, не превысили ли лимит времени
-        elapsed_time = time.time() - start_time
-        if elapsed_time > max_generation_time:
-            print(f"⏰ Превышен лимит времени ({max_generation_time}с), используем быстрые fallback'ы")
-            # Заполняем оставшиеся главы быстрыми fallback'ами
-            for remaining_config in chapter_configs[len(chapters):]:
-                chapters[remaining_config['key']] = quick_fallbacks.get(remaining_config['key'], f"Эта глава о {remaining_config['title'].lower()} написана с особой теплотой и вниманием к деталям.")
-            break
-        
-        try:
-            print(f"💝 Генерирую главу '{config['title']}' для {full_name}... ({elapsed_time:.1f}с)")
-            
-            # Быстрая генерация с таймаутом 15 секунд на главу
-            chapter_start = time.time()
-            generated_content = generate_memoir_chapter("romantic_book_chapter", {
-                'prompt': config['prompt'],
-                'context': context_data,
-                'style': 'romantic_personal_gift'
-            })
-            
-            chapter_time = time.time() - chapter_start
-            if chapter_time > 15:  # Если глава генерировалась дольше 15 секунд
-                print(f"⚡ Глава '{config['title']}' генерировалась {chapter_time:.1f}с - долго!")
-            
-            # Проверяем качество результата
-            if len(generated_content.strip()) < 100:  # Если слишком короткий ответ
-                print(f"⚡ Короткий ответ для '{config['title']}', использую fallback")
-                chapters[config['key']] = quick_fallbacks.get(config['key'], f"Глава о {config['title'].lower()} полна восхищения и теплых слов.")
-            else:
-                clean_content = strip_cliches(generated_content)
-                # Применяем форматирование: абзацы + выделения
-                chapters[config['key']] = format_chapter_text(clean_content)
-            
-            print(f"✅ Глава '{config['title']}' готова за {chapter_time:.1f}с")
-            
-        except Exception as e:
-            print(f"💔 Ошибка генерации главы '{config['title']}': {e}")
-            # Быстрый fallback
-            chapters[config['key']] = quick_fallbacks.get(config['key'], f"Дорогой {full_name}, эта глава посвящена твоей особенной природе. Ты удивительный человек, и это видно в каждом твоем посте.")
-    
-    total_time = time.time() - start_time
-    print(f"⏱️ Все главы сгенерированы за {total_time:.1f} секунд")
-    
-    # Генерируем финальное послание
-    final_page_content = f"С бесконечным восхищением и благодарностью. Ты — особенный человек. Спасибо тебе за всё."
-    try:
-        print("💝 Генерирую финальное послание...")
-        final_prompt = f"""Напиши очень короткое и поэтичное финальное послание (1 предложения) для романтической книги о {full_name}.
+    final_fallback = f"С бесконечным восхищением и благодарностью. Ты — особенный человек. Спасибо тебе за всё."
+    final_prompt = f"""Напиши очень короткое и поэтичное финальное послание (1 предложения) для романтической книги о {full_name}.
 
 ПОЛ: {gender} - обращайся соответственно.
 
@@ -1218,15 +1224,20 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
 
 СТИЛЬ: Очень коротко, нежно, искренне. Без длинных вступлений и заключений. Только сама суть.
 """
-        final_page_content = generate_memoir_chapter("final_message", {
-            'prompt': final_prompt,
-            'context': context_data,
-            'style': 'poetic_farewell'
-        })
-        print("✅ Финальное послание готово.")
+    try:
+        # Корутины выполняются на loop LLM-шлюза; этот поток просто ждёт результат
+        generated_chapters, final_page_content = llm_gateway.run_sync(generate_romantic_chapters_agent(
+            chapter_configs, context_data, quick_fallbacks, final_prompt, final_fallback
+        ))
+        chapters.update(generated_chapters)
     except Exception as e:
-        print(f"💔 Ошибка генерации финального послания: {e}")
-        # fallback is already set
+        print(f"❌ Ошибка запуска агента глав: {e}")
+        for config in chapter_configs:
+            chapters[config['key']] = quick_fallbacks.get(config['key'], f"Глава о {config['title'].lower()} полна восхищения и теплых слов.")
+        final_page_content = final_fallback
+    
+    total_time = time.time() - start_time
+    print(f"⏱️ Все главы сгенерированы за {total_time:.1f} секунд")
     
     # Генерируем личное название книги
     book_titles = [
@@ -1238,466 +1249,50 @@ def create_literary_instagram_book_html(content: dict, analysis: dict, images: l
     ]
     book_title = random.choice(book_titles)
     
-    # HTML в стиле личного подарка
-  # HTML в стиле личного подарка
-  # HTML в стиле личного подарка
-    html = f"""<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{book_title}</title>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Playfair+Display:ital,wght@0,400;0,700;1,400;1,700&family=Open+Sans:ital,wght@0,400;0,700;1,400&display=swap" rel="stylesheet">
-    
-    <style>
-    /* Белый фон страниц, чёрный акцент */
-    :root {{
-        --accent-color: #333333;      /* чёрный вместо фиолетового */
-        --background-color: #ffffff;  /* белый фон */
-        --text-color: #333;
-        --font-body: 'Playfair Display', serif;
-        --font-caption: 'Open Sans', sans-serif;
-    }}
-
-    @page {{
-        size: A5 portrait;
-        margin: 2.5cm; /* Еще больше отступы */
-        
-        @bottom-center {{
-            content: counter(page);
-            font-family: 'Playfair Display', serif;
-            font-size: 16pt;
-            color: #555;
-            border-top: 1px solid #ddd;
-            padding-top: 0.25cm;
-            width: 100%;
-        }}
-    }}
-
-    body {{
-        font-family: var(--font-body);
-        background-color: var(--background-color) !important;
-        color: var(--text-color);
-        line-height: 1.6;
-        font-size: 24pt;
-        margin: 0;
-        counter-reset: page;
-    }}
-
-    .book-page {{
-        page-break-after: always;
-        position: relative;
-        overflow: hidden;
-        background-color: var(--background-color) !important;
-        box-shadow: none;  /* убираем тень страниц */
-    }}
-
-    .book-page:last-of-type {{
-        page-break-after: auto;
-    }}
-
-    /* Cover Page */
-    .cover-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        height: 100vh;
-        text-align: center;
-    }}
-
-    .cover-title {{
-        font-family: 'Playfair Display', serif;
-        font-size: 48pt;
-        font-weight: 700;
-        margin: 0;
-    }}
-
-    .cover-subtitle {{
-        font-family: 'Playfair Display', serif;
-        font-style: italic;
-        font-size: 24pt;
-        margin: 1rem 0 3rem 0;
-    }}
-
-    .cover-author {{
-        position: absolute;
-        bottom: 1.5cm;
-        font-size: 18pt;
-    }}
-
-    .cover-content {{
-        border: 2px solid #333;
-        padding: 2rem 3rem;
-    }}
-    
-    .cover-separator {{
-        width: 80px;
-        height: 1px;
-        background: #333;
-        margin: 0 auto 1.5rem;
-    }}
-
-    .cover-dedication {{
-        font-family: 'Open Sans', sans-serif;
-        font-style: italic;
-        font-size: 14pt;
-    }}
-
-    /* Table of Contents */
-    .toc-page {{
-        padding: 0; /* Padding is handled by @page margins */
-    }}
-
-    .toc-title {{
-        font-size: 36pt;
-        font-weight: bold;
-        text-transform: uppercase;
-        text-align: center;
-        margin-top: 1cm;
-        margin-bottom: 2cm;
-        color: var(--accent-color);
-    }}
-
-    .toc-list {{
-        list-style: none;
-        padding: 0;
-        font-size: 20pt;
-        font-family: 'Playfair Display', serif;
-    }}
-
-    .toc-item {{
-        display: flex;
-        margin-bottom: 0.5rem;
-        align-items: baseline;
-    }}
-
-    .toc-item .chapter-name {{
-        order: 1;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-    
-    /* Убираем точечные линии-лидеры в оглавлении */
-    .toc-item .leader {{
-        flex-grow: 0;
-        border-bottom: none;
-        margin: 0;
-        position: static;
-    }}
-
-    .toc-item .page-ref {{
-        order: 3;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-
-    .toc-item .page-ref::after {{
-        content: target-counter(attr(href), page);
-    }}
-    
-    /* Chapter Page */
-    .chapter-page {{
-        padding: 0; /* Padding is handled by @page margins */
-    }}
-
-    .chapter-main-title {{
-        font-family: var(--font-body);
-        font-weight: bold;
-        font-size: 32pt; /* Немного уменьшил, чтобы помещалось */
-        text-align: center;
-        text-transform: uppercase;
-        color: var(--accent-color);
-        margin: 1cm 0;
-        line-height: 1.2; /* Добавил высоты строки для многострочных заголовков */
-        overflow-wrap: break-word; /* Перенос слишком длинных слов */
-        hyphens: auto; /* Автоматические переносы */
-    }}
-    
-    .chapter-subtitle {{
-        font-family: var(--font-body);
-        font-style: italic;
-        font-size: 18pt;
-        text-align: left;
-        margin: 0 0 1rem 0;
-    }}
-
-    .chapter-image-container {{
-        text-align: center;
-        margin: 1cm 0;
-        page-break-inside: avoid;
-    }}
-
-    .chapter-image {{
-        max-width: 90%;
-        border: 1px solid #ddd;
-        padding: 0.5cm;
-    }}
-
-    .chapter-image-caption {{
-        font-family: var(--font-caption);
-        font-style: italic;
-        font-size: 14pt;
-        margin-top: 0.5rem;
-        color: var(--accent-color);
-    }}
-    
-    .chapter-body p {{
-        font-size: 24pt;
-        line-height: 1.6;
-        margin-bottom: 1em;
-    }}
-
-    .chapter-body p:first-of-type::first-letter {{
-        /* Современный способ создания буквицы, который лучше поддерживается рендерами PDF */
-        initial-letter: 3; /* Буква будет высотой в 3 строки */
-        font-weight: bold;
-        padding-right: 0.2em; /* Небольшой отступ справа для воздуха */
-        color: #555; /* Сделаем ее чуть светлее для элегантности */
-    }}
-    
-    /* Final Page Styles */
-    .final-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        text-align: center;
-    }}
-    .final-content {{
-        font-family: 'Playfair Display', serif;
-        font-style: italic;
-        font-size: 24pt;
-        line-height: 1.7;
-        max-width: 80%;
-    }}
-    .final-ornament {{
-        font-size: 32pt;
-        color: var(--accent-color);
-        margin: 2rem 0;
-        font-family: serif;
-    }}
-    .final-signature {{
-        margin-top: 1rem;
-        font-size: 18pt;
-        font-style: normal;
-    }}
-
-    @media screen {{
-        body {{
-            font-size: 16px;
-        }}
-        .book-page {{
-            width: 148mm; /* A5 width */
-            min-height: 210mm; /* A5 height */
-            margin: 2rem auto;
-            padding: 2.5cm; /* Увеличенные отступы для веб-просмотра */
-            box-sizing: border-box;
-            height: auto;
-        }}
-        .cover-page {{
-            height: 210mm;
-            position: relative;
-        }}
-        .chapter-body p {{ font-size: 14pt; }}
-        .chapter-body p:first-of-type::first-letter {{ font-size: 38pt; }}
-        .cover-title {{ font-size: 32pt; }}
-        .cover-subtitle {{ font-size: 18pt; }}
-        .toc-title {{ font-size: 24pt; }}
-        .toc-list {{ font-size: 14pt; }}
-        .chapter-main-title {{ font-size: 24pt; }}
-        .chapter-subtitle {{ font-size: 12pt; }}
-        .final-content {{ font-size: 18pt; }}
-        .final-signature {{ font-size: 14pt; }}
-    }}
-
-    @media (max-width: 428px) {{
-        .book-page {{            
-            padding: 1cm; /* Увеличенные отступы для веб-просмотра */
-        }}
-    }}
-    </style>
-</head>
-<body>
-
-<!-- Cover Page -->
-<div class="book-page cover-page">
-    <div class="cover-content">
-        <h1 class="cover-title">{full_name.upper()}</h1>
-        <p class="cover-subtitle">An Unforgettable Story</p>
-        <div class="cover-separator"></div>
-        <p class="cover-dedication">A gift from a secret admirer</p>
-    </div>
-</div>
-
-<!-- Table of Contents -->
-<div class="book-page toc-page">
-    <h2 class="toc-title">Table of Contents</h2>
-    <ul class="toc-list">
-        {"".join([f'''
-            <li class="toc-item">
-                <a href="#chapter-{config['key']}" class="chapter-name">Chapter {i+1} – {config['title']}</a>
-                <span class="leader"></span>
-                <a href="#chapter-{config['key']}" class="page-ref"></a>
-            </li>
-        ''' for i, config in enumerate(chapter_configs)])}
-    </ul>
-</div>
-
-<!-- Chapter Pages -->"""
-
-    # Генерируем главы отдельно, чтобы избежать проблем с вложенными f-строками
+    # Главы документа книги: текст и фото с подписью (если хватило фото)
+    book_chapters = []
     for i, config in enumerate(chapter_configs):
-        # Генерируем HTML для изображения
-        image_html = ""
+        chapter = BookChapter(
+            key=config['key'],
+            title=config['title'],
+            text=chapters.get(config['key'], '<p>Эта глава скоро наполнится словами восхищения...</p>'),
+        )
         if i < len(selected_photo_data):
             photo_data = selected_photo_data[i]
-            analysis = photo_data['analysis']
-            if len(analysis) > 80:
-                analysis = analysis[:80] + '...'
-            
-            image_html = f"""
-    <div class="chapter-image-container">
-        <img src="{photo_data['image']}" alt="Photo for Chapter {i+1}" class="chapter-image">
-        <p class="chapter-image-caption">{analysis}</p>
-    </div>"""
-
-        # Добавляем главу к HTML
-        html += f"""
-<div id="chapter-{config['key']}" class="book-page chapter-page">
-    <h3 class="chapter-subtitle">Chapter {i+1}</h3>
-    <h2 class="chapter-main-title">{config['title']}</h2>
-    {image_html}
-    <div class="chapter-body">
-        {chapters.get(config['key'], '<p>Эта глава скоро наполнится словами восхищения...</p>')}
-    </div>
-</div>"""
-
-    # Добавляем финальную страницу
-    html += f"""
-<!-- Final Page -->
-<div class="book-page final-page">
-    <div class="final-content">
-        <p>{final_page_content.replace(chr(10), '<br>')}</p>
-    </div>
-    <div class="final-ornament">
-        ❦
-    </div>
-    <div class="final-signature">
-        <p>Помни, что каждый человек достоин любви.</p>
-    </div>
-</div>
-
-</body>
-</html>"""
+            note = photo_data['analysis']
+            chapter.image = photo_data['image']
+            chapter.image_note = note
+            chapter.caption = note[:80] + '...' if len(note) > 80 else note
+        book_chapters.append(chapter)
     
-    return html
+    # HTML в стиле личного подарка — документ book.json и шаблон app/templates/books/romantic_classic.html
+    doc = BookDocument(
+        style="romantic",
+        format="classic",
+        template="books/romantic_classic.html",
+        title=book_title,
+        full_name=full_name,
+        chapters=book_chapters,
+        final_message=final_page_content,
+    )
+    return book_document.write(doc, output_path)
+
+def create_pdf_with_weasyprint(output_path: Path, html_content: str = None, html_path: Path = None):
+    """Генерирует красивый PDF из HTML (строки или файла) используя WeasyPrint (в пуле процессов рендера).
+
+    Ошибка рендера (PdfRenderError) пробрасывается: заглушка вместо книги в
+    output_path не пишется, недописанный файл — тоже (временный файл + os.replace).
+    """
+    import os
+    from app.services.pdf_renderer import get_pdf_pool
 
-def create_pdf_with_weasyprint(output_path: Path, html_content: str):
-    """Генерирует красивый PDF из HTML используя WeasyPrint."""
+    tmp_file = output_path.with_suffix(f".pdf.{os.getpid()}.tmp")
     try:
-        from weasyprint import HTML, CSS
-        
-        # Создаем PDF из HTML контента
-        html_doc = HTML(string=html_content)
-        
-        # Дополнительные CSS стили для печати PDF
-        print_css = CSS(string="""
-            @page {
-                margin: 1.5cm;
-                size: A4;
-            }
-            
-            body {
-                margin: 0;
-                padding: 0;
-            }
-            
-            .memoir-page {
-                page-break-after: always;
-                margin: 0;
-                box-shadow: none;
-            }
-            
-            .memoir-page:last-child {
-                page-break-after: auto;
-            }
-            
-            .photo-frame {
-                box-shadow: none;
-                border: 1px solid #ddd;
-            }
-            
-            /* Убираем лишние тени для печати */
-            * {
-                -webkit-print-color-adjust: exact !important;
-                color-adjust: exact !important;
-            }
-        """)
-        
-        # Генерируем PDF
-        html_doc.write_pdf(str(output_path), stylesheets=[print_css])
-        print(f"✅ Красивый PDF создан с помощью WeasyPrint: {output_path}")
-        
-    except ImportError:
-        print("❌ WeasyPrint не установлен. Устанавливаю...")
-        import subprocess
-        import sys
-        
-        try:
-            # Пытаемся установить weasyprint
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "weasyprint"])
-            print("✅ WeasyPrint установлен успешно")
-            
-            # Повторяем попытку создания PDF
-            from weasyprint import HTML, CSS
-            html_doc = HTML(string=html_content)
-            print_css = CSS(string="""
-                @page {
-                    margin: 1.5cm;
-                    size: A4;
-                }
-                
-                body {
-                    margin: 0;
-                    padding: 0;
-                }
-                
-                .memoir-page {
-                    page-break-after: always;
-                    margin: 0;
-                    box-shadow: none;
-                }
-                
-                .memoir-page:last-child {
-                    page-break-after: auto;
-                }
-                
-                .photo-frame {
-                    box-shadow: none;
-                    border: 1px solid #ddd;
-                }
-                
-                * {
-                    -webkit-print-color-adjust: exact !important;
-                    color-adjust: exact !important;
-                }
-            """)
-            
-            html_doc.write_pdf(str(output_path), stylesheets=[print_css])
-            print(f"✅ Красивый PDF создан с помощью WeasyPrint: {output_path}")
-            
-        except Exception as install_error:
-            print(f"❌ Не удалось установить WeasyPrint: {install_error}")
-            # Fallback к простому PDF
-            create_simple_pdf_fallback(output_path)
-            
-    except Exception as e:
-        print(f"❌ Ошибка при создании PDF с WeasyPrint: {e}")
-        # Fallback к простому PDF
-        create_simple_pdf_fallback(output_path)
+        get_pdf_pool().render_sync(tmp_file, html_content=html_content, html_path=html_path)
+        os.replace(tmp_file, output_path)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    print(f"✅ Красивый PDF создан с помощью WeasyPrint: {output_path}")
 
 def create_simple_pdf_fallback(output_path: Path):
     """Простой fallback PDF если WeasyPrint недоступен."""
@@ -1777,8 +1372,6 @@ def format_chapter_text(text: str) -> str:
 
 # --- НОВЫЙ КОД ОТ БРАТА ---
 import re
-# Правильный импорт АСИНХРОННОГО клиента
-from app.services.llm_client import async_client, settings
 
 
 async def generate_text_pages(run_id: str, style: str,
@@ -1788,12 +1381,11 @@ async def generate_text_pages(run_id: str, style: str,
     Генерирует связный, личный рассказ для флипбука, анализируя профиль.
     """
     # 1. Загружаем и анализируем данные профиля
-    posts_json_path = Path("data") / run_id / "posts.json"
-    if not posts_json_path.exists():
-        raise ValueError(f"posts.json не найден для {run_id}")
+    run_dir = Path("data") / run_id
+    if not posts_store.has_items(run_dir):
+        raise ValueError(f"Данные профиля не найдены для {run_id}")
     
-    posts_data = json.loads(posts_json_path.read_text(encoding="utf-8"))
-    profile_analysis = analyze_profile_data(posts_data)
+    profile_analysis = analyze_profile_data(posts_store.iter_items(run_dir))
 
     full_name = profile_analysis.get('full_name') or profile_analysis.get('username') or "этого человека"
 
@@ -1842,16 +1434,14 @@ async def generate_text_pages(run_id: str, style: str,
     }
 
     # 3. Вызываем LLM с новым промптом
-    resp = await async_client.chat.completions.create(
-        model=settings.AZURE_OPENAI_GPT4_DEPLOYMENT, # gpt-4.1-mini используется под этим deployment name
-        messages=[
+    raw = await llm_gateway.complete_text(
+        [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": json.dumps(user_prompt_data, ensure_ascii=False)}
         ],
         temperature=0.7,
         max_tokens=4000, # Увеличим для более длинных текстов
     )
-    raw = resp.choices[0].message.content.strip()
 
     # 4. Парсим JSON с фолбэком на regex
     try:
@@ -1885,13 +1475,9 @@ def build_fantasy_book(run_id: str, images: list[Path], texts: str, book_format:
     """Создание HTML фэнтези-книги"""
     try:
         run_dir = Path("data") / run_id
-        posts_json = run_dir / "posts.json"
         images_dir = run_dir / "images"
 
-        if posts_json.exists():
-            posts_data = json.loads(posts_json.read_text(encoding="utf-8"))
-        else:
-            posts_data = []
+        posts_data = posts_store.iter_items(run_dir)  # ленивый итератор по posts.ndjson
 
         analysis = analyze_profile_data(posts_data)
         username = analysis.get("username", "...")
@@ -1902,25 +1488,23 @@ def build_fantasy_book(run_id: str, images: list[Path], texts: str, book_format:
                 if img_file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
                     actual_images.append(img_file)
 
+        out = Path("data") / run_id
+        out.mkdir(parents=True, exist_ok=True)
+        html_file = out / "book.html"
+
         # Если формат classic — используем новую функцию с 10 главами
         if book_format == "classic":
             from app.styles.fantasy import generate_classic_fantasy_book
-            html = generate_classic_fantasy_book(run_id, actual_images, texts, user_id)
+            generate_classic_fantasy_book(run_id, actual_images, texts, user_id)
         else:
             # Старый вариант (5 глав)
             content = {"format": "fantasy"}
-            html = create_fantasy_instagram_book_html(content, analysis, actual_images)
-
-        out = Path("data") / run_id
-        out.mkdir(parents=True, exist_ok=True)
-
-        html_file = out / "book.html"
-        html_file.write_text(html, encoding="utf-8")
+            create_fantasy_instagram_book_html(content, analysis, actual_images, html_file)
 
         # Генерируем PDF версию
         try:
             pdf_file = out / "book.pdf"
-            create_pdf_with_weasyprint(pdf_file, html)
+            create_pdf_with_weasyprint(pdf_file, html_path=html_file)
             print(f"📄 Фэнтези PDF версия создана: {pdf_file}")
         except Exception as pdf_error:
             print(f"❌ Ошибка создания PDF: {pdf_error}")
@@ -1955,7 +1539,7 @@ def build_fantasy_book(run_id: str, images: list[Path], texts: str, book_format:
                         source_dir = Path("data") / run_id
                         user_library_dir = Path("data") / "user_books" / user_id / book_id
                         user_library_dir.mkdir(parents=True, exist_ok=True)
-                        for file in ["book.html", "book.pdf", "posts.json"]:
+                        for file in ["book.html", "book.json", "book.pdf", "posts.ndjson", "posts.json"]:
                             source_file = source_dir / file
                             if source_file.exists():
                                 shutil.copy2(source_file, user_library_dir / file)
@@ -2029,8 +1613,8 @@ def build_fantasy_book(run_id: str, images: list[Path], texts: str, book_format:
         except Exception as final_error:
             print(f"Критическая ошибка: {final_error}")
 
-def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: list[Path]) -> str:
-    """Создает HTML фэнтези-книгу в стиле возвышенной личной фантастики, как в примере пользователя."""
+def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: list[Path], output_path: Path) -> Path:
+    """Создает HTML фэнтези-книгу в стиле возвышенной личной фантастики, как в примере пользователя, сохраняет её документ (book.json) и пишет HTML в output_path."""
     import random, time
     from app.services.llm_client import strip_cliches
     full_name = analysis.get('full_name', analysis.get('username', 'герой древних хроник'))
@@ -2045,20 +1629,8 @@ def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: li
     selected_photo_data = []
     detected_gender = "unknown"
     if images:
-        total_images = len(images)
-        if total_images >= 10:
-            selected_indices = random.sample(range(total_images), 10)
-            selected_indices.sort()
-        elif total_images >= 5:
-            selected_indices = list(range(total_images))
-            while len(selected_indices) < 10:
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
-        else:
-            selected_indices = []
-            for _ in range(10):
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
+        # До 10 лучших различных фото (см. app/services/photo_selection.py)
+        selected_indices = select_best(images, 10)
         for i, idx in enumerate(selected_indices):
             img_path = images[idx]
             if img_path.exists():
@@ -2066,7 +1638,7 @@ def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: li
                     from PIL import Image, ImageEnhance
                     from io import BytesIO
                     import base64
-                    with Image.open(img_path) as img:
+                    with Image.open(derivative_path(img_path, "web")) as img:
                         if img.mode != 'RGB':
                             img = img.convert('RGB')
                         max_size = (700, 500)
@@ -2075,10 +1647,8 @@ def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: li
                         img = enhancer.enhance(1.05)
                         enhancer = ImageEnhance.Color(img)
                         img = enhancer.enhance(1.1)
-                        buffer = BytesIO()
-                        img.save(buffer, format='JPEG', quality=90)
-                        img_str = base64.b64encode(buffer.getvalue()).decode()
-                        processed_images.append(f"data:image/jpeg;base64,{img_str}")
+                        img_url = assets.store_image(img_path.parent.parent, img, quality=90)
+                        processed_images.append(img_url)
                         fallback_descriptions = [
                             "Взгляд, в котором отражается древняя магия",
                             "Аура героя, сияющая сквозь века",
@@ -2094,7 +1664,7 @@ def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: li
                         selected_photo_data.append({
                             'index': idx + 1,
                             'analysis': fallback_descriptions[i % len(fallback_descriptions)],
-                            'image': f"data:image/jpeg;base64,{img_str}"
+                            'image': img_url
                         })
                 except Exception as e:
                     print(f"❌ Ошибка обработки изображения {img_path}: {e}")
@@ -2130,313 +1700,40 @@ def create_fantasy_instagram_book_html(content: dict, analysis: dict, images: li
         chapters = {c['key']: '' for c in chapter_configs}
         final_page_content = "Пусть твоя сага будет вечной, а имя — вписано в Книгу Героев!"
         book_title = f"Хроники {full_name}"
-   # ЗАМЕНИТЕ ВСЮ ЧАСТЬ ГЕНЕРАЦИИ HTML НА ЭТУ:
-
-    # HTML в стиле фэнтези
-    html = f"""<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{book_title}</title>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Cinzel:wght@400;700&family=Crimson+Text:ital,wght@0,400;0,700;1,400&display=swap" rel="stylesheet">
-    <style>
-    :root {{
-        --accent-color: #222;
-        --background-color: #fff;
-        --text-color: #222;
-        --font-body: 'Crimson Text', serif;
-        --font-caption: 'Cinzel', serif;
-    }}
-    @page {{
-        size: A5 portrait;
-        margin: 2.5cm;
-        @bottom-center {{
-            content: counter(page);
-            font-family: 'Cinzel', serif;
-            font-size: 14pt;
-            color: #555;
-            border-top: 1px solid #ddd;
-            padding-top: 0.25cm;
-            width: 100%;
-        }}
-    }}
-    body {{
-        font-family: var(--font-body);
-        background-color: var(--background-color) !important;
-        color: var(--text-color);
-        line-height: 1.6;
-        font-size: 20pt;
-        margin: 0;
-        counter-reset: page;
-    }}
-    .book-page {{
-        page-break-after: always;
-        position: relative;
-        overflow: hidden;
-        background-color: var(--background-color) !important;
-        box-shadow: none;
-    }}
-    .book-page:last-of-type {{
-        page-break-after: auto;
-    }}
-    .cover-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        height: 100vh;
-        text-align: center;
-    }}
-    .cover-title {{
-        font-family: 'Cinzel', serif;
-        font-size: 40pt;
-        font-weight: 700;
-        margin: 0;
-    }}
-    .cover-subtitle {{
-        font-family: 'Cinzel', serif;
-        font-style: italic;
-        font-size: 20pt;
-        margin: 1rem 0 3rem 0;
-    }}
-    .cover-content {{
-        border: none;
-        padding: 2rem 3rem;
-    }}
-    .cover-separator {{
-        width: 80px;
-        height: 1px;
-        background: #222;
-        margin: 0 auto 1.5rem;
-    }}
-    .cover-dedication {{
-        font-family: 'Crimson Text', serif;
-        font-style: italic;
-        font-size: 12pt;
-    }}
-    .toc-title {{
-        font-size: 28pt;
-        font-weight: bold;
-        text-transform: uppercase;
-        text-align: center;
-        margin-top: 1cm;
-        margin-bottom: 2cm;
-        color: var(--accent-color);
-    }}
-    .toc-list {{
-        list-style: none;
-        padding: 0;
-        font-size: 16pt;
-        font-family: 'Cinzel', serif;
-    }}
-    .toc-item {{
-        display: flex;
-        margin-bottom: 0.5rem;
-        align-items: baseline;
-    }}
-    .toc-item .chapter-name {{
-        order: 1;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-    .toc-item .leader {{
-        flex-grow: 0;
-        border-bottom: none;
-        margin: 0;
-        position: static;
-    }}
-    .toc-item .page-ref {{
-        order: 3;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-    .chapter-page {{
-        padding: 0;
-    }}
-    .chapter-main-title {{
-        font-family: var(--font-body);
-        font-weight: bold;
-        font-size: 24pt;
-        text-align: center;
-        text-transform: uppercase;
-        color: var(--accent-color);
-        margin: 1cm 0;
-        line-height: 1.2;
-        overflow-wrap: break-word;
-        hyphens: auto;
-    }}
-    .chapter-subtitle {{
-        font-family: var(--font-body);
-        font-style: italic;
-        font-size: 14pt;
-        text-align: left;
-        margin: 0 0 1rem 0;
-    }}
-    .chapter-image-container {{
-        text-align: center;
-        margin: 1cm 0;
-        page-break-inside: avoid;
-    }}
-    .chapter-image {{
-        max-width: 90%;
-        border: none;
-        padding: 0.5cm;
-    }}
-    .chapter-image-caption {{
-        font-family: var(--font-caption);
-        font-style: italic;
-        font-size: 12pt;
-        margin-top: 0.5rem;
-        color: var(--accent-color);
-    }}
-    .chapter-body p {{
-        font-size: 20pt;
-        line-height: 1.6;
-        margin-bottom: 1em;
-    }}
-    .chapter-body p:first-of-type::first-letter {{
-        initial-letter: 2;
-        font-weight: bold;
-        padding-right: 0.2em;
-        color: #555;
-    }}
-    .final-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        text-align: center;
-    }}
-    .final-content {{
-        font-family: 'Playfair Display', serif;
-        font-style: italic;
-        font-size: 20pt;
-        line-height: 1.7;
-        max-width: 80%;
-    }}
-    .final-ornament {{
-        font-size: 28pt;
-        color: var(--accent-color);
-        margin: 2rem 0;
-        font-family: serif;
-    }}
-    .final-signature {{
-        margin-top: 1rem;
-        font-size: 14pt;
-        font-style: normal;
-    }}
-    @media screen {{
-        body {{ font-size: 12px; }}
-        .book-page {{ width: 148mm; min-height: 210mm; margin: 2rem auto; padding: 2.5cm; box-sizing: border-box; height: auto; }}
-        .cover-page {{ height: 210mm; position: relative; }}
-        .chapter-body p {{ font-size: 12pt; }}
-        .chapter-body p:first-of-type::first-letter {{ font-size: 28pt; }}
-        .cover-title {{ font-size: 24pt; }}
-        .cover-subtitle {{ font-size: 14pt; }}
-        .toc-title {{ font-size: 18pt; }}
-        .toc-list {{ font-size: 12pt; }}
-        .chapter-main-title {{ font-size: 16pt; }}
-        .chapter-subtitle {{ font-size: 10pt; }}
-        .final-content {{ font-size: 12pt; }}
-        .final-signature {{ font-size: 10pt; }}
-    }}
-    @media (max-width: 428px) {{
-        .book-page {{            
-            padding: 1cm; /* Увеличенные отступы для веб-просмотра */
-        }}
-    }}
-    </style>
-</head>
-<body>
-<!-- Cover Page -->
-<div class="book-page cover-page">
-    <div class="cover-content">
-        <h1 class="cover-title">{full_name.upper()}</h1>
-        <p class="cover-subtitle">Фантастическая история личности</p>
-        <div class="cover-separator"></div>
-        <p class="cover-dedication">A tale of inner power and destiny</p>
-    </div>
-</div>
-<!-- Table of Contents -->
-<div class="book-page toc-page">
-    <h2 class="toc-title">Содержание</h2>
-    <ul class="toc-list">
-        {"".join([f'''
-            <li class="toc-item">
-                <a href="#chapter-{config['key']}" class="chapter-name">Глава {i+1} – {config['title']}</a>
-                <span class="leader"></span>
-                <a href="#chapter-{config['key']}" class="page-ref"></a>
-            </li>
-        ''' for i, config in enumerate(chapter_configs)])}
-    </ul>
-</div>
-<!-- Chapter Pages -->"""
-
-    # Генерируем главы отдельно, чтобы избежать проблем с вложенными f-строками
+    # Главы документа книги: текст и фото с подписью (если хватило фото)
+    book_chapters = []
     for i, config in enumerate(chapter_configs):
-        # Получаем данные безопасно
-        chapter_key = config['key']
-        chapter_title = config['title']
-        
-        # Генерируем HTML для изображения
-        image_html = ""
+        chapter = BookChapter(
+            key=config['key'],
+            title=config['title'],
+            text=chapters.get(config['key'], f"<p>{config['title']} о {full_name} — это всегда повод для улыбки!</p>"),
+        )
         if i < len(selected_photo_data):
             photo_data = selected_photo_data[i]
-            analysis_text = photo_data['analysis']
-            if len(analysis_text) > 80:
-                analysis_text = analysis_text[:80] + '...'
-            
-            image_html = f"""
-    <div class="chapter-image-container">
-        <img src="{photo_data['image']}" alt="Photo for Chapter {i+1}" class="chapter-image">
-        <p class="chapter-image-caption">{analysis_text}</p>
-    </div>"""
-
-        # Получаем контент главы
-        chapter_content = chapters.get(chapter_key, f'<p>{chapter_title} о {full_name} — это всегда повод для улыбки!</p>')
-
-        # Добавляем главу к HTML
-        html += f"""
-<div id="chapter-{chapter_key}" class="book-page chapter-page">
-    <h3 class="chapter-subtitle">{chapter_title}</h3>
-    <h2 class="chapter-main-title">{chapter_title}</h2>
-    {image_html}
-    <div class="chapter-body">
-        {chapter_content}
-    </div>
-</div>"""
-    # Добавляем финальную страницу
-    html += f'''
-<!-- Final Page -->
-<div class="book-page final-page">
-    <div class="final-content">
-        <p>{final_page_content.replace(chr(10), '<br>')}</p>
-    </div>
-    <div class="final-ornament">
-        ✦
-    </div>
-    <div class="final-signature">
-        <p>Пусть твоя история вдохновляет других.</p>
-    </div>
-</div>
-</body>
-</html>'''
-    
-    return html
+            note = photo_data['analysis']
+            chapter.image = photo_data['image']
+            chapter.image_note = note
+            chapter.caption = note[:80] + '...' if len(note) > 80 else note
+        book_chapters.append(chapter)
+
+    # HTML в стиле фэнтези — документ book.json и шаблон app/templates/books/fantasy_classic.html
+    doc = BookDocument(
+        style="fantasy",
+        format="classic",
+        template="books/fantasy_classic.html",
+        title=book_title,
+        full_name=full_name,
+        chapters=book_chapters,
+        final_message=final_page_content,
+    )
+    return book_document.write(doc, output_path)
 
 def build_humor_book(run_id: str, images: list[Path], texts: str, book_format: str = "classic", user_id: str = None):
     """Создание HTML юмористической книги"""
     try:
         run_dir = Path("data") / run_id
-        posts_json = run_dir / "posts.json"
         images_dir = run_dir / "images"
-        if posts_json.exists():
-            posts_data = json.loads(posts_json.read_text(encoding="utf-8"))
-        else:
-            posts_data = []
+        posts_data = posts_store.iter_items(run_dir)  # ленивый итератор по posts.ndjson
         analysis = analyze_profile_data(posts_data)
         username = analysis.get("username", "...")
         actual_images = []
@@ -2444,9 +1741,12 @@ def build_humor_book(run_id: str, images: list[Path], texts: str, book_format: s
             for img_file in sorted(images_dir.glob("*")):
                 if img_file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
                     actual_images.append(img_file)
+        out = Path("data") / run_id
+        out.mkdir(parents=True, exist_ok=True)
+        html_file = out / "book.html"
         # Если формат classic — используем новую функцию
         if book_format == "classic":
-            html = create_classic_humor_book_html({}, analysis, actual_images)
+            create_classic_humor_book_html({}, analysis, actual_images, html_file)
         else:
             # Юмористические сообщения о процессе анализа
             humor_analysis_messages = [
@@ -2467,15 +1767,11 @@ def build_humor_book(run_id: str, images: list[Path], texts: str, book_format: s
             print(random.choice(humor_photo_messages))
             from app.styles.humor import generate_humor_chapters, create_humor_html
             chapters = generate_humor_chapters(analysis, actual_images)
-            html = create_humor_html(analysis, chapters, actual_images)
-        out = Path("data") / run_id
-        out.mkdir(parents=True, exist_ok=True)
-        html_file = out / "book.html"
-        html_file.write_text(html, encoding="utf-8")
+            create_humor_html(analysis, chapters, actual_images, html_file)
         # Генерируем PDF версию
         try:
             pdf_file = out / "book.pdf"
-            create_pdf_with_weasyprint(pdf_file, html)
+            create_pdf_with_weasyprint(pdf_file, html_path=html_file)
             print(f"📄 Юмористическая PDF версия создана: {pdf_file}")
         except Exception as pdf_error:
             print(f"❌ Ошибка создания PDF: {pdf_error}")
@@ -2509,7 +1805,7 @@ def build_humor_book(run_id: str, images: list[Path], texts: str, book_format: s
                         source_dir = Path("data") / run_id
                         user_library_dir = Path("data") / "user_books" / user_id / book_id
                         user_library_dir.mkdir(parents=True, exist_ok=True)
-                        for file in ["book.html", "book.pdf", "posts.json"]:
+                        for file in ["book.html", "book.json", "book.pdf", "posts.ndjson", "posts.json"]:
                             source_file = source_dir / file
                             if source_file.exists():
                                 shutil.copy2(source_file, user_library_dir / file)
@@ -2583,8 +1879,8 @@ def build_humor_book(run_id: str, images: list[Path], texts: str, book_format: s
         except Exception as final_error:
             print(f"Критическая ошибка: {final_error}")
 
-def create_classic_humor_book_html(content: dict, analysis: dict, images: list[Path]) -> str:
-    """Создает HTML классической юмористической книги с 10 главами и эпилогом"""
+def create_classic_humor_book_html(content: dict, analysis: dict, images: list[Path], output_path: Path) -> Path:
+    """Создает HTML классической юмористической книги с 10 главами и эпилогом, сохраняет её документ (book.json) и пишет HTML в output_path"""
     import random
     from app.services.llm_client import generate_memoir_chapter, strip_cliches
     full_name = analysis.get('full_name', analysis.get('username', 'герой комедии'))
@@ -2599,20 +1895,8 @@ def create_classic_humor_book_html(content: dict, analysis: dict, images: list[P
     selected_photo_data = []
     detected_gender = "unknown"
     if images:
-        total_images = len(images)
-        if total_images >= 10:
-            selected_indices = random.sample(range(total_images), 10)
-            selected_indices.sort()
-        elif total_images >= 5:
-            selected_indices = list(range(total_images))
-            while len(selected_indices) < 10:
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
-        else:
-            selected_indices = []
-            for _ in range(10):
-                random_idx = random.randint(0, total_images - 1)
-                selected_indices.append(random_idx)
+        # До 10 лучших различных фото (см. app/services/photo_selection.py)
+        selected_indices = select_best(images, 10)
         for i, idx in enumerate(selected_indices):
             img_path = images[idx]
             if img_path.exists():
@@ -2620,7 +1904,7 @@ def create_classic_humor_book_html(content: dict, analysis: dict, images: list[P
                     from PIL import Image, ImageEnhance
                     from io import BytesIO
                     import base64
-                    with Image.open(img_path) as img:
+                    with Image.open(derivative_path(img_path, "web")) as img:
                         if img.mode != 'RGB':
                             img = img.convert('RGB')
                         max_size = (700, 500)
@@ -2629,10 +1913,8 @@ def create_classic_humor_book_html(content: dict, analysis: dict, images: list[P
                         img = enhancer.enhance(1.05)
                         enhancer = ImageEnhance.Color(img)
                         img = enhancer.enhance(1.1)
-                        buffer = BytesIO()
-                        img.save(buffer, format='JPEG', quality=90)
-                        img_str = base64.b64encode(buffer.getvalue()).decode()
-                        processed_images.append(f"data:image/jpeg;base64,{img_str}")
+                        img_url = assets.store_image(img_path.parent.parent, img, quality=90)
+                        processed_images.append(img_url)
                         fallback_descriptions = [
                             "На этом фото ты выглядишь как победитель конкурса на самую смешную улыбку!",
                             "Взгляд, который может рассмешить даже будильник.",
@@ -2648,7 +1930,7 @@ def create_classic_humor_book_html(content: dict, analysis: dict, images: list[P
                         selected_photo_data.append({
                             'index': idx + 1,
                             'analysis': fallback_descriptions[i % len(fallback_descriptions)],
-                            'image': f"data:image/jpeg;base64,{img_str}"
+                            'image': img_url
                         })
                 except Exception as e:
                     print(f"❌ Ошибка обработки изображения {img_path}: {e}")
@@ -2690,290 +1972,29 @@ def create_classic_humor_book_html(content: dict, analysis: dict, images: list[P
             print(f"❌ Ошибка генерации главы '{config['title']}': {e}")
             chapters[config['key']] = f"{config['title']} о {full_name} — это всегда повод для улыбки!"
     book_title = f"Весёлые истории о {full_name}"
-   # HTML в стиле юмористической книги
-    html = f"""<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{book_title}</title>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Playfair+Display:ital,wght@0,400;0,700;1,400;1,700&family=Open+Sans:ital,wght@0,400;0,700;1,400&display=swap" rel="stylesheet">
-    <style>
-    :root {{
-        --accent-color: #222;
-        --background-color: #fff;
-        --text-color: #222;
-        --font-body: 'Playfair Display', serif;
-        --font-caption: 'Open Sans', sans-serif;
-    }}
-    body {{
-        font-family: var(--font-body);
-        background-color: var(--background-color) !important;
-        color: var(--text-color);
-        line-height: 1.6;
-        font-size: 20pt;
-        margin: 0;
-    }}
-    .book-page {{
-        page-break-after: always;
-        position: relative;
-        overflow: hidden;
-        background-color: var(--background-color) !important;
-        box-shadow: none;
-    }}
-    .book-page:last-of-type {{
-        page-break-after: auto;
-    }}
-    .cover-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        height: 100vh;
-        text-align: center;
-    }}
-    .cover-title {{
-        font-family: 'Playfair Display', serif;
-        font-size: 48pt;
-        font-weight: 700;
-        margin: 0;
-    }}
-    .cover-subtitle {{
-        font-family: 'Playfair Display', serif;
-        font-style: italic;
-        font-size: 24pt;
-        margin: 1rem 0 3rem 0;
-    }}
-    .cover-content {{
-        border: 2px solid #222;
-        padding: 2rem 3rem;
-    }}
-    .cover-separator {{
-        width: 80px;
-        height: 1px;
-        background: #222;
-        margin: 0 auto 1.5rem;
-    }}
-    .cover-dedication {{
-        font-family: 'Open Sans', sans-serif;
-        font-style: italic;
-        font-size: 14pt;
-    }}
-    .toc-title {{
-        font-size: 36pt;
-        font-weight: bold;
-        text-transform: uppercase;
-        text-align: center;
-        margin-top: 1cm;
-        margin-bottom: 2cm;
-        color: var(--accent-color);
-    }}
-    .toc-list {{
-        list-style: none;
-        padding: 0;
-        font-size: 20pt;
-        font-family: 'Playfair Display', serif;
-    }}
-    .toc-item {{
-        display: flex;
-        margin-bottom: 0.5rem;
-        align-items: baseline;
-    }}
-    .toc-item .chapter-name {{
-        order: 1;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-    .toc-item .leader {{
-        flex-grow: 0;
-        border-bottom: none;
-        margin: 0;
-        position: static;
-    }}
-    .toc-item .page-ref {{
-        order: 3;
-        text-decoration: none;
-        color: var(--text-color);
-    }}
-    .chapter-page {{
-        padding: 0;
-    }}
-    .chapter-main-title {{
-        font-family: var(--font-body);
-        font-weight: bold;
-        font-size: 24pt;
-        text-align: center;
-        text-transform: uppercase;
-        color: var(--accent-color);
-        margin: 1cm 0;
-        line-height: 1.2;
-        overflow-wrap: break-word;
-        hyphens: auto;
-    }}
-    .chapter-subtitle {{
-        font-family: var(--font-body);
-        font-style: italic;
-        font-size: 14pt;
-        text-align: left;
-        margin: 0 0 1rem 0;
-    }}
-    .chapter-image-container {{
-        text-align: center;
-        margin: 1cm 0;
-        page-break-inside: avoid;
-    }}
-    .chapter-image {{
-        max-width: 90%;
-        border: 1px solid #ddd;
-        padding: 0.5cm;
-    }}
-    .chapter-image-caption {{
-        font-family: var(--font-caption);
-        font-style: italic;
-        font-size: 14pt;
-        margin-top: 0.5rem;
-        color: var(--accent-color);
-    }}
-    .chapter-body p {{
-        font-size: 20pt;
-        line-height: 1.6;
-        margin-bottom: 1em;
-    }}
-    .chapter-body p:first-of-type::first-letter {{
-        initial-letter: 2;
-        font-weight: bold;
-        padding-right: 0.2em;
-        color: #555;
-    }}
-    .final-page {{
-        display: flex;
-        flex-direction: column;
-        justify-content: center;
-        align-items: center;
-        text-align: center;
-    }}
-    .final-content {{
-        font-family: 'Playfair Display', serif;
-        font-style: italic;
-        font-size: 20pt;
-        line-height: 1.7;
-        max-width: 80%;
-    }}
-    .final-ornament {{
-        font-size: 28pt;
-        color: var(--accent-color);
-        margin: 2rem 0;
-        font-family: serif;
-    }}
-    .final-signature {{
-        margin-top: 1rem;
-        font-size: 14pt;
-        font-style: normal;
-    }}
-    @media screen {{
-        body {{ font-size: 12px; }}
-        .book-page {{ width: 148mm; min-height: 210mm; margin: 2rem auto; padding: 2.5cm; box-sizing: border-box; height: auto; }}
-        .cover-page {{ height: 210mm; position: relative; }}
-        .chapter-body p {{ font-size: 12pt; }}
-        .chapter-body p:first-of-type::first-letter {{ font-size: 28pt; }}
-        .cover-title {{ font-size: 24pt; }}
-        .cover-subtitle {{ font-size: 14pt; }}
-        .toc-title {{ font-size: 18pt; }}
-        .toc-list {{ font-size: 12pt; }}
-        .chapter-main-title {{ font-size: 16pt; }}
-        .chapter-subtitle {{ font-size: 10pt; }}
-        .final-content {{ font-size: 12pt; }}
-        .final-signature {{ font-size: 10pt; }}
-    }}
-    @media (max-width: 428px) {{
-        .book-page {{            
-            padding: 1cm; /* Увеличенные отступы для веб-просмотра */
-        }}
-    }}
-    </style>
-</head>
-<body>
-<!-- Cover Page -->
-<div class="book-page cover-page">
-    <div class="cover-content">
-        <h1 class="cover-title">{full_name.upper()}</h1>
-        <p class="cover-subtitle">Весёлые истории</p>
-        <div class="cover-separator"></div>
-        <p class="cover-dedication">Юмористическая биография с улыбкой</p>
-    </div>
-</div>
-<!-- Table of Contents -->
-<div class="book-page toc-page">
-    <h2 class="toc-title">Содержание</h2>
-    <ul class="toc-list">"""
-
-    # Генерируем оглавление
-    for config in chapter_configs:
-        chapter_key = config['key']
-        chapter_title = config['title']
-        html += f"""
-        <li class="toc-item">
-            <a href="#chapter-{chapter_key}" class="chapter-name">{chapter_title}</a>
-            <span class="leader"></span>
-            <a href="#chapter-{chapter_key}" class="page-ref"></a>
-        </li>"""
-
-    html += """
-    </ul>
-</div>
-<!-- Chapter Pages -->"""
-
-    # Генерируем главы отдельно для юмористической книги
+    # Главы документа книги: текст и фото с подписью (если хватило фото)
+    book_chapters = []
     for i, config in enumerate(chapter_configs):
-        # Получаем данные безопасно
-        chapter_key = config['key']
-        chapter_title = config['title']
-        
-        # Генерируем HTML для изображения
-        image_html = ""
+        chapter = BookChapter(
+            key=config['key'],
+            title=config['title'],
+            text=chapters.get(config['key'], f"<p>{config['title']} о {full_name} — это всегда повод для улыбки!</p>"),
+        )
         if i < len(selected_photo_data):
             photo_data = selected_photo_data[i]
-            analysis_text = photo_data['analysis']
-            if len(analysis_text) > 80:
-                analysis_text = analysis_text[:80] + '...'
-            
-            image_html = f"""
-    <div class="chapter-image-container">
-        <img src="{photo_data['image']}" alt="Photo for Chapter {i+1}" class="chapter-image">
-        <p class="chapter-image-caption">{analysis_text}</p>
-    </div>"""
-
-        # Получаем контент главы
-        chapter_content = chapters.get(chapter_key, f'<p>{chapter_title} о {full_name} — это всегда повод для улыбки!</p>')
-
-        # Добавляем главу к HTML
-        html += f"""
-<div id="chapter-{chapter_key}" class="book-page chapter-page">
-    <h3 class="chapter-subtitle">{chapter_title}</h3>
-    <h2 class="chapter-main-title">{chapter_title}</h2>
-    {image_html}
-    <div class="chapter-body">
-        {chapter_content}
-    </div>
-</div>"""
-
-    # Добавляем финальную страницу
-    html += f"""
-<!-- Final Page -->
-<div class="book-page final-page">
-    <div class="final-content">
-        <p>Спасибо, что дочитали до конца! Не забывайте улыбаться и делиться хорошим настроением с окружающими. 😄</p>
-    </div>
-    <div class="final-ornament">
-        ✦
-    </div>
-    <div class="final-signature">
-        <p>Создано с улыбкой в Mythic</p>
-    </div>
-</div>
-</body>
-</html>"""
-    
-    return html
\ No newline at end of file
+            note = photo_data['analysis']
+            chapter.image = photo_data['image']
+            chapter.image_note = note
+            chapter.caption = note[:80] + '...' if len(note) > 80 else note
+        book_chapters.append(chapter)
+
+    # HTML в стиле юмористической книги — документ book.json и шаблон app/templates/books/humor_classic.html
+    doc = BookDocument(
+        style="humor",
+        format="classic",
+        template="books/humor_classic.html",
+        title=book_title,
+        full_name=full_name,
+        chapters=book_chapters,
+    )
+    return book_document.write(doc, output_path)
\ No newline at end of file
@@ -0,0 +1,153 @@
+# app/services/book_convert.py
+"""Смена формата готовой книги (классика ⇄ флипбук) без повторной генерации.
+
+Раньше /create-flipbook для run_id с готовой классической книгой запускал
+полную сборку: book.html удалялся, а generate_flipbook_data делал отдельный
+запрос к LLM на 4000 токенов (и наоборот). Теперь run_full_build сначала
+проверяет convertible() и, если можно, вызывает convert():
+  ▸ главы, фото и анализы фото берутся из документа книги (book.json,
+    app/services/book_document.py) — текст глав не генерируется заново;
+  ▸ недостающее (короткие подписи к фото для флипбука, финальное послание
+    для классики) дописывается одним небольшим запросом к LLM; без LLM —
+    подписи из анализа фото и стандартное послание стиля;
+  ▸ вёрстка — шаблоном нужного формата, как при обычной сборке.
+Конвертация выполняется, только если документ того же стиля: смена стиля —
+это новая книга.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import re
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app.services import book_document
+from app.services.book_document import BookChapter, BookDocument
+from app.services.llm_gateway import llm_gateway
+
+log = logging.getLogger("book_convert")
+
+# Шаблон классической книги по стилю
+CLASSIC_TEMPLATES = {
+    "romantic": "books/romantic_classic.html",
+    "fantasy": "books/fantasy_classic.html",
+    "humor": "books/humor_classic.html",
+}
+# Финальное послание классики, если LLM не ответил
+FINAL_FALLBACKS = {
+    "romantic": "С бесконечным восхищением и благодарностью. Ты — особенный человек. Спасибо тебе за всё.",
+    "fantasy": "Пусть твоя сага будет вечной, а имя — вписано в Книгу Героев!",
+    "humor": "Спасибо, что дочитали до конца! Не забывайте улыбаться.",
+}
+# Подпись к фото во флипбуке — короткая строка, а не абзац анализа
+CAPTION_MAX_WORDS = 15
+EXCERPT_CHARS = 400
+
+_TAGS = re.compile(r"<[^>]+>")
+
+
+def _plain(html: str) -> str:
+    return " ".join(_TAGS.sub(" ", html or "").split())
+
+
+def _short(text: str, words: int = CAPTION_MAX_WORDS) -> str:
+    parts = _plain(text).rstrip(".…").split()
+    return " ".join(parts[:words]) + ("…" if len(parts) > words else "")
+
+
+def _needs_caption(chapter: BookChapter) -> bool:
+    caption = chapter.caption.strip()
+    return bool(chapter.image) and (not caption or caption.endswith("...")
+                                    or len(caption.split()) > CAPTION_MAX_WORDS)
+
+
+# ─────────────── дописывание недостающего ──────────────────────────────────
+async def _complete_missing(doc: BookDocument, caption_for: List[BookChapter],
+                            need_final: bool) -> Dict[str, object]:
+    """Один короткий запрос к LLM: {"captions": {key: подпись}, "final_message": str}."""
+    if not caption_for and not need_final:
+        return {}
+    tasks = []
+    if caption_for:
+        tasks.append(f"Для каждой главы ниже — подпись под фото ({CAPTION_MAX_WORDS} слов максимум): "
+                     "образно, в тон главы, без кавычек. Ключ — key главы.")
+    if need_final:
+        tasks.append("Финальное послание книги — 1–2 предложения, обращение к герою на «ты».")
+    chapters = [{"key": c.key, "title": _plain(c.title), "photo": c.image_note or c.caption,
+                 "excerpt": _plain(c.text)[:EXCERPT_CHARS]} for c in caption_for or doc.chapters[-2:]]
+    messages = [
+        {"role": "system", "content": (
+            f"Ты редактор готовой книги в стиле «{doc.style}» о {doc.full_name or 'герое'}. "
+            "Текст глав уже написан — нужно дописать только недостающие мелочи. "
+            'Ответ — JSON: {"captions": {"<key>": "..."}, "final_message": "..."}.')},
+        {"role": "user", "content": "\n".join(tasks) + "\n\nГлавы:\n"
+                                    + json.dumps(chapters, ensure_ascii=False)},
+    ]
+    try:
+        raw = await llm_gateway.complete_text(
+            messages,
+            temperature=0.7,
+            max_tokens=settings.BOOK_CONVERT_MAX_TOKENS,
+            response_format={"type": "json_object"},
+        )
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {}
+    except Exception as e:
+        log.warning("book convert: недостающее не дописано (%s), беру запасные тексты", e)
+        return {}
+
+
+# ─────────────── классика → флипбук и обратно ──────────────────────────────
+async def _to_flipbook(doc: BookDocument) -> BookDocument:
+    from app.services.flipbook_builder import flipbook_layout
+
+    template, labels = flipbook_layout(doc.style)
+    labels.pop("book_title")
+    missing = [c for c in doc.chapters if _needs_caption(c)]
+    captions = (await _complete_missing(doc, missing, need_final=False)).get("captions") or {}
+    chapters = []
+    for chapter in doc.chapters:
+        if _needs_caption(chapter):
+            caption = captions.get(chapter.key) if isinstance(captions, dict) else None
+            caption = _short(caption) if isinstance(caption, str) and caption.strip() else \
+                _short(chapter.image_note or chapter.caption)
+            chapter = replace(chapter, caption=caption)
+        chapters.append(chapter)
+    print(f"🔁 Флипбук из готовой книги: {len(chapters)} глав, новых подписей к фото: {len(missing)}")
+    return replace(doc, format="flipbook", template=template, chapters=chapters, labels=labels)
+
+
+async def _to_classic(doc: BookDocument) -> BookDocument:
+    # Заголовки флипбука — markdown «## …», превращённый в <h2>
+    chapters = [replace(c, title=_plain(c.title)) for c in doc.chapters]
+    final_message = doc.final_message
+    if not final_message and doc.style != "humor":  # юмор-шаблон послание не показывает
+        final_message = (await _complete_missing(doc, [], need_final=True)).get("final_message")
+        if not isinstance(final_message, str) or not final_message.strip():
+            final_message = FINAL_FALLBACKS.get(doc.style, FINAL_FALLBACKS["romantic"])
+    print(f"🔁 Классическая книга из флипбука: {len(chapters)} глав")
+    return replace(doc, format="classic", template=CLASSIC_TEMPLATES.get(doc.style, CLASSIC_TEMPLATES["romantic"]),
+                   chapters=chapters, final_message=final_message.strip(), labels={})
+
+
+def convertible(run_id: str, style: str, target_format: str) -> Optional[BookDocument]:
+    """Документ книги, из которого можно собрать target_format, или None —
+    нужна обычная сборка (нет документа, другой стиль, тот же формат)."""
+    if not settings.BOOK_CONVERT_ENABLED or target_format not in ("classic", "flipbook"):
+        return None
+    doc = book_document.load(Path("data") / run_id)
+    if doc is None or not doc.chapters or doc.style != style or doc.format == target_format:
+        return None
+    return doc
+
+
+async def convert(run_id: str, doc: BookDocument, target_format: str) -> BookDocument:
+    """Пересобирает книгу run_id в target_format из её документа (см. convertible)."""
+    converted = await (_to_flipbook(doc) if target_format == "flipbook" else _to_classic(doc))
+    await asyncio.to_thread(book_document.write, converted, Path("data") / run_id / "book.html")
+    log.info("book %s converted %s → %s without regeneration", run_id, doc.format, target_format)
+    return converted
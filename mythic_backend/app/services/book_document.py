@@ -0,0 +1,212 @@
+# app/services/book_document.py
+"""Документ книги — промежуточный слой между текстами LLM и вёрсткой.
+
+Раньше ответ LLM сразу превращался в HTML, и единственным результатом
+сборки был book.html: новый формат, PDF, исправленный шаблон или превью
+требовали повторной генерации. Теперь:
+  ▸ сборщики стилей складывают главы, ссылки на фото, подписи и метаданные
+    в BookDocument и сохраняют его в book.json (компактный JSON) рядом с
+    book.html;
+  ▸ render_html() собирает book.html из документа по его шаблону —
+    классическая книга и флипбук; render_preview() — вариант для анонимного
+    просмотра; PDF рендерится из полученного book.html (pdf_service);
+  ▸ rerender() пересобирает все эти файлы из book.json за миллисекунды,
+    без вызовов LLM.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from jinja2 import Template, TemplateNotFound
+
+from app.services.template_env import get_template, stream_to_file
+
+log = logging.getLogger("book_document")
+
+DOCUMENT_NAME = "book.json"
+SCHEMA_VERSION = 1
+# Шаблон флипбука, если шаблона стиля нет
+FLIPBOOK_FALLBACK_TEMPLATE = "flipbook_template.html"
+# Обложка и оглавление классической книги — страницы до первой главы
+CLASSIC_LEADING_PAGES = 2
+
+
+@dataclass(slots=True)
+class BookChapter:
+    key: str
+    title: str
+    text: str                        # HTML главы
+    image: Optional[str] = None      # ссылка на фото (ассет, см. app/services/assets.py)
+    caption: str = ""                # подпись под фото в вёрстке
+    image_note: str = ""             # полный анализ фото, из которого сделана подпись
+
+
+@dataclass(slots=True)
+class BookDocument:
+    style: str                       # romantic | fantasy | humor
+    format: str                      # classic | flipbook
+    template: str                    # шаблон в app/templates
+    title: str
+    full_name: str = ""
+    chapters: List[BookChapter] = field(default_factory=list)
+    final_message: str = ""
+    prologue: str = ""
+    # Прочие подписи шаблона: подзаголовок, «Содержание», «Благодарности»…
+    labels: Dict[str, str] = field(default_factory=dict)
+    version: int = SCHEMA_VERSION
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BookDocument":
+        chapter_fields = {f.name for f in fields(BookChapter)}
+        doc_fields = {f.name for f in fields(cls)}
+        chapters = [BookChapter(**{k: v for k, v in c.items() if k in chapter_fields})
+                    for c in data.get("chapters") or []]
+        return cls(**{k: v for k, v in data.items() if k in doc_fields and k != "chapters"},
+                   chapters=chapters)
+
+
+# ─────────────── хранение ──────────────────────────────────────────────────
+def document_path(run_dir: Path) -> Path:
+    return run_dir / DOCUMENT_NAME
+
+
+def save(run_dir: Path, doc: BookDocument) -> Path:
+    """Пишет book.json (временный файл + os.replace)."""
+    path = document_path(run_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{DOCUMENT_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(doc.to_dict(), ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+    return path
+
+
+def load(run_dir: Path) -> Optional[BookDocument]:
+    """Документ книги или None (старый run_id, другая версия схемы, битый файл)."""
+    path = document_path(run_dir)
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("book.json не прочитан (%s): %s", path, e)
+        return None
+    if data.get("version") != SCHEMA_VERSION:
+        return None
+    try:
+        return BookDocument.from_dict(data)
+    except TypeError as e:
+        log.warning("book.json не разобран (%s): %s", path, e)
+        return None
+
+
+# ─────────────── рендер ────────────────────────────────────────────────────
+def _template(doc: BookDocument) -> Template:
+    try:
+        return get_template(doc.template)
+    except TemplateNotFound:
+        if doc.format != "flipbook":
+            raise
+    print(f"⚠️ Не найден шаблон {doc.template}, использую базовый")
+    try:
+        return get_template(FLIPBOOK_FALLBACK_TEMPLATE)
+    except TemplateNotFound as e:
+        print(f"❌ Не найден даже базовый шаблон {FLIPBOOK_FALLBACK_TEMPLATE}: {e}")
+        # Минимальный встроенный шаблон
+        from app.services.flipbook_builder import create_embedded_flipbook_template
+        tpl = create_embedded_flipbook_template()
+        if tpl is None:
+            raise
+        return tpl
+
+
+def _flipbook_pages(doc: BookDocument) -> List[Dict[str, Any]]:
+    """Каждая глава флипбука — две страницы: текст отдельно, фото с подписью отдельно.
+    Главе без фото и подписи (книга, переведённая из классики) пустая страница не нужна."""
+    pages = []
+    for chapter in doc.chapters:
+        pages.append({"title": chapter.title, "text": chapter.text,
+                      "image": None, "caption": None, "type": "text"})
+        if chapter.image or chapter.caption:
+            pages.append({"title": chapter.title, "text": None,
+                          "image": chapter.image, "caption": chapter.caption or None, "type": "image"})
+    return pages
+
+
+def _context(doc: BookDocument, run_id: str) -> Dict[str, Any]:
+    context = {
+        "run_id": run_id,
+        "style": doc.style,
+        "book_title": doc.title,
+        "full_name": doc.full_name,
+        "prologue": doc.prologue,
+        "final_page_content": doc.final_message,
+        **doc.labels,
+    }
+    if doc.format == "flipbook":
+        context["pages"] = _flipbook_pages(doc)
+    else:
+        context["chapters"] = doc.chapters
+    return context
+
+
+def render_html(doc: BookDocument, output_path: Path, **extra: Any) -> Path:
+    """Собирает HTML книги из документа (потоком в файл)."""
+    return stream_to_file(_template(doc), output_path, **_context(doc, output_path.parent.name), **extra)
+
+
+def write(doc: BookDocument, output_path: Path) -> Path:
+    """Сохраняет документ рядом с output_path и собирает по нему book.html."""
+    save(output_path.parent, doc)
+    return render_html(doc, output_path)
+
+
+def render_preview(doc: BookDocument, output_path: Path, max_pages: int) -> Optional[Path]:
+    """Первые max_pages страниц классической книги и страница «войдите, чтобы
+    читать дальше». None — у формата нет превью по документу."""
+    if doc.format != "classic":
+        return None
+    from app.services.book_variants import AUTH_WALL_HTML
+
+    chapters = max(0, max_pages - CLASSIC_LEADING_PAGES)
+    if chapters >= len(doc.chapters):
+        return render_html(doc, output_path)
+    return render_html(doc, output_path, preview_chapters=chapters,
+                       auth_wall=AUTH_WALL_HTML.format(pages=max_pages))
+
+
+async def rerender(run_id: str) -> Optional[BookDocument]:
+    """Пересобирает book.html, сжатые копии, превью и PDF из book.json без LLM.
+
+    None — у run_id нет документа книги (собран до его появления).
+    """
+    from app.services import http_cache
+    from app.services.book_variants import build_preview
+    from app.services.pdf_renderer import PdfRenderError
+    from app.services.pdf_service import ensure_pdf
+
+    run_dir = Path("data") / run_id
+    doc = await asyncio.to_thread(load, run_dir)
+    if doc is None:
+        return None
+    html_file = run_dir / "book.html"
+    await asyncio.to_thread(render_html, doc, html_file)
+    await asyncio.to_thread(http_cache.precompress, html_file)
+    if doc.format == "classic":
+        await asyncio.to_thread(build_preview, run_dir)
+        try:
+            await ensure_pdf(run_id, force=True)
+        except PdfRenderError as e:
+            # HTML уже пересобран; PDF можно запросить позже через /generate-pdf
+            log.warning("book %s: PDF не пересобран (%s)", run_id, e)
+    log.info("book %s re-rendered from %s", run_id, DOCUMENT_NAME)
+    return doc
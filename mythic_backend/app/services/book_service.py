@@ -5,6 +5,7 @@ from sqlalchemy.orm import selectinload
 from sqlalchemy import String as SAString
 from ..models import User, Book
 from .user_service import UserService
+from . import run_manifest
 from typing import Optional, List, Dict, Any
 from pathlib import Path
 import json
@@ -173,31 +174,26 @@ class BookService:
         if existing_book:
             return existing_book
         
-        # Определяем пути к файлам
+        # Определяем пути к файлам; что уже собрано — смотрим в манифесте run_id
         run_dir = Path("data") / run_id
         html_file = run_dir / "book.html"
         pdf_file = run_dir / "book.pdf"
         images_dir = run_dir / "images"
-        posts_file = run_dir / "posts.json"
+        manifest = run_manifest.load(run_id)
         
-        if not html_file.exists() and not pdf_file.exists():
+        if not manifest or not (manifest["files"].get("html") or manifest["files"].get("pdf")):
             return None
         
-        # Загружаем данные профиля
+        # Данные профиля
+        profile = manifest.get("profile") or {}
         profile_data = {}
-        if posts_file.exists():
-            try:
-                posts_data = json.loads(posts_file.read_text(encoding="utf-8"))
-                if posts_data:
-                    profile = posts_data[0]
-                    profile_data = {
-                        "username": profile.get("username"),
-                        "fullName": profile.get("fullName"),
-                        "followersCount": profile.get("followersCount"),
-                        "postsCount": len(profile.get("latestPosts", []))
-                    }
-            except:
-                pass
+        if profile:
+            profile_data = {
+                "username": profile.get("username"),
+                "fullName": profile.get("fullName"),
+                "followersCount": profile.get("followers"),
+                "postsCount": profile.get("posts"),
+            }
         
         # Определяем название книги
         title = custom_title
@@ -215,9 +211,9 @@ class BookService:
             run_id=run_id,
             title=title,
             profile_data=profile_data,
-            html_path=str(html_file) if html_file.exists() else None,
-            pdf_path=str(pdf_file) if pdf_file.exists() else None,
-            images_path=str(images_dir) if images_dir.exists() else None,
+            html_path=str(html_file) if manifest["files"].get("html") else None,
+            pdf_path=str(pdf_file) if manifest["files"].get("pdf") else None,
+            images_path=str(images_dir) if manifest["files"].get("images") else None,
             metadata={"auto_saved": True}
         )
         
@@ -0,0 +1,104 @@
+# app/services/book_variants.py
+"""Варианты book.html, которые считаются один раз при сборке, а не на просмотр.
+
+Анонимный просмотр классической книги раньше на каждый запрос разбирал
+многомегабайтный book.html через BeautifulSoup, удалял страницы после
+десятой и сериализовал DOM заново. Теперь:
+  ▸ build_preview() после сборки пишет рядом book.preview.html — первые
+    BOOK_PREVIEW_PAGES страниц и страница «войдите, чтобы читать дальше».
+    Если есть документ книги (book.json), превью рендерится из него тем же
+    шаблоном; BeautifulSoup остаётся для книг, собранных без документа;
+  ▸ ensure_preview() отдаёт готовый файл и пересобирает его, только если
+    book.html новее (старые run_id, правки книги в редакторе).
+Оба варианта отдаются как статические файлы со сжатыми копиями
+(app/services/http_cache.py).
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+from app.config import settings
+from app.services import book_document, http_cache
+
+log = logging.getLogger("book_variants")
+
+BOOK_NAME = "book.html"
+PREVIEW_NAME = "book.preview.html"
+
+AUTH_WALL_HTML = """
+<div style="display: flex; flex-direction: column; justify-content: center; align-items: center; height: 100vh; text-align: center; font-family: 'Playfair Display', serif; background-color: #fff; color: #333;">
+    <h2 style="font-size: 2em; margin-bottom: 1em; color: #333;">📚 Для продолжения чтения</h2>
+    <p style="font-size: 1.2em; margin-bottom: 1.5em; color: #666; max-width: 400px; line-height: 1.6;">
+        Это только первые {pages} страниц вашей книги. Чтобы прочитать всю историю, войдите в систему или зарегистрируйтесь.
+    </p>
+    <a href="/" style="background-color: #333; color: white; padding: 12px 24px; text-decoration: none; border-radius: 8px; font-size: 1.1em; margin-top: 1em;">
+        Войти в систему
+    </a>
+</div>
+"""
+
+
+def limit_book_pages(html_content: str, max_pages: int) -> str:
+    """Ограничивает HTML книгу первыми max_pages страницами"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    # Находим все страницы книги
+    book_pages = soup.find_all('div', class_='book-page')
+    if len(book_pages) <= max_pages:
+        return html_content  # Если страниц меньше лимита, возвращаем как есть
+
+    # Оставляем только первые max_pages страниц
+    for page in book_pages[max_pages:]:
+        page.decompose()
+
+    # Страница с сообщением о необходимости авторизации
+    auth_message_page = soup.new_tag('div')
+    auth_message_page['class'] = 'book-page auth-required-page'
+    auth_message_page.append(BeautifulSoup(AUTH_WALL_HTML.format(pages=max_pages), 'html.parser'))
+
+    body = soup.find('body')
+    if body:
+        body.append(auth_message_page)
+    return str(soup)
+
+
+def build_preview(run_dir: Path, compress: bool = True) -> Path:
+    """Пишет book.preview.html для run_dir (временный файл + os.replace);
+    compress — сразу и сжатые копии (при сборке, не во время запроса)."""
+    html_file = run_dir / BOOK_NAME
+    preview_file = run_dir / PREVIEW_NAME
+    doc = book_document.load(run_dir)
+    if doc is not None and doc.format == "classic":
+        # Превью собирается из документа книги тем же шаблоном — без разбора HTML
+        book_document.render_preview(doc, preview_file, settings.BOOK_PREVIEW_PAGES)
+        if compress:
+            http_cache.precompress(preview_file)
+        log.info("preview rendered: %s", preview_file)
+        return preview_file
+
+    html_content = html_file.read_text(encoding="utf-8")
+    try:
+        preview = limit_book_pages(html_content, settings.BOOK_PREVIEW_PAGES)
+    except Exception as e:
+        # Как и раньше: лучше показать книгу целиком, чем ничего
+        log.error(f"Error limiting book pages for {run_dir.name}: {e}")
+        preview = html_content
+    tmp = preview_file.with_name(f"{PREVIEW_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(preview, encoding="utf-8")
+    os.replace(tmp, preview_file)
+    if compress:
+        http_cache.precompress(preview_file)
+    log.info("preview written: %s", preview_file)
+    return preview_file
+
+
+def ensure_preview(run_dir: Path) -> Path:
+    """Готовый book.preview.html; пересобирается, только если book.html новее."""
+    preview_file = run_dir / PREVIEW_NAME
+    if preview_file.exists() and preview_file.stat().st_mtime >= (run_dir / BOOK_NAME).stat().st_mtime:
+        return preview_file
+    return build_preview(run_dir, compress=False)
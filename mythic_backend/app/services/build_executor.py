@@ -0,0 +1,91 @@
+# app/services/build_executor.py
+"""Выполнение синхронных стиль-сборщиков вне event loop.
+
+Каждый стиль получает свой ограниченный ThreadPoolExecutor: сборщики делают
+блокирующие вызовы Azure и рендер WeasyPrint, и если выполнять их прямо в
+корутине, замирают все остальные запросы процесса (/status, авторизация).
+Потоки, а не процессы, — сборщики обмениваются состоянием через модули
+(клиенты LLM, кэши), а тяжёлая CPU-часть (PDF) вынесена отдельно.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from app.config import settings
+
+log = logging.getLogger("build_executor")
+
+
+class StyleExecutorPool:
+    """Пул исполнителей «стиль → ThreadPoolExecutor» с метриками очереди."""
+
+    def __init__(self, limits: Dict[str, int], default_limit: int):
+        self._limits = dict(limits)
+        self._default_limit = default_limit
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._metrics: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _executor(self, style: str) -> ThreadPoolExecutor:
+        with self._lock:
+            if style not in self._executors:
+                limit = self._limits.get(style, self._default_limit)
+                self._executors[style] = ThreadPoolExecutor(
+                    max_workers=limit, thread_name_prefix=f"build-{style}"
+                )
+                self._metrics[style] = {
+                    "limit": limit, "queued": 0, "running": 0,
+                    "completed": 0, "failed": 0, "last_duration_s": 0.0,
+                }
+            return self._executors[style]
+
+    def _bump(self, style: str, key: str, delta: float = 1):
+        with self._lock:
+            self._metrics[style][key] += delta
+
+    async def run(self, style: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Запускает func(*args) в пуле стиля и ждёт результат, не блокируя loop."""
+        executor = self._executor(style)
+        # run_in_executor не переносит contextvars — делаем это явно
+        ctx = contextvars.copy_context()
+        call = functools.partial(ctx.run, self._tracked, style, func, *args, **kwargs)
+        self._bump(style, "queued")
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+    def _tracked(self, style: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self._bump(style, "queued", -1)
+        self._bump(style, "running")
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._bump(style, "failed")
+            raise
+        else:
+            self._bump(style, "completed")
+            return result
+        finally:
+            self._bump(style, "running", -1)
+            with self._lock:
+                self._metrics[style]["last_duration_s"] = round(time.monotonic() - started, 1)
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {style: dict(m) for style, m in self._metrics.items()}
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+build_executor = StyleExecutorPool(
+    settings.STYLE_BUILD_CONCURRENCY,
+    settings.STYLE_BUILD_DEFAULT_CONCURRENCY,
+)
@@ -0,0 +1,127 @@
+# app/services/build_pipeline.py
+"""Пайплайн сборки книги: этап загрузки фото → сбор текстов → стиль-сборщик.
+
+Если у run_id уже есть книга того же стиля в другом формате, она не
+собирается заново, а переводится в нужный формат (app/services/book_convert.py).
+
+Выполняется воркером очереди (см. app/worker.py); в API-процессе
+используется только как фоллбэк, если Redis недоступен.
+"""
+import asyncio
+from pathlib import Path
+
+from app.services import posts_store, run_manifest
+from app.services.book_convert import convert, convertible
+from app.services.book_variants import build_preview
+from app.services.downloader import wait_for_download
+from app.services.http_cache import precompress
+from app.services.image_derivatives import async_build_derivatives
+from app.services.job_queue import final_attempt, register_handler
+from app.services.llm_gateway import build_scope
+from app.services.pdf_service import ensure_pdf, pdf_is_fresh
+from app.services.progress import failure_stage, publish
+from app.styles import build_book
+
+
+async def run_full_build(run_id: str, book_format: str, user: dict):
+    """
+    Полный асинхронный процесс сборки книги: ожидание фото, сборка текста и HTML.
+    """
+    run_dir = Path("data") / run_id
+    images_dir = run_dir / "images"
+    style = (run_manifest.load(run_id) or {}).get("style") or "romantic"
+
+    # Книга уже есть в другом формате — раскладываем готовые главы и фото
+    # заново, LLM дописывает только недостающие мелочи
+    source = await asyncio.to_thread(convertible, run_id, style, book_format)
+    if source is not None:
+        run_manifest.mark_stage(run_id, "book_generated", done=False, files={"html": False})
+        publish(run_id, "building", message="Меняю формат книги", style=style, format=book_format)
+        try:
+            with build_scope(run_id):
+                await convert(run_id, source, book_format)
+        except Exception as e:
+            print(f"⚠️ Не удалось сменить формат книги {run_id}, собираю заново: {e}")
+        else:
+            if book_format != "flipbook":
+                try:
+                    await ensure_pdf(run_id, force=True)
+                except Exception as e:
+                    print(f"❌ Ошибка создания PDF: {e}")
+            await _finish_build(run_id, style, book_format)
+            return
+
+    # Если формат flipbook — удаляем старый book.html перед генерацией
+    if book_format == "flipbook":
+        book_html = run_dir / "book.html"
+        if book_html.exists():
+            book_html.unlink()
+        run_manifest.mark_stage(run_id, "book_generated", done=False, files={"html": False})
+
+    # 1. Ждем завершения этапа загрузки фото (событие, а не опрос папки)
+    #    Таймаут и пустая загрузка — ошибка задачи: очередь повторит сборку
+    try:
+        downloads = await wait_for_download(run_id, timeout=300.0)
+    except asyncio.TimeoutError:
+        print(f"❌ Таймаут ожидания изображений для {run_id}")
+        publish(run_id, failure_stage(final_attempt()), message="Не дождались загрузки фотографий")
+        raise RuntimeError(f"таймаут ожидания изображений для {run_id}")
+    if not downloads.get("images"):
+        print(f"❌ Нет изображений для {run_id}")
+        publish(run_id, failure_stage(final_attempt()), message="Не удалось загрузить фотографии")
+        raise RuntimeError(f"нет изображений для {run_id}")
+
+    # Производные размеры фото: обычно уже посчитаны после загрузки,
+    # здесь досчитываются только недостающие (старые run_id, повторная загрузка)
+    try:
+        await async_build_derivatives(run_dir)
+    except Exception as e:
+        print(f"⚠️ Не удалось подготовить размеры фото для {run_id}: {e}")
+
+    # 2. Собираем данные
+    images = sorted([str(p) for p in images_dir.glob("*")])[:30]
+    comments = [p.get('caption', '') for p in posts_store.iter_items(run_dir)]
+
+    user_id = user.get("sub")
+
+    # 3. Вызываем новый асинхронный диспетчер; LLM-запросы сборки
+    #    ограничены семафором этой сборки (LLM_PER_BUILD_CONCURRENCY)
+    publish(run_id, "building", message="Пишу книгу", style=style, format=book_format)
+    try:
+        with build_scope(run_id):
+            await build_book(style, run_id, images, comments, book_format, user_id)
+    except Exception as e:
+        publish(run_id, failure_stage(final_attempt()), message=f"Ошибка сборки: {e}")
+        raise
+    await _finish_build(run_id, style, book_format)
+
+
+async def _finish_build(run_id: str, style: str, book_format: str):
+    """Варианты book.html, стадия book_generated в манифесте и событие прогресса.
+
+    Сборщик мог завершиться без book.html — это ошибка сборки, а не готовая книга.
+    """
+    run_dir = Path("data") / run_id
+    if not (run_dir / "book.html").exists():
+        publish(run_id, failure_stage(final_attempt()), message="Книга не собрана")
+        raise RuntimeError(f"book.html не создан для {run_id}")
+    # Сжатые копии и вариант для анонимного просмотра классической книги —
+    # один раз при сборке, а не на каждый запрос
+    try:
+        await asyncio.to_thread(precompress, run_dir / "book.html")
+        if book_format != "flipbook":
+            await asyncio.to_thread(build_preview, run_dir)
+    except Exception as e:
+        print(f"⚠️ Не удалось подготовить варианты книги {run_id}: {e}")
+    run_manifest.mark_stage(run_id, "book_generated", done=True, files={
+        "html": True,
+        "pdf": pdf_is_fresh(run_dir),  # PDF прошлой сборки — не PDF этой книги
+    })
+    publish(run_id, "book_generated", message="Книга готова", style=style, format=book_format)
+    print(f"✅ Полная сборка для {run_id} (формат: {book_format}) завершена.")
+
+
+@register_handler("build")
+async def handle_build_job(payload: dict):
+    """Обработчик задачи очереди ``build``."""
+    await run_full_build(payload["run_id"], payload["book_format"], payload.get("user") or {})
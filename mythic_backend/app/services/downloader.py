@@ -1,14 +1,24 @@
 import asyncio
-import httpx, logging, mimetypes
+import httpx, json, logging, mimetypes, os
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 import time
 
+import aiofiles
+
+from app.config import settings
+from app.services import posts_store, progress, run_manifest
+from app.services.image_derivatives import async_build_derivatives
+from app.services.photo_selection import build_selection
+from app.services.progress import publish
+
 log = logging.getLogger("downloader")
 
 
 # ─────────────────── сбор ссылок ────────────────────────────────────────────
-def _collect_urls(items: List[Dict]) -> List[str]:
+def _collect_urls(items: Iterable[Dict]) -> List[str]:
     """Ищем displayUrl и images во всех latestPosts, childPosts и stories."""
     urls: list[str] = []
 
@@ -35,33 +45,109 @@ def _collect_urls(items: List[Dict]) -> List[str]:
             if story.get("videoUrl"):
                 urls.append(story["videoUrl"])
 
-    # удаляем дубликаты, сохраняя порядок
+    # удаляем дубликаты, сохраняя порядок; у CDN одно фото приходит с разными
+    # подписями в query, поэтому сравниваем по пути (почти-дубли ловит photo_selection)
     seen = set()
     out = []
     for u in urls:
-        if u not in seen:
+        key = urlsplit(u).path or u
+        if key not in seen:
             out.append(u)
-            seen.add(u)
+            seen.add(key)
     return out
 
 
 # ─────────────────── скачивание с retry логикой ─────────────────────────────
-async def _save(url: str, folder: Path, client: httpx.AsyncClient, idx: int, max_retries: int = 3):
+class DownloadTooLarge(Exception):
+    """Файл больше DOWNLOAD_MAX_BYTES."""
+
+
+@dataclass
+class DownloadResult:
+    """Итог загрузки одного URL — для лога и downloads.json."""
+    url: str
+    idx: int
+    status: str = "failed"          # ok | too_large | failed
+    file: Optional[str] = None
+    bytes: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def _host_limiter(limiters: Dict[str, asyncio.Semaphore], url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).hostname or ""
+    if host not in limiters:
+        limiters[host] = asyncio.Semaphore(settings.DOWNLOAD_PER_HOST_CONCURRENCY)
+    return limiters[host]
+
+
+def _check_length(headers: httpx.Headers):
+    length = headers.get("content-length")
+    if length and length.isdigit() and int(length) > settings.DOWNLOAD_MAX_BYTES:
+        raise DownloadTooLarge(f"{length} bytes")
+
+
+async def _stream_to_file(url: str, folder: Path, client: httpx.AsyncClient, idx: int) -> Tuple[Path, int]:
+    """HEAD-проверка размера, затем потоковая запись тела кусками во временный файл."""
+    if settings.DOWNLOAD_HEAD_CHECK:
+        try:
+            head = await client.head(url, follow_redirects=True)
+            if head.is_success:
+                _check_length(head.headers)
+        except httpx.HTTPError:
+            pass  # HEAD не обязателен — размер проверим по ходу GET
+
+    async with client.stream("GET", url, follow_redirects=True) as r:
+        r.raise_for_status()
+        _check_length(r.headers)
+        # получаем расширение по Content-Type, fallback = .jpg
+        content_type = r.headers.get("content-type", "").split(";")[0].strip()
+        ext = mimetypes.guess_extension(content_type) or ".jpg"
+        fname = folder / f"{idx:03d}{ext}"
+        part = fname.with_name(fname.name + ".part")
+        written = 0
+        try:
+            async with aiofiles.open(part, "wb") as fh:
+                async for chunk in r.aiter_bytes(settings.DOWNLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > settings.DOWNLOAD_MAX_BYTES:
+                        raise DownloadTooLarge(f"> {settings.DOWNLOAD_MAX_BYTES} bytes")
+                    await fh.write(chunk)
+            os.replace(part, fname)
+        finally:
+            part.unlink(missing_ok=True)
+    return fname, written
+
+
+async def _save(url: str, folder: Path, client: httpx.AsyncClient, idx: int,
+                max_retries: Optional[int] = None) -> DownloadResult:
     """Скачивает изображение с повторными попытками при ошибках соединения"""
+    max_retries = settings.DOWNLOAD_RETRIES if max_retries is None else max_retries
+    result = DownloadResult(url=url, idx=idx)
+    started = time.perf_counter()
     for attempt in range(max_retries + 1):
+        result.retries = attempt
         try:
-            # Увеличиваем таймаут и добавляем задержку между попытками
-            timeout = httpx.Timeout(30.0, connect=10.0)
-            r = await client.get(url, follow_redirects=True, timeout=timeout)
-            r.raise_for_status()
-            
-            # получаем расширение по Content-Type, fallback = .jpg
-            ext = mimetypes.guess_extension(r.headers.get("content-type", "")) or ".jpg"
-            fname = folder / f"{idx:03d}{ext}"
-            fname.write_bytes(r.content)
-            log.debug("saved %s", fname.name)
-            return  # Успешно скачали, выходим
-            
+            fname, result.bytes = await _stream_to_file(url, folder, client, idx)
+            result.status, result.file = "ok", fname.name
+            log.debug("saved %s (%s bytes)", fname.name, result.bytes)
+            break
+        except DownloadTooLarge as e:
+            log.warning(f"Skipping {url}: too large ({e})")
+            result.status, result.error = "too_large", str(e)
+            _create_placeholder_image(folder, idx)
+            break
+        except httpx.HTTPStatusError as e:
+            # 4xx (кроме 429) повторять бессмысленно
+            retryable = e.response.status_code == 429 or e.response.status_code >= 500
+            if retryable and attempt < max_retries:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            log.error(f"Failed to download {url}: HTTP {e.response.status_code}")
+            result.error = f"HTTP {e.response.status_code}"
+            _create_placeholder_image(folder, idx)
+            break
         except (httpx.ConnectError, httpx.TimeoutException, httpx.RequestError) as e:
             if attempt < max_retries:
                 wait_time = 2 ** attempt  # Экспоненциальная задержка
@@ -69,12 +155,49 @@ async def _save(url: str, folder: Path, client: httpx.AsyncClient, idx: int, max
                 await asyncio.sleep(wait_time)
             else:
                 log.error(f"Failed to download {url} after {max_retries + 1} attempts: {e}")
+                result.error = str(e)
                 # Создаем заглушку для отсутствующего изображения
                 _create_placeholder_image(folder, idx)
         except Exception as e:
             log.error(f"Unexpected error downloading {url}: {e}")
+            result.error = str(e)
             _create_placeholder_image(folder, idx)
-            return
+            break
+    result.seconds = round(time.perf_counter() - started, 3)
+    return result
+
+
+async def download_all(urls: List[str], folder: Path) -> List[DownloadResult]:
+    """Качает urls в folder: общий пул keep-alive соединений, не больше
+    DOWNLOAD_PER_HOST_CONCURRENCY одновременных загрузок на хост."""
+    limits = httpx.Limits(
+        max_keepalive_connections=settings.DOWNLOAD_MAX_KEEPALIVE,
+        max_connections=settings.DOWNLOAD_MAX_CONNECTIONS,
+    )
+    timeout = httpx.Timeout(settings.DOWNLOAD_TIMEOUT, connect=settings.DOWNLOAD_CONNECT_TIMEOUT)
+    limiters: Dict[str, asyncio.Semaphore] = {}
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        async def download_limited(url: str, idx: int) -> DownloadResult:
+            async with _host_limiter(limiters, url):
+                return await _save(url, folder, client, idx)
+
+        return await asyncio.gather(*[download_limited(u, i) for i, u in enumerate(urls, 1)])
+
+
+def _write_report(folder: Path, results: List[DownloadResult]):
+    """downloads.json рядом с images/ (не внутри — сборщики читают images/*)."""
+    ok = [r for r in results if r.status == "ok"]
+    report = {
+        "total": len(results),
+        "ok": len(ok),
+        "bytes": sum(r.bytes for r in ok),
+        "retries": sum(r.retries for r in results),
+        "items": [asdict(r) for r in results],
+    }
+    (folder.parent / "downloads.json").write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    log.info("download report: %s/%s ok, %s bytes, %s retries",
+             report["ok"], report["total"], report["bytes"], report["retries"])
 
 
 def _create_placeholder_image(folder: Path, idx: int):
@@ -110,51 +233,104 @@ def _create_placeholder_image(folder: Path, idx: int):
         log.error(f"Failed to create placeholder image: {e}")
 
 
-def download_photos(items: List[Dict], folder: Path):
-    """Синхронная обёртка для Starlette BackgroundTask с улучшенной обработкой ошибок."""
+# ─────────────────── этап «загрузка фото» ───────────────────────────────────
+# run_id → загрузка, выполняющаяся в этом процессе
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+async def download_stage(run_id: str, items: Optional[Iterable[Dict]] = None) -> Dict:
+    """Этап пайплайна: скачивает фото, считает производные размеры, отмечает
+    images_downloaded в манифесте и публикует событие. Возвращает сводку.
+
+    items по умолчанию — ленивый итератор по posts.ndjson run_id.
+    """
+    run_dir = run_manifest.run_dir(run_id)
+    folder = run_dir / "images"
+    results: List[DownloadResult] = []
     try:
-        urls = _collect_urls(items)
-        if not urls:
+        if items is None:
+            items = posts_store.iter_items(run_dir)
+        urls = (await asyncio.to_thread(_collect_urls, items))[:settings.DOWNLOAD_MAX_IMAGES]
+        if urls:
+            folder.mkdir(parents=True, exist_ok=True)
+            log.info("downloading %s images → %s", len(urls), folder)
+            results = await download_all(urls, folder)
+            await asyncio.to_thread(_write_report, folder, results)
+        else:
             log.warning("no image urls found — nothing to download")
-            return
-
-        # Ограничиваем до первых 15 фотографий для оптимизации
-        urls = urls[:15]
-        log.info("limiting to first %s images for optimal performance", len(urls))
-
-        folder.mkdir(parents=True, exist_ok=True)
-        log.info("downloading %s images → %s", len(urls), folder)
-
-        async def main():
-            # Настройки клиента с более надежными параметрами
-            limits = httpx.Limits(max_keepalive_connections=5, max_connections=10)
-            timeout = httpx.Timeout(30.0, connect=10.0)
-            
-            async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
-                # Ограничиваем количество одновременных загрузок
-                semaphore = asyncio.Semaphore(3)
-                
-                async def download_with_semaphore(url: str, idx: int):
-                    async with semaphore:
-                        await _save(url, folder, client, idx)
-                
-                tasks = [download_with_semaphore(u, i) for i, u in enumerate(urls, 1)]
-                await asyncio.gather(*tasks, return_exceptions=True)
-
-        
-        try:
-            loop = asyncio.get_running_loop()
-            future = asyncio.run_coroutine_threadsafe(main(), loop)
-            future.result(timeout=120) 
-        except RuntimeError:
-            asyncio.run(main())
-            
-        log.info("download completed (%s urls processed)", len(urls))
-        
     except Exception as e:
-        log.error(f"Critical error in download_photos: {e}")
+        log.error(f"Critical error in download_stage: {e}")
         try:
             folder.mkdir(parents=True, exist_ok=True)
-            _create_placeholder_image(folder, 1)
+            await asyncio.to_thread(_create_placeholder_image, folder, 1)
         except Exception as fallback_error:
             log.error(f"Failed to create fallback image: {fallback_error}")
+
+    # Производные размеры (vision / web) — один раз сразу после загрузки
+    try:
+        await async_build_derivatives(run_dir)
+    except Exception as e:
+        log.error(f"Image derivatives failed: {e}")
+
+    # Рейтинг фото и схлопывание дублей (selection.json) — по готовым производным
+    try:
+        await asyncio.to_thread(build_selection, run_dir)
+    except Exception as e:
+        log.error(f"Photo selection failed: {e}")
+
+    image_count = sum(1 for _ in folder.glob("*")) if folder.exists() else 0
+    summary = {
+        "runId": run_id,
+        "images": image_count,
+        "downloaded": sum(1 for r in results if r.status == "ok"),
+        "failed": sum(1 for r in results if r.status != "ok"),
+        "bytes": sum(r.bytes for r in results),
+    }
+    await asyncio.to_thread(run_manifest.mark_stage, run_id, "images_downloaded",
+                            files={"images": image_count}, downloads=summary)
+    publish(run_id, "images_downloaded", message="Фотографии загружены", images=image_count)
+    log.info("download stage completed for %s: %s", run_id, summary)
+    return summary
+
+
+def start_download(run_id: str, items: Optional[Iterable[Dict]] = None) -> asyncio.Task:
+    """Запускает этап загрузки в текущем event loop (повторный вызов для того же
+    run_id возвращает уже идущую задачу)."""
+    task = _inflight.get(run_id)
+    if task is None:
+        task = asyncio.create_task(download_stage(run_id, items))
+        _inflight[run_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(run_id, None))
+    return task
+
+
+def _finished_summary(run_id: str) -> Optional[Dict]:
+    manifest = run_manifest.load(run_id) or {}
+    if not manifest.get("stages", {}).get("images_downloaded"):
+        return None
+    return manifest.get("downloads") or {"runId": run_id, "images": manifest["files"].get("images", 0)}
+
+
+async def _wait_for_stage(run_id: str) -> Dict:
+    summary = await asyncio.to_thread(_finished_summary, run_id)
+    if summary:
+        return summary
+    # Загрузка идёт в другом процессе (API), ждём её событие; манифест
+    # перепроверяем и на каждом heartbeat — на случай, если событие пропущено
+    async for event in progress.subscribe(run_id, heartbeat=5.0):
+        if event is None or event.get("stage") == "images_downloaded":
+            summary = await asyncio.to_thread(_finished_summary, run_id)
+            if summary:
+                return summary
+
+
+async def wait_for_download(run_id: str, timeout: float) -> Dict:
+    """Ждёт завершения этапа загрузки run_id — в этом процессе или в любом другом.
+
+    Raises asyncio.TimeoutError, если этап не завершился за timeout секунд.
+    """
+    task = _inflight.get(run_id)
+    if task is not None:
+        # shield: таймаут ожидающего не должен отменять саму загрузку
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    return await asyncio.wait_for(_wait_for_stage(run_id), timeout)
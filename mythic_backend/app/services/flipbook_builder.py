@@ -1,16 +1,14 @@
 # app/services/flipbook_builder.py
 import json
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
 import markdown
 import re
-import base64
 
-# Импортируем асинхронный клиент и настройки из llm_client
-from app.services.llm_client import async_client, settings
-
-# Подключаем шаблоны из папки app/templates
-env = Environment(loader=FileSystemLoader('app/templates'))
+# LLM-запросы идут через общий шлюз (пул соединений + лимиты Azure)
+from app.services.llm_gateway import llm_gateway
+from app.services import assets, book_document, posts_store
+# Вёрстка — по документу книги (book.json) и шаблонам app/templates
+from app.services.book_document import BookChapter, BookDocument
 
 def create_embedded_flipbook_template():
     """
@@ -97,27 +95,22 @@ def create_embedded_flipbook_template():
 
 
 def _get_profile_context(run_id: str) -> dict:
-    """Загружает и парсит posts.json для получения контекста о профиле."""
-    posts_path = Path('data') / run_id / 'posts.json'
-    if not posts_path.exists():
-        print(f"⚠️ posts.json не найден для {run_id}")
-        return {}
-
+    """Контекст профиля из первого item датасета (остальной файл не читается)."""
     try:
-        posts_data = json.loads(posts_path.read_text(encoding='utf-8'))
-        if not posts_data:
+        # Извлекаем данные из профиля (обычно первый элемент датасета)
+        profile = posts_store.first_item(Path('data') / run_id)
+        if not profile:
+            print(f"⚠️ Данные профиля не найдены для {run_id}")
             return {}
-
-        # Извлекаем данные из профиля (обычно первый элемент в списке)
-        profile = posts_data[0]
+        latest_posts = profile.get('latestPosts', [])
         return {
             "username": profile.get("username", "Неизвестный"),
             "full_name": profile.get("fullName", ""),
             "bio": profile.get("biography", ""),
-            "captions": [p.get('caption', '') for p in profile.get('latestPosts', [])[:5] if p.get('caption')]
+            "captions": [c for c in (p.get('caption', '') for p in latest_posts) if c][:5]
         }
     except (json.JSONDecodeError, IndexError) as e:
-        print(f"❌ Ошибка парсинга posts.json для {run_id}: {e}")
+        print(f"❌ Ошибка парсинга данных профиля для {run_id}: {e}")
         return {}
 
 
@@ -175,15 +168,13 @@ async def _generate_book_content_from_llm(image_names: list[str], context: dict)
     ]
 
     print("📚 Отправляю эпический запрос к Летописцу для создания легенды...")
-    resp = await async_client.chat.completions.create(
-        model=settings.AZURE_OPENAI_GPT4_DEPLOYMENT,
-        messages=messages,
+    raw_content = await llm_gateway.complete_text(
+        messages,
         temperature=0.85, # Чуть больше креативности для эпического стиля
         max_tokens=4000, # Увеличиваем лимит для получения длинных текстов
         response_format={"type": "json_object"} # Просим JSON в ответе
     )
 
-    raw_content = resp.choices[0].message.content.strip()
     print("📜 Летописец вернул свиток с текстом.")
 
     try:
@@ -230,19 +221,17 @@ async def generate_flipbook_data(run_id: str, image_paths: list[str]) -> dict:
     # Сопоставляем абсолютные пути с именами файлов для кодирования
     image_path_map = {Path(p).name: p for p in image_paths}
     
-    # Преобразуем markdown в HTML и встраиваем изображения в Base64
+    run_dir = Path("data") / run_id
+    
+    # Преобразуем markdown в HTML и подставляем ссылки на ассеты изображений
     for page in pages_content:
-        # Встраиваем изображение
+        # Ссылка на уменьшенную копию фото (см. app/services/assets.py)
         image_name = page.get("image")
         if image_name in image_path_map:
             try:
-                with open(image_path_map[image_name], "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                extension = Path(image_name).suffix.lower().replace('.', '')
-                if extension == 'jpg': extension = 'jpeg'
-                page["image"] = f"data:image/{extension};base64,{encoded_string}"
+                page["image"] = assets.store_file(run_dir, Path(image_path_map[image_name]))
             except Exception as e:
-                print(f"❌ Ошибка кодирования изображения {image_name}: {e}")
+                print(f"❌ Ошибка подготовки изображения {image_name}: {e}")
                 page["image"] = "" # Пустая строка, если ошибка
         else:
             page["image"] = ""
@@ -280,19 +269,14 @@ def create_fallback_flipbook_data(run_id: str) -> dict:
         if images_dir.exists():
             for img_file in sorted(images_dir.glob("*"))[:5]:  # Максимум 5 изображений
                 if img_file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
-                    # Кодируем изображения в base64
+                    # Сохраняем уменьшенную копию ассетом
                     try:
-                        with open(img_file, "rb") as image_file:
-                            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                        extension = img_file.suffix.lower().replace('.', '')
-                        if extension == 'jpg': extension = 'jpeg'
-                        image_base64 = f"data:image/{extension};base64,{encoded_string}"
                         image_files.append({
                             "name": img_file.name,
-                            "base64": image_base64
+                            "url": assets.store_file(run_dir, img_file)
                         })
                     except Exception as e:
-                        print(f"❌ Ошибка кодирования {img_file.name}: {e}")
+                        print(f"❌ Ошибка подготовки {img_file.name}: {e}")
         
         if not image_files:
             print("❌ Нет изображений для создания fallback flipbook")
@@ -324,7 +308,7 @@ def create_fallback_flipbook_data(run_id: str) -> dict:
             pages.append({
                 "title": title,
                 "text": None,
-                "image": img_data["base64"],
+                "image": img_data["url"],
                 "caption": f"Особенный момент из жизни {full_name}",
                 "type": "image"
             })
@@ -337,11 +321,50 @@ def create_fallback_flipbook_data(run_id: str) -> dict:
         return {}
 
 
+# Шаблон и подписи флипбука по стилю книги; неизвестный стиль — старый шаблон
+FLIPBOOK_LAYOUTS = {
+    'fantasy': ('flipbook_fantasy.html', {
+        "book_title": "Хроники Героя",
+        "book_subtitle": "Создано магией и вдохновением",
+        "toc_title": "Путеводитель",
+        "intro_title": "Вступление",
+        "gratitude_title": "Благодарности",
+    }),
+    'humor': ('flipbook_humor.html', {
+        "book_title": "Весёлая История",
+        "book_subtitle": "Создано с улыбкой",
+        "toc_title": "Оглавление",
+        "intro_title": "Вступление",
+        "gratitude_title": "Благодарности",
+    }),
+    'romantic': ('flipbook_romantic.html', {
+        "book_title": "Романтическая История",
+        "book_subtitle": "Создано с любовью",
+        "toc_title": "Содержание",
+        "intro_title": "Введение",
+        "gratitude_title": "Благодарности",
+    }),
+}
+FLIPBOOK_DEFAULT_LAYOUT = ('flipbook_template.html', {
+    "book_title": "История",
+    "book_subtitle": "Книга в стиле flipbook",
+    "toc_title": "Содержание",
+    "intro_title": "Введение",
+    "gratitude_title": "Благодарности",
+})
+
+
+def flipbook_layout(style: str) -> tuple[str, dict]:
+    """(шаблон, подписи) флипбука для стиля; подписи — копия, её можно менять."""
+    tpl_name, labels = FLIPBOOK_LAYOUTS.get(style, FLIPBOOK_DEFAULT_LAYOUT)
+    return tpl_name, dict(labels)
+
+
 def build_flipbook_html(run_id: str, data: dict, style: str = 'romantic'):
     """
     Рендерит HTML-флипбук на основе готовых данных (пролог и страницы).
     Теперь поддерживает динамические шаблоны по стилю книги.
-    Для каждой главы делаем две страницы: текст отдельно, фото отдельно (как было раньше).
+    Для каждой главы делаем две страницы: текст отдельно, фото отдельно (см. app/services/book_document.py).
     """
     # Если нет данных от LLM - создаем fallback
     if not data or "pages" not in data:
@@ -351,86 +374,32 @@ def build_flipbook_html(run_id: str, data: dict, style: str = 'romantic'):
             print("❌ Не удалось создать даже fallback версию flipbook")
             return
 
-    # Динамические заголовки по стилю
-    if style == 'fantasy':
-        book_title = "Хроники Героя"
-        book_subtitle = "Создано магией и вдохновением"
-        toc_title = "Путеводитель"
-        intro_title = "Вступление"
-        gratitude_title = "Благодарности"
-        tpl_name = 'flipbook_fantasy.html'
-    elif style == 'humor':
-        book_title = "Весёлая История"
-        book_subtitle = "Создано с улыбкой"
-        toc_title = "Оглавление"
-        intro_title = "Вступление"
-        gratitude_title = "Благодарности"
-        tpl_name = 'flipbook_humor.html'
-    elif style == 'romantic':
-        book_title = "Романтическая История"
-        book_subtitle = "Создано с любовью"
-        toc_title = "Содержание"
-        intro_title = "Введение"
-        gratitude_title = "Благодарности"
-        tpl_name = 'flipbook_romantic.html'
-    else:
-        # fallback — старый шаблон
-        book_title = "История"
-        book_subtitle = "Книга в стиле flipbook"
-        toc_title = "Содержание"
-        intro_title = "Введение"
-        gratitude_title = "Благодарности"
-        tpl_name = 'flipbook_template.html'
-
-    # --- ВОТ ГЛАВНОЕ: преобразуем pages ---
-    orig_pages = data.get("pages", [])
-    split_pages = []
-    for page in orig_pages:
-        # 1. Страница только с текстом
-        split_pages.append({
-            "title": page.get("title", ""),
-            "text": page.get("text", ""),
-            "image": None,
-            "caption": None,
-            "type": "text"
-        })
-        # 2. Страница только с фото и подписью
-        split_pages.append({
-            "title": page.get("title", ""),
-            "text": None,
-            "image": page.get("image", None),
-            "caption": page.get("caption", None),
-            "type": "image"
-        })
-
-    # Пытаемся загрузить шаблон с fallback
-    try:
-        tpl = env.get_template(tpl_name)
-    except Exception as e:
-        print(f"⚠️ Не найден шаблон {tpl_name}, использую базовый: {e}")
-        tpl_name = 'flipbook_template.html'
-        try:
-            tpl = env.get_template(tpl_name)
-        except Exception as e2:
-            print(f"❌ Не найден даже базовый шаблон {tpl_name}: {e2}")
-            # Создаем минимальный встроенный шаблон
-            tpl = create_embedded_flipbook_template()
-            if not tpl:
-                print("❌ Не удалось создать даже встроенный шаблон")
-                return
-    
-    html = tpl.render(
-        run_id=run_id,
+    # Динамические заголовки и шаблон по стилю
+    tpl_name, labels = flipbook_layout(style)
+    book_title = labels.pop("book_title")
+
+    # Главы документа книги; на две страницы (текст / фото) их делит рендер
+    chapters = [
+        BookChapter(
+            key=f"page-{i + 1}",
+            title=page.get("title") or "",
+            text=page.get("text") or "",
+            image=page.get("image") or None,
+            caption=page.get("caption") or "",
+        )
+        for i, page in enumerate(data.get("pages", []))
+    ]
+    profile_context = _get_profile_context(run_id)
+    doc = BookDocument(
+        style=style,
+        format="flipbook",
+        template=tpl_name,
+        title=book_title,
+        full_name=profile_context.get("full_name") or profile_context.get("username") or "",
+        chapters=chapters,
         prologue=data.get("prologue", ""),
-        pages=split_pages,
-        book_title=book_title,
-        book_subtitle=book_subtitle,
-        toc_title=toc_title,
-        intro_title=intro_title,
-        gratitude_title=gratitude_title,
-        style=style
+        labels=labels,
     )
     out = Path('data') / run_id / 'book.html'
-    out.parent.mkdir(parents=True, exist_ok=True)
-    out.write_text(html, encoding='utf-8')
+    book_document.write(doc, out)
     print(f"✅ Flipbook HTML создан: {out}") 
\ No newline at end of file
@@ -0,0 +1,231 @@
+# app/services/http_cache.py
+"""Отдача файлов книги: условные запросы, диапазоны и сжатые копии.
+
+file_response() — единая точка для просмотра и скачивания книг:
+  ▸ сильный ETag — sha256 содержимого (кэшируется в памяти по mtime и
+    размеру файла), плюс Last-Modified; If-None-Match / If-Modified-Since
+    с той же версией дают 304 без тела;
+  ▸ сжатые копии рядом с файлом — book.html.br / book.html.gz. precompress()
+    пишет их при сборке; без свежей копии gzip считается один раз при первом
+    запросе. Копия выбирается по Accept-Encoding, у неё свой ETag;
+  ▸ ranges=True (PDF) — Accept-Ranges и ответ 206 на один диапазон
+    ``Range: bytes=a-b`` с учётом If-Range.
+Файлы книги пишутся через os.replace, поэтому любая пересборка меняет
+mtime — копии и дайджесты не переживают изменения исходника.
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+log = logging.getLogger("http_cache")
+
+# Браузер хранит копию, но перед использованием сверяет ETag
+REVALIDATE = "private, no-cache"
+CHUNK_SIZE = 64 * 1024
+# Кодировка → суффикс файла копии; порядок — предпочтение сервера
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = {".html", ".htm", ".css", ".js", ".json", ".svg", ".txt"}
+
+_DIGESTS_MAX = 4096
+_digests: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+_digests_lock = threading.Lock()
+
+
+# ─────────────── дайджесты и сжатые копии ──────────────────────────────────
+def digest(path: Path, stat: Optional[os.stat_result] = None) -> str:
+    """sha256 содержимого; пересчитывается, только если файл изменился."""
+    stat = stat or path.stat()
+    key = str(path)
+    with _digests_lock:
+        cached = _digests.get(key)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            _digests.move_to_end(key)
+            return cached[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+    value = h.hexdigest()
+    with _digests_lock:
+        _digests[key] = (stat.st_mtime_ns, stat.st_size, value)
+        _digests.move_to_end(key)
+        while len(_digests) > _DIGESTS_MAX:
+            _digests.popitem(last=False)
+    return value
+
+
+def _sibling(path: Path, suffix: str) -> Path:
+    return path.with_name(path.name + suffix)
+
+
+def _fresh_sibling(path: Path, suffix: str, stat: os.stat_result) -> Optional[Path]:
+    sibling = _sibling(path, suffix)
+    try:
+        return sibling if sibling.stat().st_mtime_ns >= stat.st_mtime_ns else None
+    except FileNotFoundError:
+        return None
+
+
+def _write_sibling(path: Path, suffix: str, payload: bytes) -> Path:
+    target = _sibling(path, suffix)
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, target)
+    return target
+
+
+def precompress(path: Path) -> None:
+    """Пишет .br (если есть brotli) и .gz рядом с файлом — вызывается при сборке."""
+    if not path.exists() or path.suffix.lower() not in COMPRESSIBLE:
+        return
+    data = path.read_bytes()
+    if BROTLI_AVAILABLE:
+        _write_sibling(path, ".br", brotli.compress(data, quality=11))
+    _write_sibling(path, ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+    log.info("precompressed %s", path)
+
+
+# ─────────────── разбор заголовков ─────────────────────────────────────────
+def _accepted_encodings(request: Request) -> Dict[str, float]:
+    accepted = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """``bytes=a-b`` → (start, end) включительно; None — заголовок не подходит
+    (несколько диапазонов, другие единицы). ValueError — диапазон вне файла."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    if not (start_s or end_s).isdigit() or (end_s and not end_s.isdigit()):
+        return None
+    if not start_s:
+        length = int(end_s)
+        if length <= 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(start_s)
+    end = min(int(end_s), size - 1) if end_s else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _iter_range(path: Path, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = fh.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# ─────────────── ответ ─────────────────────────────────────────────────────
+def file_response(request: Request, path: Path, media_type: str,
+                  filename: Optional[str] = None,
+                  headers: Optional[Dict[str, str]] = None,
+                  ranges: bool = False) -> Response:
+    """Файл с ETag / Last-Modified, сжатой копией по Accept-Encoding и (для
+    ranges=True) поддержкой Range; 304, если у клиента та же версия.
+
+    Синхронная: из async-обработчиков вызывается через run_in_threadpool.
+    """
+    stat = path.stat()
+    base_etag = digest(path, stat)[:32]
+    response_headers = {
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": REVALIDATE,
+        **(headers or {}),
+    }
+
+    body_path, encoding = path, None
+    if path.suffix.lower() in COMPRESSIBLE:
+        response_headers["Vary"] = ", ".join(filter(None, [response_headers.get("Vary"), "Accept-Encoding"]))
+        accepted = _accepted_encodings(request)
+        for name, suffix in ENCODINGS:
+            if accepted.get(name, 0) <= 0:
+                continue
+            sibling = _fresh_sibling(path, suffix, stat)
+            if sibling is None and name == "gzip":
+                # Книга изменилась после сборки (редактор) или старый run_id
+                sibling = _write_sibling(path, suffix, gzip.compress(path.read_bytes(), compresslevel=6, mtime=0))
+            if sibling is not None:
+                body_path, encoding = sibling, name
+                break
+
+    etag = f'"{base_etag}-{encoding}"' if encoding else f'"{base_etag}"'
+    response_headers["ETag"] = etag
+    if encoding:
+        response_headers["Content-Encoding"] = encoding
+    if _not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=response_headers)
+
+    if ranges and not encoding:
+        response_headers["Accept-Ranges"] = "bytes"
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range.strip() == etag):
+            try:
+                byte_range = _parse_range(range_header, stat.st_size)
+            except ValueError:
+                return Response(status_code=416, headers={**response_headers,
+                                                          "Content-Range": f"bytes */{stat.st_size}"})
+            if byte_range is not None:
+                start, end = byte_range
+                response_headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+                response_headers["Content-Length"] = str(end - start + 1)
+                if filename:
+                    response_headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+                return StreamingResponse(_iter_range(path, start, end), status_code=206,
+                                         media_type=media_type, headers=response_headers)
+
+    body_stat = stat if body_path == path else body_path.stat()
+    return FileResponse(path=body_path, media_type=media_type, filename=filename,
+                        headers=response_headers, stat_result=body_stat)
@@ -0,0 +1,202 @@
+# app/services/image_derivatives.py
+"""Производные размеры фото, которые считаются один раз после загрузки.
+
+На этапе загрузки (downloader.download_stage) каждое фото из images/ декодируется один раз и
+сохраняется в нескольких размерах (по длинной стороне):
+  ▸ vision — VISION_IMAGE_SIZE (512), для анализа фото LLM;
+  ▸ web    — IMAGE_WEB_SIZE (700), для HTML-книги и PDF (он рендерится из book.html).
+Ресайз идёт в пуле процессов (IMAGE_DERIVATIVE_WORKERS), каскадом от
+большего размера к меньшему. Результат:
+
+  data/<run_id>/derivatives/<size>/<имя фото>.jpg
+  data/<run_id>/derivatives/index.json — размеры и sha256 исходников и копий
+
+Потребители берут нужный размер через derivative_path() / vision_data_url()
+и не декодируют оригинал повторно; если индекса нет (старые run_id или
+ошибка этапа), возвращается оригинал. Повторный запуск пересчитывает только
+новые или изменившиеся фото.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from app.config import settings
+
+log = logging.getLogger("image_derivatives")
+
+DERIVATIVES_DIRNAME = "derivatives"
+INDEX_NAME = "index.json"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+QUALITY = {"vision": 85, "web": 90}
+
+
+def sizes() -> Dict[str, int]:
+    return {
+        "web": settings.IMAGE_WEB_SIZE,
+        "vision": settings.VISION_IMAGE_SIZE,
+    }
+
+
+# ─────────────── код процесса пула ─────────────────────────────────────────
+def _derive_one(source: str, out_dir: str, size_map: Dict[str, int]) -> Dict:
+    """Декодирует фото один раз и пишет все размеры, от большего к меньшему."""
+    src = Path(source)
+    data = src.read_bytes()
+    entry = {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data), "derivatives": {}}
+    with Image.open(BytesIO(data)) as original:
+        img = ImageOps.exif_transpose(original).convert("RGB")
+    entry["width"], entry["height"] = img.size
+
+    for name, max_side in sorted(size_map.items(), key=lambda kv: -kv[1]):
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=QUALITY.get(name, 88))
+        payload = buffer.getvalue()
+        target = Path(out_dir) / name / f"{src.stem}.jpg"
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(payload)
+        os.replace(tmp, target)
+        entry["derivatives"][name] = {
+            "path": f"{name}/{target.name}",
+            "width": img.width,
+            "height": img.height,
+            "sha256": hashlib.sha256(payload).hexdigest(),
+        }
+    return entry
+
+
+# ─────────────── сторона родителя ──────────────────────────────────────────
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_index_cache: Dict[str, Tuple[float, Dict]] = {}
+_index_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _index_path(run_dir: Path) -> Path:
+    return run_dir / DERIVATIVES_DIRNAME / INDEX_NAME
+
+
+def load_index(run_dir: Path) -> Dict:
+    """Индекс производных run_id ({} если этап ещё не выполнялся); кэшируется по mtime."""
+    path = _index_path(run_dir)
+    try:
+        mtime = path.stat().st_mtime
+    except FileNotFoundError:
+        return {}
+    key = str(path)
+    with _index_lock:
+        cached = _index_cache.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    try:
+        index = json.loads(path.read_text(encoding="utf-8"))
+    except ValueError:
+        return {}
+    with _index_lock:
+        _index_cache[key] = (mtime, index)
+    return index
+
+
+def _write_index(run_dir: Path, index: Dict):
+    path = _index_path(run_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{INDEX_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+async def async_build_derivatives(run_dir: Path) -> Dict:
+    """Этап «производные фото»: считает недостающие размеры и обновляет индекс."""
+    images_dir = run_dir / "images"
+    out_dir = run_dir / DERIVATIVES_DIRNAME
+    size_map = sizes()
+    previous = load_index(run_dir)
+    images = dict(previous.get("images", {})) if previous.get("sizes") == size_map else {}
+
+    todo = []
+    for path in sorted(images_dir.glob("*")) if images_dir.exists() else []:
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        known = images.get(path.name)
+        if known and known.get("size") == path.stat().st_size:
+            continue
+        todo.append(path)
+
+    if todo:
+        loop = asyncio.get_running_loop()
+        executor = _get_executor()
+        results = await asyncio.gather(
+            *[loop.run_in_executor(executor, _derive_one, str(p), str(out_dir), size_map) for p in todo],
+            return_exceptions=True,
+        )
+        for path, result in zip(todo, results):
+            if isinstance(result, BaseException):
+                log.warning("derivatives: не удалось обработать %s: %s", path.name, result)
+                images.pop(path.name, None)
+            else:
+                images[path.name] = result
+
+    index = {"version": 1, "sizes": size_map, "images": images}
+    if todo or index != previous:
+        _write_index(run_dir, index)
+    log.info("derivatives for %s: %s images (%s new)", run_dir.name, len(images), len(todo))
+    return index
+
+
+def derivative_path(image_path: Path, size: str) -> Path:
+    """Путь к производной нужного размера; оригинал, если её нет."""
+    run_dir = image_path.parent.parent
+    entry = load_index(run_dir).get("images", {}).get(image_path.name)
+    if entry and size in entry["derivatives"]:
+        path = run_dir / DERIVATIVES_DIRNAME / entry["derivatives"][size]["path"]
+        if path.exists():
+            return path
+    return image_path
+
+
+def vision_data_url(image_path: Optional[Path], max_side: Optional[int] = None) -> str:
+    """data URL (JPEG) для vision-запроса: готовая производная читается без
+    декодирования; без неё — уменьшаем оригинал на месте."""
+    if not image_path or not image_path.exists():
+        return ""
+    max_side = max_side or settings.VISION_IMAGE_SIZE
+    try:
+        derived = derivative_path(image_path, "vision")
+        if derived != image_path and max_side == settings.VISION_IMAGE_SIZE:
+            payload = derived.read_bytes()
+        else:
+            with Image.open(image_path) as img:
+                img = img.convert("RGB")
+                img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+                buffer = BytesIO()
+                img.save(buffer, format="JPEG", quality=QUALITY["vision"])
+            payload = buffer.getvalue()
+        return f"data:image/jpeg;base64,{base64.b64encode(payload).decode()}"
+    except Exception as e:
+        log.warning("vision: не удалось подготовить %s: %s", image_path, e)
+        return ""
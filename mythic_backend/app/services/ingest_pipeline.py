@@ -0,0 +1,92 @@
+# app/services/ingest_pipeline.py
+"""Приём данных Apify: вебхук только ставит задачу, работа — в воркере.
+
+Раньше вебхук сам ждал fetch_run и чтение датасета, и Apify мог не дождаться
+ответа и прислать вебхук повторно. Теперь:
+  ▸ claim_webhook() — хранилище идемпотентности: Redis SET NX с TTL
+    (WEBHOOK_DEDUP_TTL), без Redis — память процесса. Повторная доставка
+    того же runId ничего не запускает;
+  ▸ задача очереди ``ingest`` (или фоновая задача API без Redis) читает
+    датасет в posts.ndjson, отмечает data_collected и выполняет этап загрузки
+    фото; прогресс виден в статусе run_id (этап ``ingesting``);
+  ▸ принятый датасет попадает в кэш скрапинга (app/services/scrape_cache.py).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import settings
+from app.services import posts_store, run_manifest, scrape_cache
+from app.services.apify_client import fetch_run, iter_item_pages
+from app.services.downloader import start_download
+from app.services.job_queue import final_attempt, get_redis, register_handler
+from app.services.progress import failure_stage, publish
+
+log = logging.getLogger("ingest")
+
+DEDUP_PREFIX = "mythic:webhook"
+_LOCAL_MAX = 10000
+# runId → момент, до которого повтор вебхука игнорируется (фоллбэк без Redis)
+_local_seen: "OrderedDict[str, float]" = OrderedDict()
+
+
+def _claim_local(run_id: str) -> bool:
+    now = time.monotonic()
+    expires = _local_seen.get(run_id)
+    if expires is not None and expires > now:
+        return False
+    _local_seen[run_id] = now + settings.WEBHOOK_DEDUP_TTL
+    _local_seen.move_to_end(run_id)
+    while len(_local_seen) > _LOCAL_MAX:
+        _local_seen.popitem(last=False)
+    return True
+
+
+async def claim_webhook(run_id: str) -> bool:
+    """True — вебхук для run_id пришёл впервые; False — повторная доставка."""
+    try:
+        return bool(await get_redis().set(f"{DEDUP_PREFIX}:{run_id}", int(time.time()),
+                                          nx=True, ex=settings.WEBHOOK_DEDUP_TTL))
+    except Exception as e:
+        log.warning("idempotency store: Redis недоступен (%s), проверка в памяти процесса", e)
+        return _claim_local(run_id)
+
+
+async def ingest_run(run_id: str, dataset_id: Optional[str] = None):
+    """Этап приёма: датасет → posts.ndjson → data_collected → загрузка фото."""
+    publish(run_id, "ingesting", message="Получаю данные профиля")
+    try:
+        if not dataset_id:
+            run = await fetch_run(run_id)
+            dataset_id = run.get("defaultDatasetId")
+        if not dataset_id:
+            raise RuntimeError("datasetId unresolved")
+
+        # Датасет читается страницами и сразу пишется в posts.ndjson
+        run_dir = run_manifest.run_dir(run_id)
+        ingested = await posts_store.ingest(run_dir, iter_item_pages(dataset_id))
+    except Exception as e:
+        log.error("ingest %s failed: %s", run_id, e)
+        # failed — только если очередь больше не повторит задачу
+        publish(run_id, failure_stage(final_attempt()), message=f"Не удалось получить данные профиля: {e}")
+        raise
+
+    profile = [ingested["profile"]] if ingested["profile"] else []
+    manifest = run_manifest.mark_stage(run_id, "data_collected", profile=run_manifest.profile_summary(profile))
+    publish(run_id, "data_collected", message="Данные профиля получены", items=ingested["items"])
+    # Следующий /start-scrape того же профиля возьмёт данные отсюда
+    if manifest.get("scrapeKey") and ingested["items"]:
+        await scrape_cache.remember(manifest["scrapeKey"], run_id)
+
+    # Загрузка фото — в этом же процессе; сборка дождётся её через wait_for_download
+    await start_download(run_id)
+    log.info("ingest for %s completed: %s items", run_id, ingested["items"])
+
+
+@register_handler("ingest")
+async def handle_ingest_job(payload: dict):
+    """Обработчик задачи очереди ``ingest``."""
+    await ingest_run(payload["run_id"], payload.get("dataset_id"))
@@ -0,0 +1,289 @@
+# app/services/job_queue.py
+"""Очередь задач сборки книг поверх Redis.
+
+Доставка «как минимум один раз»:
+  ▸ enqueue() кладёт id задачи в список ``queue``, тело — в хэш ``jobs``;
+  ▸ воркер атомарно перекладывает id в ``processing`` (BLMOVE), затем берёт «аренду»
+    (zset ``leases``: id → дедлайн). Пока задача выполняется, аренда продлевается;
+  ▸ если воркер умер, reaper по истечении аренды возвращает задачу в очередь.
+    Перекладывание и аренда — два запроса: задачу в ``processing`` без аренды
+    (воркер умер между ними) reaper сам берёт в аренду (Lua-скрипт, атомарно
+    с проверкой processing), и она тоже вернётся в очередь по истечении;
+  ▸ упавшая задача повторяется с задержкой (zset ``delayed``), после
+    JOB_MAX_RETRIES попыток уходит в dead-letter список ``dead``. Истёкшая
+    аренда — тоже попытка: задача, которая роняет воркер, не ходит по кругу. Обработчик
+    узнаёт, последняя ли это попытка, через final_attempt() — окончательную
+    ошибку клиенту сообщают только тогда.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from app.config import settings
+
+log = logging.getLogger("jobs")
+
+PREFIX = "mythic:jobs"
+QUEUE_KEY = f"{PREFIX}:queue"
+PROCESSING_KEY = f"{PREFIX}:processing"
+LEASES_KEY = f"{PREFIX}:leases"
+DELAYED_KEY = f"{PREFIX}:delayed"
+DEAD_KEY = f"{PREFIX}:dead"
+JOBS_KEY = f"{PREFIX}:data"
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# kind → coroutine(payload); заполняется через @register_handler
+_handlers: Dict[str, JobHandler] = {}
+_redis: Optional[aioredis.Redis] = None
+# Последняя ли попытка выполняемой задачи; вне воркера (фоновая задача API) — повторов нет
+_final_attempt: contextvars.ContextVar[bool] = contextvars.ContextVar("job_final_attempt", default=True)
+
+
+def get_redis() -> aioredis.Redis:
+    """Общий async-клиент Redis (ленивая инициализация)."""
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def final_attempt() -> bool:
+    """True — если текущая задача упадёт, повтора не будет (или она выполняется не из очереди)."""
+    return _final_attempt.get()
+
+
+def register_handler(kind: str):
+    """Декоратор: регистрирует обработчик задач данного типа."""
+    def decorator(func: JobHandler) -> JobHandler:
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+async def enqueue(kind: str, payload: Dict[str, Any]) -> str:
+    """Ставит задачу в очередь и возвращает её id."""
+    r = get_redis()
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "payload": payload,
+        "attempts": 0,
+        "enqueued_at": time.time(),
+    }
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(JOBS_KEY, job_id, json.dumps(job, ensure_ascii=False))
+        pipe.lpush(QUEUE_KEY, job_id)
+        await pipe.execute()
+    log.info("enqueued job %s kind=%s", job_id, kind)
+    return job_id
+
+
+async def queue_stats() -> Dict[str, int]:
+    """Глубина очередей — для /health и мониторинга."""
+    r = get_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.llen(QUEUE_KEY)
+        pipe.llen(PROCESSING_KEY)
+        pipe.zcard(DELAYED_KEY)
+        pipe.llen(DEAD_KEY)
+        queued, processing, delayed, dead = await pipe.execute()
+    return {"queued": queued, "processing": processing, "delayed": delayed, "dead": dead}
+
+
+async def _load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    raw = await get_redis().hget(JOBS_KEY, job_id)
+    return json.loads(raw) if raw else None
+
+
+async def _ack(job_id: str):
+    """Задача выполнена — убираем все её следы."""
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.lrem(PROCESSING_KEY, 1, job_id)
+        pipe.zrem(LEASES_KEY, job_id)
+        pipe.hdel(JOBS_KEY, job_id)
+        await pipe.execute()
+
+
+def _schedule_retry(pipe, job: Dict[str, Any], error: str):
+    """Добавляет в транзакцию pipe учёт попытки: повтор с экспоненциальной
+    задержкой или перенос в dead-letter после JOB_MAX_RETRIES."""
+    job_id = job["id"]
+    job["attempts"] = job.get("attempts", 0) + 1
+    job["last_error"] = error[:500]
+    pipe.hset(JOBS_KEY, job_id, json.dumps(job, ensure_ascii=False))
+    if job["attempts"] > settings.JOB_MAX_RETRIES:
+        pipe.lpush(DEAD_KEY, job_id)
+        log.error("job %s moved to dead-letter after %s attempts: %s",
+                  job_id, job["attempts"], error)
+    else:
+        delay = settings.JOB_RETRY_BACKOFF * (2 ** (job["attempts"] - 1))
+        pipe.zadd(DELAYED_KEY, {job_id: time.time() + delay})
+        log.warning("job %s failed (attempt %s), retry in %.0fs: %s",
+                    job_id, job["attempts"], delay, error)
+
+
+async def _fail(job: Dict[str, Any], error: str):
+    """Повтор с экспоненциальной задержкой или перенос в dead-letter."""
+    job_id = job["id"]
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.lrem(PROCESSING_KEY, 1, job_id)
+        pipe.zrem(LEASES_KEY, job_id)
+        _schedule_retry(pipe, job, error)
+        await pipe.execute()
+
+
+# Аренда каждой задаче в processing, у которой её нет. Скрипт выполняется
+# атомарно, поэтому задача, которую только что подтвердили (_ack) или
+# отложили (_fail), уже не в processing и аренду не получит.
+_LEASE_ORPHANS_LUA = """
+local deadline = ARGV[1]
+local leased = 0
+for _, job_id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if not redis.call('ZSCORE', KEYS[2], job_id) then
+        redis.call('ZADD', KEYS[2], deadline, job_id)
+        leased = leased + 1
+    end
+end
+return leased
+"""
+_lease_orphans = None
+
+
+async def _expire_lease(r: aioredis.Redis, job_id: str, now: float):
+    """Аренда job_id истекла: воркер умер или завис — это попытка, как и ошибка.
+
+    WATCH по leases: если за это время аренду продлили, задачу подтвердили
+    или отложили (все они меняют leases), транзакция не выполнится.
+    """
+    async with r.pipeline(transaction=True) as pipe:
+        for _ in range(3):
+            try:
+                await pipe.watch(LEASES_KEY)
+                deadline = await pipe.zscore(LEASES_KEY, job_id)
+                if deadline is None or deadline > now:
+                    await pipe.reset()
+                    return
+                raw = await pipe.hget(JOBS_KEY, job_id)
+                pipe.multi()
+                pipe.zrem(LEASES_KEY, job_id)
+                pipe.lrem(PROCESSING_KEY, 1, job_id)
+                if raw:
+                    _schedule_retry(pipe, json.loads(raw), "lease expired")
+                await pipe.execute()
+                return
+            except WatchError:
+                continue  # leases изменились (например, чужой heartbeat) — проверяем заново
+
+
+async def _requeue_expired():
+    """Возвращает в очередь задачи с истёкшей арендой и созревшие отложенные."""
+    global _lease_orphans
+    r = get_redis()
+    now = time.time()
+
+    # Задачи в processing без аренды (воркер умер между BLMOVE и ZADD)
+    # получают её и вернутся в очередь по истечении
+    if _lease_orphans is None:
+        _lease_orphans = r.register_script(_LEASE_ORPHANS_LUA)
+    await _lease_orphans(keys=[PROCESSING_KEY, LEASES_KEY],
+                         args=[now + settings.JOB_VISIBILITY_TIMEOUT])
+
+    for job_id in await r.zrangebyscore(LEASES_KEY, "-inf", now):
+        await _expire_lease(r, job_id, now)
+
+    for job_id in await r.zrangebyscore(DELAYED_KEY, "-inf", now):
+        if await r.zrem(DELAYED_KEY, job_id):
+            await r.lpush(QUEUE_KEY, job_id)
+
+
+# ─────────────────── воркер ────────────────────────────────────────────────
+class Worker:
+    """Пул из ``concurrency`` корутин, забирающих задачи из Redis."""
+
+    def __init__(self, concurrency: int | None = None, poll_timeout: int = 5):
+        self.concurrency = concurrency or settings.WORKER_CONCURRENCY
+        self.poll_timeout = poll_timeout
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def _heartbeat(self, job_id: str):
+        """Продлеваем аренду, пока задача выполняется."""
+        interval = max(settings.JOB_VISIBILITY_TIMEOUT / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            await get_redis().zadd(
+                LEASES_KEY, {job_id: time.time() + settings.JOB_VISIBILITY_TIMEOUT}, xx=True
+            )
+
+    async def _process(self, job_id: str):
+        job = await _load_job(job_id)
+        if not job:
+            await _ack(job_id)
+            return
+
+        handler = _handlers.get(job["kind"])
+        if handler is None:
+            await _fail(job, f"no handler for kind '{job['kind']}'")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        final = _final_attempt.set(job.get("attempts", 0) >= settings.JOB_MAX_RETRIES)
+        try:
+            await handler(job["payload"])
+        except Exception as e:
+            log.exception("job %s (%s) raised", job_id, job["kind"])
+            await _fail(job, repr(e))
+        else:
+            await _ack(job_id)
+            log.info("job %s (%s) done", job_id, job["kind"])
+        finally:
+            _final_attempt.reset(final)
+            heartbeat.cancel()
+
+    async def _consume(self, slot: int):
+        r = get_redis()
+        while not self._stopping.is_set():
+            try:
+                job_id = await r.blmove(QUEUE_KEY, PROCESSING_KEY, self.poll_timeout, "RIGHT", "LEFT")
+                if not job_id:
+                    continue
+                await r.zadd(LEASES_KEY, {job_id: time.time() + settings.JOB_VISIBILITY_TIMEOUT})
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("worker slot %s error: %s", slot, e)
+                await asyncio.sleep(1)
+
+    async def _reaper(self):
+        while not self._stopping.is_set():
+            try:
+                await _requeue_expired()
+            except Exception as e:
+                log.error("reaper error: %s", e)
+            await asyncio.sleep(5)
+
+    async def run(self):
+        log.info("worker started: concurrency=%s", self.concurrency)
+        tasks = [asyncio.create_task(self._consume(i)) for i in range(self.concurrency)]
+        tasks.append(asyncio.create_task(self._reaper()))
+        await self._stopping.wait()
+        # Даём текущим итерациям BLMOVE завершиться; незавершённые задачи
+        # вернутся в очередь по истечении аренды.
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        log.info("worker stopped")
@@ -0,0 +1,267 @@
+# app/services/llm_cache.py
+"""Кэш ответов LLM с адресацией по содержимому запроса.
+
+Ключ — sha256 от (deployment, system prompt, prompt, дайджест изображения,
+temperature, max_tokens), поэтому повторная сборка того же профиля (другой
+формат, повторный PDF) не платит за одинаковые запросы ещё раз.
+
+Бэкенды (LLM_CACHE_BACKEND):
+  ▸ memory — LRU в памяти процесса;
+  ▸ sqlite — файл на диске, общий для процессов одной машины (в docker-compose
+    каталог cache/ — общий том API и воркеров);
+  ▸ redis  — общий для API и всех воркеров;
+  ▸ off    — кэш выключен.
+Все бэкенды ограничены LLM_CACHE_MAX_ENTRIES (вытесняются давно не читанные)
+и LLM_CACHE_TTL. Запросы с temperature выше LLM_CACHE_MAX_TEMPERATURE не
+кэшируются — там разнообразие ответов важнее экономии.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from app.config import settings
+from app.services.llm_gateway import llm_gateway
+
+logger = logging.getLogger("llm_cache")
+
+
+def make_key(deployment: str, system_prompt: str | None, prompt: str, image_digest: str | None,
+             temperature: float, max_tokens: int) -> str:
+    """Ключ кэша: хэш всех параметров, от которых зависит ответ модели."""
+    raw = json.dumps(
+        [deployment, system_prompt or "", prompt, image_digest or "", round(temperature, 3), max_tokens],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def digest(data: str | bytes | None) -> str | None:
+    """Дайджест изображения (data URL или сырые байты) для ключа кэша."""
+    if not data:
+        return None
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+# ─────────────── бэкенды ───────────────────────────────────────────────────
+class MemoryBackend:
+    """LRU в памяти процесса."""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str):
+        self._data[key] = (time.time() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def size(self) -> int:
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """Кэш в SQLite; запросы выполняются в потоке, чтобы не блокировать loop."""
+
+    def __init__(self, path: Path, max_entries: int, ttl: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache(accessed_at)")
+            self._conn = conn
+        return self._conn
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if row[1] < now:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return row[0]
+
+    def _set(self, key: str, value: str):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            overflow = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            conn.commit()
+
+    def _size(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str):
+        await asyncio.to_thread(self._set, key, value)
+
+    async def size(self) -> int:
+        return await asyncio.to_thread(self._size)
+
+
+class RedisBackend:
+    """Кэш в Redis: значение с EX = TTL + zset времени доступа для LRU-вытеснения."""
+
+    PREFIX = "mythic:llm_cache"
+
+    def __init__(self, url: str, max_entries: int, ttl: int):
+        import redis.asyncio as aioredis
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._lru_key = f"{self.PREFIX}:lru"
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._redis.get(f"{self.PREFIX}:{key}")
+        if value is None:
+            await self._redis.zrem(self._lru_key, key)
+            return None
+        await self._redis.zadd(self._lru_key, {key: time.time()})
+        return value
+
+    async def set(self, key: str, value: str):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.set(f"{self.PREFIX}:{key}", value, ex=self.ttl)
+            pipe.zadd(self._lru_key, {key: time.time()})
+            pipe.zcard(self._lru_key)
+            *_, count = await pipe.execute()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            stale = await self._redis.zpopmin(self._lru_key, overflow)
+            if stale:
+                await self._redis.delete(*[f"{self.PREFIX}:{k}" for k, _ in stale])
+                self.evictions += len(stale)
+
+    async def size(self) -> int:
+        return await self._redis.zcard(self._lru_key)
+
+
+def _create_backend():
+    kind = settings.LLM_CACHE_BACKEND.lower()
+    if kind == "off":
+        return None
+    if kind == "redis":
+        return RedisBackend(settings.REDIS_URL, settings.LLM_CACHE_MAX_ENTRIES, settings.LLM_CACHE_TTL)
+    if kind == "sqlite":
+        return SQLiteBackend(Path(settings.LLM_CACHE_PATH), settings.LLM_CACHE_MAX_ENTRIES, settings.LLM_CACHE_TTL)
+    return MemoryBackend(settings.LLM_CACHE_MAX_ENTRIES, settings.LLM_CACHE_TTL)
+
+
+# ─────────────── фасад ─────────────────────────────────────────────────────
+class LLMCache:
+    """Обёртка над бэкендом со счётчиками. Операции выполняются на loop
+    LLM-шлюза — так async-клиенты бэкендов всегда работают в одном loop."""
+
+    def __init__(self):
+        self._backend = None
+        self._initialized = False
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "skipped": 0, "errors": 0}
+
+    @property
+    def backend(self):
+        if not self._initialized:
+            try:
+                self._backend = _create_backend()
+            except Exception as e:
+                logger.warning("LLM-кэш недоступен (%s): %s", settings.LLM_CACHE_BACKEND, e)
+                self._backend = None
+            self._initialized = True
+        return self._backend
+
+    def enabled_for(self, temperature: float) -> bool:
+        """Высокотемпературные (творческие) запросы не кэшируем."""
+        if self.backend is None:
+            return False
+        if temperature > settings.LLM_CACHE_MAX_TEMPERATURE:
+            self.stats["skipped"] += 1
+            return False
+        return True
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await llm_gateway.submit(self.backend.get(key))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning("LLM-кэш: ошибка чтения: %s", e)
+            value = None
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        try:
+            await llm_gateway.submit(self.backend.set(key, value))
+            self.stats["stores"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning("LLM-кэш: ошибка записи: %s", e)
+
+    def metrics(self) -> Dict[str, object]:
+        backend = self.backend
+        return {
+            "backend": settings.LLM_CACHE_BACKEND if backend is not None else "off",
+            "evictions": getattr(backend, "evictions", 0),
+            **self.stats,
+        }
+
+
+llm_cache = LLMCache()
@@ -1,26 +1,17 @@
+import asyncio
 import base64
 from pathlib import Path
 from app.config import settings
 from typing import Optional
 import logging
 import random
-from openai import AzureOpenAI, AsyncAzureOpenAI
 import json
 import markdown
 
-# Инициализация синхронного клиента
-client = AzureOpenAI(
-    api_key=settings.AZURE_OPENAI_API_KEY,
-    azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-    api_version=settings.AZURE_OPENAI_API_VERSION
-)
-
-# Инициализация АСИНХРОННОГО клиента для новых функций
-async_client = AsyncAzureOpenAI(
-    api_key=settings.AZURE_OPENAI_API_KEY,
-    azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-    api_version=settings.AZURE_OPENAI_API_VERSION
-)
+# Все запросы к Azure идут через общий шлюз: один пул соединений и общие лимиты
+from app.services.llm_gateway import llm_gateway
+from app.services.llm_cache import llm_cache, make_key, digest
+from app.services.image_derivatives import vision_data_url
 
 logger = logging.getLogger(__name__)
 
@@ -123,9 +114,10 @@ async def generate_flipbook_json(image_paths: list[str]) -> dict:
 
     # 3. Вызываем Azure OpenAI API с `function_call`
     try:
-        response = await async_client.chat.completions.create(
-            model=settings.AZURE_OPENAI_GPT4_DEPLOYMENT, # Используем мощную модель для креатива
-            messages=messages,
+        response = await llm_gateway.create(
+            messages,
+            deployment=settings.AZURE_OPENAI_GPT4_DEPLOYMENT, # Используем мощную модель для креатива
+            max_tokens=4000,
             functions=functions,
             function_call={"name": "build_flipbook"}, # Принудительно вызываем нашу функцию
             temperature=0.8
@@ -160,17 +152,26 @@ async def generate_flipbook_json(image_paths: list[str]) -> dict:
         # В случае ошибки, можно вернуть пустую структуру, чтобы приложение не падало
         return {"prologue": "Что-то пошло не так...", "pages": []}
 
-def generate_text(prompt: str,
-                  system_prompt: str | None = None,   # <-- add system_prompt param
-                  model: str = "gpt-4.1-mini",
-                  max_tokens: int = 1500,
-                  temperature: float = 0.8,
-                  image_data: Optional[str] = None) -> str:
-    """Генерирует текст с помощью Azure OpenAI API (только GPT-4o), с поддержкой изображений"""
+async def async_generate_text(prompt: str,
+                              system_prompt: str | None = None,
+                              model: str = "gpt-4.1-mini",
+                              max_tokens: int = 1500,
+                              temperature: float = 0.8,
+                              image_data: Optional[str] = None,
+                              cache: bool = True) -> str:
+    """Генерирует текст с помощью Azure OpenAI API (только GPT-4o), с поддержкой изображений.
+    Ответы кэшируются (llm_cache); cache=False — всегда новый ответ."""
+    deployment = settings.AZURE_OPENAI_GPT4_DEPLOYMENT
+    # Нейтральная система по умолчанию
+    fast_system_message = system_prompt or "Ты — современный рассказчик. Пиши ясно, интересно, без клише."
+    use_cache = cache and llm_cache.enabled_for(temperature)
+    if use_cache:
+        cache_key = make_key(deployment, None if image_data else fast_system_message,
+                             prompt, digest(image_data), temperature, max_tokens)
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
     try:
-        deployment = settings.AZURE_OPENAI_GPT4_DEPLOYMENT
-        # Нейтральная система по умолчанию
-        fast_system_message = system_prompt or "Ты — современный рассказчик. Пиши ясно, интересно, без клише."
         if image_data:
             messages = [
                 {
@@ -187,19 +188,19 @@ def generate_text(prompt: str,
                     ]
                 }
             ]
-            response = client.chat.completions.create(
-                model=deployment,
-                messages=messages,
+            response = await llm_gateway.create(
+                messages,
+                deployment=deployment,
                 max_tokens=max_tokens,
                 temperature=temperature
             )
         else:
-            response = client.chat.completions.create(
-                model=deployment,
-                messages=[
+            response = await llm_gateway.create(
+                [
                     {"role": "system", "content": fast_system_message},
                     {"role": "user", "content": prompt}
                 ],
+                deployment=deployment,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 presence_penalty=0.3,
@@ -208,20 +209,40 @@ def generate_text(prompt: str,
         result = response.choices[0].message.content
         if not result:
             return ""
-        return strip_cliches(result.strip())
+        text = strip_cliches(result.strip())
+        if use_cache:
+            await llm_cache.set(cache_key, text)
+        return text
     except Exception as e:
         logger.error(f"Ошибка в generate_text: {e}")
         return f"Этот момент наполнен особой красотой и теплом. Каждая деталь говорит о твоей уникальности."
 
 
-def analyze_photo_for_memoir(image_path: Path, context: str = "", chapter_focus: str = "general") -> str:
+def generate_text(prompt: str,
+                  system_prompt: str | None = None,   # <-- add system_prompt param
+                  model: str = "gpt-4.1-mini",
+                  max_tokens: int = 1500,
+                  temperature: float = 0.8,
+                  image_data: Optional[str] = None,
+                  cache: bool = True) -> str:
+    """Синхронная обёртка над async_generate_text для сборщиков в потоках"""
+    return llm_gateway.run_sync(async_generate_text(
+        prompt, system_prompt=system_prompt, model=model,
+        max_tokens=max_tokens, temperature=temperature, image_data=image_data, cache=cache,
+    ))
+
+
+async def async_analyze_photo_for_memoir(image_path: Path, context: str = "", chapter_focus: str = "general") -> str:
     """Анализирует фотографию для мемуарного повествования"""
     try:
         if not image_path.exists():
             return "В памяти остался лишь размытый силуэт..."
             
-        with open(image_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+        # Фото 512px (производная vision) вместо оригинала в полном разрешении
+        image_url = await asyncio.to_thread(vision_data_url, image_path)
+        if not image_url:
+            return "В памяти остался лишь размытый силуэт..."
+        image_data = image_url.split(",", 1)[1]
         
         # Фокусы для разных глав
         chapter_styles = {
@@ -265,9 +286,16 @@ def analyze_photo_for_memoir(image_path: Path, context: str = "", chapter_focus:
 Пиши романтично и поэтично, но искренне.
 Избегай клише!"""
 
-        response = client.chat.completions.create(
-            model=settings.AZURE_OPENAI_GPT4_DEPLOYMENT,
-            messages=[
+        use_cache = llm_cache.enabled_for(0.9)
+        if use_cache:
+            cache_key = make_key(settings.AZURE_OPENAI_GPT4_DEPLOYMENT, None, prompt,
+                                 digest(image_data), 0.9, 300)
+            cached = await llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        response = await llm_gateway.create(
+            [
                 {
                     "role": "user",
                     "content": [
@@ -275,26 +303,41 @@ def analyze_photo_for_memoir(image_path: Path, context: str = "", chapter_focus:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}",
-                                "detail": "high"
+                                "url": image_url,
+                                "detail": "low"
                             }
                         }
                     ]
                 }
             ],
+            deployment=settings.AZURE_OPENAI_GPT4_DEPLOYMENT,
             max_tokens=300,
             temperature=0.9
         )
         
-        result = response.choices[0].message.content.strip()
-        return strip_cliches(result)
+        result = strip_cliches(response.choices[0].message.content.strip())
+        if use_cache:
+            await llm_cache.set(cache_key, result)
+        return result
         
     except Exception as e:
         logger.error(f"Ошибка анализа фото {image_path}: {e}")
         return f"Память сохранила лишь ощущение света и тепла..."
 
 
+def analyze_photo_for_memoir(image_path: Path, context: str = "", chapter_focus: str = "general") -> str:
+    """Синхронная обёртка над async_analyze_photo_for_memoir"""
+    return llm_gateway.run_sync(async_analyze_photo_for_memoir(image_path, context, chapter_focus))
+
+
 def generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str = "", temperature: float = 0.8, max_tokens: int = 1200) -> str:
+    """Синхронная обёртка над async_generate_memoir_chapter"""
+    return llm_gateway.run_sync(async_generate_memoir_chapter(
+        chapter_type, data, photo_analysis, temperature=temperature, max_tokens=max_tokens
+    ))
+
+
+async def async_generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str = "", temperature: float = 0.8, max_tokens: int = 1200) -> str:
     """Генерирует главу мемуаров по конкретной структуре"""
     
     # Проверяем, передан ли готовый промпт в данных
@@ -303,7 +346,7 @@ def generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str =
         prompt = data["prompt"]
         
         # НЕ обрезаем промпты с пословицами - они уже оптимизированы
-        result = generate_text(prompt, max_tokens=max_tokens, temperature=temperature)  # Увеличиваем для качественных текстов
+        result = await async_generate_text(prompt, max_tokens=max_tokens, temperature=temperature)  # Увеличиваем для качественных текстов
         return strip_cliches(result)
     
     # Поддержка фэнтези стиля
@@ -312,7 +355,7 @@ def generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str =
         sys_prompt = data.get("system_prompt")  # <-- extract system_prompt if present
         
         # НЕ обрезаем промпты с пословицами - они уже оптимизированы
-        result = generate_text(
+        result = await async_generate_text(
             prompt, 
             system_prompt=sys_prompt,            # <-- pass system_prompt
             max_tokens=max_tokens, 
@@ -324,7 +367,7 @@ def generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str =
     if chapter_type == "humor_chapter" and "prompt" in data:
         prompt = data["prompt"]
         sys_prompt = data.get("system_prompt")  # <-- extract system_prompt if present
-        result = generate_text(
+        result = await async_generate_text(
             prompt,
             system_prompt=sys_prompt,            # <-- pass system_prompt
             max_tokens=max_tokens,
@@ -479,7 +522,7 @@ def generate_memoir_chapter(chapter_type: str, data: dict, photo_analysis: str =
     # Качественная генерация с увеличенными параметрами
     try:
         prompt = detailed_prompts.get(chapter_type, f"Напиши развернуто и романтично о {chapter_type.replace('_', ' ')}.")
-        result = generate_text(prompt, max_tokens=1200, temperature=0.8)  # Увеличиваем для качественных текстов
+        result = await async_generate_text(prompt, max_tokens=1200, temperature=0.8)  # Увеличиваем для качественных текстов
         
         # Проверяем качество результата
         if len(result.strip()) < 200:  # Если слишком короткий ответ
@@ -497,19 +540,25 @@ def generate_complete_memoir_book(data: dict, images: list) -> dict:
     
     username = data.get('username', 'незнакомец')
     
-    # Анализируем фотографии для разных глав
+    # Анализируем фотографии для разных глав — все запросы параллельно
     photo_analyses = []
     if images:
-        for i, img_path in enumerate(images[:10]):  # Максимум 10 фото для анализа
-            if img_path.exists():
-                try:
-                    focus_types = ["first_impression", "story_creation", "hidden_emotions"]
-                    focus = focus_types[i % 3]
-                    analysis = analyze_photo_for_memoir(img_path, f"@{username}", focus)
-                    photo_analyses.append(analysis)
-                except Exception as e:
-                    print(f"❌ Ошибка анализа фото {img_path}: {e}")
-                    photo_analyses.append("Фотография пробуждает особые чувства...")
+        focus_types = ["first_impression", "story_creation", "hidden_emotions"]
+        existing = [img_path for img_path in images[:10] if img_path.exists()]  # Максимум 10 фото для анализа
+
+        async def analyze_all():
+            return await asyncio.gather(
+                *[async_analyze_photo_for_memoir(img_path, f"@{username}", focus_types[i % 3])
+                  for i, img_path in enumerate(existing)],
+                return_exceptions=True,
+            )
+
+        for img_path, analysis in zip(existing, llm_gateway.run_sync(analyze_all())):
+            if isinstance(analysis, Exception):
+                print(f"❌ Ошибка анализа фото {img_path}: {analysis}")
+                photo_analyses.append("Фотография пробуждает особые чувства...")
+            else:
+                photo_analyses.append(analysis)
     
     # Добавляем анализы фото в данные
     data['photo_analyses'] = photo_analyses
@@ -0,0 +1,282 @@
+# app/services/llm_gateway.py
+"""Async-шлюз к Azure OpenAI, через который ходят все стиль-сборщики.
+
+▸ Один AsyncAzureOpenAI на deployment поверх общего httpx-пула с HTTP/2.
+▸ Все запросы исполняются на выделенном event loop в фоновом потоке — так
+  пул соединений и лимиты общие и для корутин, и для синхронных сборщиков,
+  которые работают в потоках build_executor.
+▸ Глобальный семафор + семафор на сборку (build_scope) не дают одной книге
+  занять все слоты.
+▸ Token bucket по RPM/TPM квотам Azure: при всплеске сборок запросы ждут
+  своей очереди, а не получают шторм 429. На 429 все вызовы ставятся на паузу
+  по Retry-After.
+▸ request_timeout() — бюджет времени на весь вызов модели внутри блока,
+  включая повторы. Отсчёт начинается, когда вызов впервые получил семафоры и
+  квоты, поэтому очередь под нагрузкой не превращается в таймаут (в отличие
+  от asyncio.wait_for вокруг вызова); каждая попытка получает остаток бюджета
+  как таймаут HTTP-запроса.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Coroutine, Dict, List, Optional, TypeVar
+
+import httpx
+from openai import AsyncAzureOpenAI, RateLimitError, APIConnectionError, APITimeoutError
+
+from app.config import settings
+
+logger = logging.getLogger("llm_gateway")
+
+T = TypeVar("T")
+
+# id текущей сборки (run_id) — задаётся build_scope() и наследуется потоками build_executor
+current_build: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_current_build", default=None)
+# Бюджет вызова модели, секунд — задаётся request_timeout(); None — только LLM_TIMEOUT на попытку
+current_request_timeout: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "llm_request_timeout", default=None)
+
+
+class TokenBucket:
+    """Простой token bucket: ёмкость — минутная квота, пополнение — равномерно."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = max(per_minute, 1.0)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        """Коррекция после ответа: списываем/возвращаем разницу с оценкой."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def drain(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class LLMGateway:
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # Всё ниже живёт только на self._loop
+        self._clients: Dict[str, AsyncAzureOpenAI] = {}
+        self._global_sem: Optional[asyncio.Semaphore] = None
+        self._build_sems: Dict[str, asyncio.Semaphore] = {}
+        self._rpm: Optional[TokenBucket] = None
+        self._tpm: Optional[TokenBucket] = None
+        self._paused_until = 0.0
+        self.stats = {"requests": 0, "rate_limited": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    # ─────────────── фоновый event loop ────────────────────────────────────
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._start_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    thread = threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True)
+                    thread.start()
+                    self._thread = thread
+                    self._loop = loop
+        return self._loop
+
+    def _in_gateway_loop(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    async def submit(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Выполнить корутину на loop шлюза и дождаться результата из любого loop."""
+        if self._in_gateway_loop():
+            return await coro
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def run_sync(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Синхронный вызов для сборщиков, работающих в потоках."""
+        if self._in_gateway_loop():
+            coro.close()
+            raise RuntimeError("run_sync() нельзя вызывать из loop LLM-шлюза")
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    # ─────────────── ресурсы (создаются на loop шлюза) ─────────────────────
+    def _client(self, deployment: str) -> AsyncAzureOpenAI:
+        if deployment not in self._clients:
+            http_client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=settings.LLM_MAX_CONCURRENCY,
+                    max_keepalive_connections=settings.LLM_MAX_CONCURRENCY,
+                ),
+                timeout=httpx.Timeout(settings.LLM_TIMEOUT, connect=10.0),
+            )
+            self._clients[deployment] = AsyncAzureOpenAI(
+                api_key=settings.AZURE_OPENAI_API_KEY,
+                azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                api_version=settings.AZURE_OPENAI_API_VERSION,
+                http_client=http_client,
+                max_retries=0,  # повторы делаем сами, с учётом общих лимитов
+            )
+        return self._clients[deployment]
+
+    def _limits(self):
+        if self._global_sem is None:
+            share = settings.LLM_QUOTA_SHARE
+            self._global_sem = asyncio.Semaphore(settings.LLM_MAX_CONCURRENCY)
+            self._rpm = TokenBucket(settings.AZURE_OPENAI_RPM * share)
+            self._tpm = TokenBucket(settings.AZURE_OPENAI_TPM * share)
+        return self._global_sem, self._rpm, self._tpm
+
+    def _build_semaphore(self, build_id: Optional[str]) -> Optional[asyncio.Semaphore]:
+        if not build_id:
+            return None
+        if build_id not in self._build_sems:
+            self._build_sems[build_id] = asyncio.Semaphore(settings.LLM_PER_BUILD_CONCURRENCY)
+        return self._build_sems[build_id]
+
+    def release_build(self, build_id: str):
+        """Освобождает семафор сборки (вызывается при выходе из build_scope)."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._build_sems.pop, build_id, None)
+
+    # ─────────────── вызов модели ──────────────────────────────────────────
+    @staticmethod
+    def _estimate_tokens(messages: List[dict], max_tokens: int) -> int:
+        total = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                total += len(content) // 3
+            elif isinstance(content, list):
+                for part in content:
+                    if part.get("type") == "text":
+                        total += len(part.get("text", "")) // 3
+                    elif part.get("type") == "image_url":
+                        detail = part.get("image_url", {}).get("detail", "auto")
+                        total += 85 if detail == "low" else 765
+        return total + max_tokens
+
+    async def _complete(self, build_id: Optional[str], deployment: str, messages: List[dict],
+                        max_tokens: int, temperature: float, extra: Dict[str, Any],
+                        budget: Optional[float] = None):
+        global_sem, rpm, tpm = self._limits()
+        build_sem = self._build_semaphore(build_id)
+        estimate = self._estimate_tokens(messages, max_tokens)
+        deadline: Optional[float] = None  # monotonic; с первой попытки, получившей лимиты
+
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            backoff = 0.0
+            if build_sem is not None:
+                await build_sem.acquire()
+            try:
+                async with global_sem:
+                    pause = self._paused_until - time.monotonic()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                    await rpm.acquire(1)
+                    await tpm.acquire(estimate)
+                    request_extra = extra
+                    if budget is not None:
+                        now = time.monotonic()
+                        deadline = deadline if deadline is not None else now + budget
+                        if deadline - now <= 0:
+                            raise TimeoutError(f"бюджет вызова LLM ({budget:.0f}с) исчерпан")
+                        request_extra = {**extra, "timeout": deadline - now}
+                    self.stats["requests"] += 1
+                    response = await self._client(deployment).chat.completions.create(
+                        model=deployment,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        **request_extra,
+                    )
+            except RateLimitError as e:
+                self.stats["rate_limited"] += 1
+                retry_after = 10.0
+                try:
+                    retry_after = float(e.response.headers.get("retry-after", retry_after))
+                except (TypeError, ValueError, AttributeError):
+                    pass
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                rpm.drain()
+                tpm.drain()
+                logger.warning("Azure 429 (попытка %s), пауза %.1fs", attempt + 1, retry_after)
+                if attempt >= settings.LLM_MAX_RETRIES:
+                    raise
+            except (APIConnectionError, APITimeoutError) as e:
+                self.stats["errors"] += 1
+                logger.warning("Сетевая ошибка LLM (попытка %s): %s", attempt + 1, e)
+                if attempt >= settings.LLM_MAX_RETRIES or (deadline is not None and time.monotonic() >= deadline):
+                    raise
+                backoff = min(2 ** attempt, 30)
+            else:
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    self.stats["prompt_tokens"] += usage.prompt_tokens or 0
+                    self.stats["completion_tokens"] += usage.completion_tokens or 0
+                    tpm.adjust((usage.total_tokens or estimate) - estimate)
+                return response
+            finally:
+                if build_sem is not None:
+                    build_sem.release()
+            # Ждём вне семафоров, чтобы не держать слоты других запросов
+            await asyncio.sleep(backoff)
+
+    async def create(self, messages: List[dict], *, max_tokens: int = 1500, temperature: float = 0.8,
+                     deployment: Optional[str] = None, build_id: Optional[str] = None, **extra):
+        """chat.completions.create через общие пул и лимиты; возвращает объект ответа."""
+        return await self.submit(self._complete(
+            build_id or current_build.get(),
+            deployment or settings.AZURE_OPENAI_GPT4_DEPLOYMENT,
+            messages, max_tokens, temperature, extra,
+            budget=current_request_timeout.get(),
+        ))
+
+    async def complete_text(self, messages: List[dict], **kwargs) -> str:
+        """То же, что create(), но возвращает текст первого ответа."""
+        response = await self.create(messages, **kwargs)
+        return (response.choices[0].message.content or "").strip()
+
+
+llm_gateway = LLMGateway()
+
+
+@contextmanager
+def build_scope(build_id: str):
+    """Привязывает все LLM-вызовы внутри блока к семафору сборки build_id."""
+    token = current_build.set(build_id)
+    try:
+        yield
+    finally:
+        current_build.reset(token)
+        llm_gateway.release_build(build_id)
+
+
+@contextmanager
+def request_timeout(seconds: float):
+    """Бюджет каждого LLM-вызова внутри блока, вместе с повторами (ожидание лимитов
+    до первой попытки не считается)."""
+    token = current_request_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        current_request_timeout.reset(token)
@@ -4,14 +4,23 @@ from __future__ import annotations
 
 Задача: получить краткое художественное описание (1-2 предложения)
 и эмоцию/настроение по входным данным о медиа.
-Использует Azure OpenAI через общий llm_client.generate_text().
+Использует Azure OpenAI через общий LLM-шлюз.
+
+Пакетный анализ (analyze_media_batch) берёт фото размера VISION_IMAGE_SIZE
+(готовые производные из app/services/image_derivatives.py) и отправляет по VISION_BATCH_SIZE штук в одном multi-image запросе; пакеты
+выполняются параллельно, результаты сопоставляются с фото по номеру.
 """
 
-import base64
+import asyncio
+import json
+import re
 from pathlib import Path
 from typing import List
 from pydantic import BaseModel, Field
-from app.services.llm_client import generate_text
+from app.config import settings
+from app.services.llm_client import async_generate_text
+from app.services.llm_gateway import llm_gateway
+from app.services.image_derivatives import vision_data_url
 
 class MediaAnalysisRequest(BaseModel):
     image_path: Path | None = Field(default=None, description="Путь к изображению-постеру или превью видео (может быть None)")
@@ -24,30 +33,29 @@ class MediaAnalysisResult(BaseModel):
     mood: str
 
 
-def _load_image_as_base64(path: Path | None) -> str:
-    """Utility: loads image file and returns base64 string or empty on failure"""
-    if not path:
-        return ""
-    try:
-        data = path.read_bytes() if path and path.exists() else b""
-        return base64.b64encode(data).decode()
-    except Exception:
-        return ""
+def _load_image_for_vision(path: Path | None, max_side: int | None = None) -> str:
+    """data URL (JPEG) фото для vision: готовая производная 512px, иначе ресайз оригинала"""
+    return vision_data_url(path, max_side)
 
 
-def analyze_media_item(req: MediaAnalysisRequest, max_tokens: int = 80) -> MediaAnalysisResult:
-    """Synchronous helper that sends a single analysis request to LLM.
+def _fallback_result(req: MediaAnalysisRequest) -> MediaAnalysisResult:
+    fallback_desc = "Живой кадр, передающий яркие эмоции" if req.media_type == "reel" else "Красивое атмосферное фото"
+    return MediaAnalysisResult(description=fallback_desc, mood="неизвестно")
+
+
+async def async_analyze_media_item(req: MediaAnalysisRequest, max_tokens: int = 80) -> MediaAnalysisResult:
+    """Sends a single analysis request to LLM (image attached if present).
     Returns structured MediaAnalysisResult.  Uses small max_tokens for speed.
     """
-    img_b64 = _load_image_as_base64(req.image_path)
+    # Декодирование/сжатие фото — в потоке, чтобы не держать event loop
+    image_data = await asyncio.to_thread(_load_image_for_vision, req.image_path)
     prompt = f"""
-Ты — креативный визуальный аналитик. Посмотри на изображение (дано в base64) и коротко опиши его содержание и настроение.
+Ты — креативный визуальный аналитик. Посмотри на изображение (если оно приложено) и коротко опиши его содержание и настроение.
 
 ВХОДНЫЕ ДАННЫЕ:
 - Тип: {req.media_type}
 - Caption: "{req.caption[:120]}"
 - Alt-text: "{req.alt_text[:120]}"
-- Image (base64, может быть пустым): {img_b64[:60]}...
 
 ОТВЕТИ СТРОГО В ФОРМАТЕ JSON:
 {{
@@ -56,23 +64,93 @@ def analyze_media_item(req: MediaAnalysisRequest, max_tokens: int = 80) -> Media
 }}
 """
     try:
-        raw = generate_text(prompt, max_tokens=max_tokens, temperature=0.7)
+        raw = await async_generate_text(prompt, max_tokens=max_tokens, temperature=0.7,
+                                        image_data=image_data or None)
         # Пытаемся извлечь JSON часть
-        import json, re
         json_match = re.search(r"{.*}", raw, re.S)
         if json_match:
             data = json.loads(json_match.group(0))
             return MediaAnalysisResult(**data)
     except Exception as e:
         print(f"media_analyzer: LLM error {e}")
-    # fallback
-    fallback_desc = "Живой кадр, передающий яркие эмоции" if req.media_type == "reel" else "Красивое атмосферное фото"
-    return MediaAnalysisResult(description=fallback_desc, mood="неизвестно")
+    return _fallback_result(req)
+
+
+def analyze_media_item(req: MediaAnalysisRequest, max_tokens: int = 80) -> MediaAnalysisResult:
+    """Synchronous wrapper over async_analyze_media_item for threaded builders."""
+    return llm_gateway.run_sync(async_analyze_media_item(req, max_tokens))
+
+
+async def _analyze_image_group(requests: List[MediaAnalysisRequest]) -> List[MediaAnalysisResult]:
+    """Один multi-image запрос на группу фото; ответы сопоставляются по номеру фото."""
+    images = await asyncio.gather(*[asyncio.to_thread(_load_image_for_vision, r.image_path) for r in requests])
+    content = [{
+        "type": "text",
+        "text": f"""Ты — креативный визуальный аналитик. Ниже {len(requests)} фотографий, они пронумерованы по порядку начиная с 1.
+Для КАЖДОЙ коротко опиши содержание и настроение.
+
+ПОДПИСИ:
+""" + "\n".join(f'{i}. Тип: {r.media_type}; Caption: "{r.caption[:120]}"; Alt-text: "{r.alt_text[:120]}"'
+                for i, r in enumerate(requests, 1)) + """
+
+ОТВЕТЬ СТРОГО В ФОРМАТЕ JSON:
+{"results": [{"index": 1, "description": "одно красивое предложение", "mood": "одно слово настроение"}]}""",
+    }]
+    for i, image in enumerate(images, 1):
+        if image:
+            content.append({"type": "text", "text": f"Фото {i}:"})
+            content.append({"type": "image_url", "image_url": {"url": image, "detail": "low"}})
+
+    by_index = {}
+    try:
+        raw = await llm_gateway.complete_text(
+            [{"role": "user", "content": content}],
+            max_tokens=80 * len(requests) + 40,
+            temperature=0.7,
+            response_format={"type": "json_object"},
+        )
+        for item in json.loads(raw).get("results", []):
+            try:
+                by_index[int(item["index"])] = MediaAnalysisResult(
+                    description=item["description"], mood=item.get("mood", "неизвестно")
+                )
+            except (KeyError, TypeError, ValueError):
+                continue
+    except Exception as e:
+        print(f"media_analyzer: batch LLM error {e}")
+
+    # Модель пропустила фото — добираем одиночными запросами, параллельно
+    # (лимиты соблюдает шлюз)
+    missing = [i for i in range(1, len(requests) + 1) if i not in by_index]
+    retried = await asyncio.gather(*[async_analyze_media_item(requests[i - 1]) for i in missing])
+    by_index.update(zip(missing, retried))
+    return [by_index[i] for i in range(1, len(requests) + 1)]
+
+
+async def async_analyze_media_batch(requests: List[MediaAnalysisRequest],
+                                    batch_size: int | None = None) -> List[MediaAnalysisResult]:
+    """Анализирует все медиа параллельно: фото группами по batch_size в одном
+    vision-запросе, элементы без изображения — отдельными запросами.
+    Порядок результатов совпадает с порядком requests."""
+    batch_size = max(1, batch_size or settings.VISION_BATCH_SIZE)
+    with_image = [i for i, r in enumerate(requests) if r.image_path and r.image_path.exists()]
+    without_image = sorted(set(range(len(requests))) - set(with_image))
+
+    groups = [with_image[i:i + batch_size] for i in range(0, len(with_image), batch_size)]
+    group_results, single_results = await asyncio.gather(
+        asyncio.gather(*[_analyze_image_group([requests[i] for i in group]) for group in groups]),
+        asyncio.gather(*[async_analyze_media_item(requests[i]) for i in without_image]),
+    )
+
+    results: List[MediaAnalysisResult | None] = [None] * len(requests)
+    for group, group_result in zip(groups, group_results):
+        for i, res in zip(group, group_result):
+            results[i] = res
+    for i, res in zip(without_image, single_results):
+        results[i] = res
+    return [res or _fallback_result(req) for res, req in zip(results, requests)]
 
 
 def analyze_media_batch(requests: List[MediaAnalysisRequest]) -> List[MediaAnalysisResult]:
-    """Поштучно вызывает analyze_media_item. Можно заменить на параллельный в будущем."""
-    results: List[MediaAnalysisResult] = []
-    for r in requests:
-        results.append(analyze_media_item(r))
-    return results 
\ No newline at end of file
+    """Синхронная обёртка над async_analyze_media_batch для сборщиков в потоках."""
+    return llm_gateway.run_sync(async_analyze_media_batch(requests)) 
\ No newline at end of file
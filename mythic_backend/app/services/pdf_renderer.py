@@ -0,0 +1,263 @@
+# app/services/pdf_renderer.py
+"""Пул процессов для рендера PDF через WeasyPrint.
+
+WeasyPrint держит GIL на всё время вёрстки и раздувает RSS на сотни МБ на
+книгах с base64-фотографиями, поэтому рендер вынесен из процессов API и
+сборщиков:
+  ▸ PDF_RENDER_WORKERS процессов (spawn), каждый перезапускается после
+    PDF_MAX_TASKS_PER_CHILD задач — память, которую не вернул pango/cairo,
+    уходит вместе с процессом;
+  ▸ внутри задачи сторожевой поток следит за RSS (PDF_MAX_RSS_MB) и временем
+    (PDF_RENDER_TIMEOUT) и при превышении завершает процесс;
+  ▸ не более PDF_QUEUE_MAX задач ждут в очереди, остальные получают
+    PdfQueueFullError;
+  ▸ фото-ассеты книги (app/services/assets.py) подставляются прямо с диска.
+
+API: submit() → concurrent.futures.Future, render() — await, render_sync() —
+для сборщиков, работающих в потоках.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Optional
+
+log = logging.getLogger("pdf_renderer")
+
+PRINT_CSS = """
+    @page {
+        margin: 1.5cm;
+        size: A4;
+    }
+
+    body {
+        margin: 0;
+        padding: 0;
+    }
+
+    .memoir-page {
+        page-break-after: always;
+        margin: 0;
+        box-shadow: none;
+    }
+
+    .memoir-page:last-child {
+        page-break-after: auto;
+    }
+
+    .photo-frame {
+        box-shadow: none;
+        border: 1px solid #ddd;
+    }
+
+    /* Убираем лишние тени для печати */
+    * {
+        -webkit-print-color-adjust: exact !important;
+        color-adjust: exact !important;
+    }
+"""
+
+
+class PdfRenderError(RuntimeError):
+    """Рендер не удался (ошибка WeasyPrint, лимит памяти или времени)."""
+
+
+class PdfQueueFullError(PdfRenderError):
+    """Очередь рендера переполнена."""
+
+
+# ─────────────── код дочернего процесса ────────────────────────────────────
+def _error_marker(output_path: Path) -> Path:
+    return output_path.with_name(output_path.name + ".render-error")
+
+
+def _watchdog(output_path: Path, max_rss_mb: int, timeout: float, done: threading.Event):
+    """Завершает процесс, если задача превысила лимит памяти или времени.
+
+    Причина пишется рядом с output_path — по ней родитель отличает «свою»
+    аварию от задач, которые просто делили с ней упавший процесс.
+    """
+    try:
+        import psutil
+        process = psutil.Process()
+    except ImportError:
+        process = None
+
+    deadline = time.monotonic() + timeout
+    while not done.wait(0.5):
+        reason = None
+        if time.monotonic() > deadline:
+            reason = f"превышено время рендера ({timeout:.0f}с)"
+        elif process is not None and max_rss_mb:
+            rss_mb = process.memory_info().rss / (1024 * 1024)
+            if rss_mb > max_rss_mb:
+                reason = f"превышен лимит памяти ({rss_mb:.0f} > {max_rss_mb} МБ)"
+        if reason:
+            try:
+                _error_marker(output_path).write_text(reason, encoding="utf-8")
+            finally:
+                os._exit(70)
+
+
+def _asset_fetcher(url: str, *args, **kwargs):
+    """url_fetcher WeasyPrint: фото-ассеты книги читаются с диска, а не по HTTP."""
+    from weasyprint import default_url_fetcher
+    from app.services.assets import MEDIA_TYPES, local_path
+
+    path = local_path(url)
+    if path is None:
+        return default_url_fetcher(url, *args, **kwargs)
+    return {"string": path.read_bytes(), "mime_type": MEDIA_TYPES[path.suffix.lstrip(".")]}
+
+
+def _render_job(output_path: str, html_content: Optional[str], html_path: Optional[str],
+                base_url: Optional[str], max_rss_mb: int, timeout: float) -> str:
+    """Выполняется в процессе пула: HTML → PDF."""
+    from weasyprint import HTML, CSS
+
+    output = Path(output_path)
+    done = threading.Event()
+    threading.Thread(target=_watchdog, args=(output, max_rss_mb, timeout, done), daemon=True).start()
+    try:
+        if html_content is None:
+            html_content = Path(html_path).read_text(encoding="utf-8")
+        HTML(string=html_content, base_url=base_url, url_fetcher=_asset_fetcher).write_pdf(
+            str(output), stylesheets=[CSS(string=PRINT_CSS)])
+    finally:
+        done.set()
+    return str(output)
+
+
+# ─────────────── сторона родителя ──────────────────────────────────────────
+class PdfRenderPool:
+    def __init__(self, workers: int, max_tasks_per_child: int, max_rss_mb: int,
+                 timeout: float, queue_max: int):
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss_mb = max_rss_mb
+        self.timeout = timeout
+        self.queue_max = queue_max
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "pool_restarts": 0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+            return self._executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self.stats["pool_restarts"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, output_path: Path, html_content: Optional[str] = None,
+               html_path: Optional[Path] = None, base_url: Optional[str] = None) -> Future:
+        """Ставит рендер в очередь; Future завершается путём к PDF или PdfRenderError."""
+        with self._lock:
+            if self._pending >= self.queue_max:
+                self.stats["rejected"] += 1
+                raise PdfQueueFullError(f"очередь PDF переполнена ({self._pending})")
+            self._pending += 1
+            self.stats["submitted"] += 1
+
+        result: Future = Future()
+        output_path = Path(output_path)
+        _error_marker(output_path).unlink(missing_ok=True)
+        args = (str(output_path), html_content, str(html_path) if html_path else None,
+                base_url, self.max_rss_mb, self.timeout)
+
+        def finish(exc: Optional[BaseException] = None, value: Optional[str] = None):
+            with self._lock:
+                self._pending -= 1
+                self.stats["failed" if exc else "completed"] += 1
+            if exc:
+                result.set_exception(exc)
+            else:
+                result.set_result(Path(value))
+
+        def attempt(retries_left: int):
+            executor = self._get_executor()
+            try:
+                inner = executor.submit(_render_job, *args)
+            except BrokenProcessPool:
+                self._reset_executor(executor)
+                if retries_left:
+                    return attempt(retries_left - 1)
+                return finish(PdfRenderError("пул рендера недоступен"))
+
+            def on_done(f: Future):
+                try:
+                    finish(value=f.result())
+                except BrokenProcessPool:
+                    self._reset_executor(executor)
+                    marker = _error_marker(output_path)
+                    if marker.exists():
+                        reason = marker.read_text(encoding="utf-8")
+                        marker.unlink(missing_ok=True)
+                        log.error("PDF %s: %s", output_path, reason)
+                        finish(PdfRenderError(reason))
+                    elif retries_left:
+                        # Процесс упал из-за соседней задачи — пробуем ещё раз
+                        attempt(retries_left - 1)
+                    else:
+                        finish(PdfRenderError("процесс рендера аварийно завершился"))
+                except Exception as e:
+                    finish(PdfRenderError(str(e)))
+
+            inner.add_done_callback(on_done)
+
+        attempt(1)
+        return result
+
+    async def render(self, output_path: Path, html_content: Optional[str] = None,
+                     html_path: Optional[Path] = None, base_url: Optional[str] = None) -> Path:
+        return await asyncio.wrap_future(self.submit(output_path, html_content, html_path, base_url))
+
+    def render_sync(self, output_path: Path, html_content: Optional[str] = None,
+                    html_path: Optional[Path] = None, base_url: Optional[str] = None) -> Path:
+        # Запас сверх timeout — на ожидание в очереди
+        return self.submit(output_path, html_content, html_path, base_url).result(timeout=self.timeout * 4)
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return {"workers": self.workers, "pending": self._pending, **self.stats}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool: Optional[PdfRenderPool] = None
+
+
+def get_pdf_pool() -> PdfRenderPool:
+    """Общий пул рендера процесса (создаётся лениво)."""
+    global _pool
+    if _pool is None:
+        from app.config import settings
+        _pool = PdfRenderPool(
+            workers=settings.PDF_RENDER_WORKERS,
+            max_tasks_per_child=settings.PDF_MAX_TASKS_PER_CHILD,
+            max_rss_mb=settings.PDF_MAX_RSS_MB,
+            timeout=settings.PDF_RENDER_TIMEOUT,
+            queue_max=settings.PDF_QUEUE_MAX,
+        )
+    return _pool
@@ -0,0 +1,87 @@
+# app/services/pdf_service.py
+"""Этап «PDF»: рендер book.pdf из уже сохранённого book.html.
+
+LLM при этом не вызывается — PDF всегда соответствует той книге, которую
+пользователь уже видел. Параллельные запросы PDF одного run_id ждут один и
+тот же рендер; файл пишется во временный и атомарно подменяется.
+
+Ошибка рендера пробрасывается вызывающему: переполненная очередь
+(PdfQueueFullError) — временная, повторить позже; прочие PdfRenderError
+отмечаются в манифесте (files.pdf=False, pdfError). Заглушка вместо книги в
+book.pdf не пишется — иначе pdf_is_fresh отдавал бы её как настоящий PDF.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Dict
+
+from app.services import run_manifest
+from app.services.pdf_renderer import PdfQueueFullError, PdfRenderError, get_pdf_pool
+
+log = logging.getLogger("pdf_service")
+
+# run_id → выполняющийся рендер (общий для всех ожидающих запросов)
+_inflight: Dict[str, asyncio.Task] = {}
+# Через сколько секунд повторить запрос, если очередь рендера переполнена (Retry-After)
+QUEUE_FULL_RETRY_AFTER = 30
+
+
+def pdf_is_fresh(run_dir: Path) -> bool:
+    """book.pdf существует и не старше book.html."""
+    html_file = run_dir / "book.html"
+    pdf_file = run_dir / "book.pdf"
+    if not pdf_file.exists():
+        return False
+    if not html_file.exists():
+        return True
+    return pdf_file.stat().st_mtime >= html_file.stat().st_mtime
+
+
+async def _render(run_id: str) -> Path:
+    """HTML-файл → временный PDF в пуле рендера → атомарная замена book.pdf."""
+    run_dir = Path("data") / run_id
+    html_file = run_dir / "book.html"
+    pdf_file = run_dir / "book.pdf"
+    tmp_file = pdf_file.with_suffix(f".pdf.{os.getpid()}.tmp")
+    log.info("PDF render started for %s", run_id)
+    try:
+        try:
+            await get_pdf_pool().render(tmp_file, html_path=html_file, base_url=str(run_dir.resolve()))
+        except PdfQueueFullError:
+            log.warning("PDF render for %s rejected: render queue is full", run_id)
+            raise
+        except PdfRenderError as e:
+            log.error("PDF render failed for %s: %s", run_id, e)
+            run_manifest.set_fields(run_id, files={"pdf": False}, pdfError=str(e)[:300])
+            raise
+        if not tmp_file.exists():
+            raise PdfRenderError("PDF не был создан")
+        os.replace(tmp_file, pdf_file)
+        run_manifest.set_fields(run_id, files={"pdf": True}, pdfError=None)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    log.info("PDF render finished for %s", run_id)
+    return pdf_file
+
+
+async def ensure_pdf(run_id: str, force: bool = False) -> Path:
+    """Возвращает путь к актуальному book.pdf, при необходимости рендерит его.
+
+    Raises FileNotFoundError, если book.html ещё не собран.
+    """
+    run_dir = Path("data") / run_id
+    if not (run_dir / "book.html").exists():
+        raise FileNotFoundError(f"book.html не найден для {run_id}")
+    if not force and pdf_is_fresh(run_dir):
+        return run_dir / "book.pdf"
+
+    task = _inflight.get(run_id)
+    if task is None:
+        task = asyncio.create_task(_render(run_id))
+        _inflight[run_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(run_id, None))
+    # shield: отмена одного HTTP-запроса не должна прерывать общий рендер
+    return await asyncio.shield(task)
@@ -0,0 +1,206 @@
+# app/services/photo_selection.py
+"""Отбор фото для книги: без дублей, лучшие — первыми.
+
+Instagram отдаёт одно и то же фото под разными CDN-ссылками и как childPosts,
+а сборщики раньше выбирали фото через random и добивали дублями. Здесь для
+каждого фото (по vision-производной 512px, оригинал не декодируется):
+  ▸ перцептивный хэш pHash (DCT 32×32 → 64 бита);
+  ▸ резкость — дисперсия лапласиана;
+  ▸ экспозиция — средняя яркость и доля пересвеченных/провалов;
+  ▸ «лицевость» — доля пикселей тона кожи (YCbCr) с весом к центру кадра;
+  ▸ разрешение исходника (из индекса производных).
+Метрики нормируются по всем фото профиля, итоговый балл — взвешенная сумма.
+Почти одинаковые фото (расстояние Хэмминга pHash ≤ PHOTO_DUP_HAMMING)
+схлопываются в лучшее из них.
+
+Результат сохраняется в data/<run_id>/selection.json после загрузки фото;
+select_best() отдаёт сборщикам индексы лучших различных фото. Без NumPy —
+исходный порядок файлов.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from app.config import settings
+from app.services.image_derivatives import derivative_path, load_index
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+log = logging.getLogger("photo_selection")
+
+SELECTION_NAME = "selection.json"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+# Веса метрик: резкость, экспозиция, лицо в кадре, разрешение
+WEIGHTS = (0.35, 0.25, 0.25, 0.15)
+_HASH_SIZE = 32
+_dct_matrix = None
+
+
+# ─────────────── метрики одного фото ───────────────────────────────────────
+def _dct():
+    """Матрица DCT-II 32×32 (без SciPy)."""
+    global _dct_matrix
+    if _dct_matrix is None:
+        n = np.arange(_HASH_SIZE)
+        _dct_matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * _HASH_SIZE))
+    return _dct_matrix
+
+
+def _phash(gray: Image.Image) -> int:
+    pixels = np.asarray(gray.resize((_HASH_SIZE, _HASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    c = _dct()
+    low = (c @ pixels @ c.T)[:8, :8].flatten()[1:]   # без DC-компоненты
+    bits = np.append(low > np.median(low), False)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _metrics(path: Path, source_size: Optional[tuple]) -> Dict:
+    with Image.open(derivative_path(path, "vision")) as img:
+        img = img.convert("RGB")
+        gray_img = img.convert("L")
+        ycbcr = np.asarray(img.convert("YCbCr"), dtype=np.float32)
+    gray = np.asarray(gray_img, dtype=np.float32)
+
+    lap = (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:])
+    sharpness = float(lap.var())
+
+    norm = gray / 255.0
+    clipped = float(np.mean((norm < 0.02) | (norm > 0.98)))
+    exposure = (1.0 - abs(float(norm.mean()) - 0.5) * 2) * (1.0 - clipped)
+
+    cb, cr = ycbcr[..., 1], ycbcr[..., 2]
+    skin = (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173)
+    h, w = skin.shape
+    yy, xx = np.ogrid[:h, :w]
+    weight = np.exp(-(((yy - h / 2) / (h / 2.5)) ** 2 + ((xx - w / 2) / (w / 2.5)) ** 2))
+    saliency = float((skin * weight).sum() / weight.sum())
+
+    width, height = source_size or img.size
+    resolution = min(1.0, (width * height) / (1080 * 1080))
+
+    return {
+        "phash": _phash(gray_img),
+        "sharpness": sharpness,
+        "exposure": exposure,
+        "saliency": saliency,
+        "resolution": resolution,
+    }
+
+
+# ─────────────── ранжирование ──────────────────────────────────────────────
+def _hamming_matrix(hashes: List[int]) -> "np.ndarray":
+    values = np.array(hashes, dtype=np.uint64)
+    xor = values[:, None] ^ values[None, :]
+    return np.unpackbits(xor.view(np.uint8).reshape(len(values), len(values), 8), axis=-1).sum(axis=-1)
+
+
+def rank_photos(run_dir: Path) -> Tuple[List[Dict], List[str]]:
+    """Оценивает фото images/ и возвращает их по убыванию балла (у дублей
+    заполнено duplicate_of — имя оставленного фото) и имена фото, которые
+    оценить не удалось."""
+    images = [p for p in sorted((run_dir / "images").glob("*"))
+              if p.suffix.lower() in IMAGE_SUFFIXES and "_placeholder" not in p.stem]
+    if not images:
+        return [], []
+    index = load_index(run_dir).get("images", {})
+
+    rows, names, failed = [], [], []
+    for path in images:
+        entry = index.get(path.name) or {}
+        source = (entry["width"], entry["height"]) if entry.get("width") else None
+        try:
+            rows.append(_metrics(path, source))
+            names.append(path.name)
+        except Exception as e:
+            log.warning("selection: не удалось оценить %s: %s", path.name, e)
+            failed.append(path.name)
+    if not rows:
+        return [], failed
+
+    raw = np.array([[r["sharpness"], r["exposure"], r["saliency"], r["resolution"]] for r in rows])
+    # Нормировка по профилю: 0 — худшее фото по метрике, 1 — лучшее
+    span = raw.max(axis=0) - raw.min(axis=0)
+    normalized = np.where(span > 0, (raw - raw.min(axis=0)) / np.where(span > 0, span, 1), 1.0)
+    scores = normalized @ np.array(WEIGHTS)
+
+    distances = _hamming_matrix([r["phash"] for r in rows])
+    kept: List[int] = []
+    ranked = []
+    for i in np.argsort(-scores, kind="stable"):
+        duplicate_of = next((k for k in kept if distances[i, k] <= settings.PHOTO_DUP_HAMMING), None)
+        if duplicate_of is None:
+            kept.append(int(i))
+        ranked.append({
+            "name": names[i],
+            "score": round(float(scores[i]), 4),
+            "phash": f"{rows[i]['phash']:016x}",
+            "duplicate_of": names[duplicate_of] if duplicate_of is not None else None,
+            "metrics": {k: round(float(v), 4) for k, v in zip(("sharpness", "exposure", "saliency", "resolution"), raw[i])},
+        })
+    return ranked, failed
+
+
+def build_selection(run_dir: Path) -> List[Dict]:
+    """Этап отбора: считает рейтинг и сохраняет selection.json.
+
+    Фото, которые не удалось оценить, записываются в failed — рейтинг с ними
+    считается полным и не пересчитывается при каждом select_best().
+    """
+    if not NUMPY_AVAILABLE:
+        return []
+    ranked, failed = rank_photos(run_dir)
+    path = run_dir / SELECTION_NAME
+    tmp = path.with_name(f"{SELECTION_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps({"photos": ranked, "failed": failed}, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+    distinct = sum(1 for r in ranked if not r["duplicate_of"])
+    log.info("selection for %s: %s photos, %s distinct, %s failed", run_dir.name, len(ranked), distinct, len(failed))
+    return ranked
+
+
+def _load_selection(run_dir: Path, names: set) -> Optional[List[Dict]]:
+    try:
+        data = json.loads((run_dir / SELECTION_NAME).read_text(encoding="utf-8"))
+        ranked = data["photos"]
+    except (OSError, ValueError, KeyError):
+        return None
+    # Набор фото изменился — рейтинг устарел; неоценённые фото тоже учтены
+    settled = {r["name"] for r in ranked} | set(data.get("failed", []))
+    return ranked if settled == names else None
+
+
+def select_best(images: List[Path], count: int) -> List[int]:
+    """Индексы в images лучших различных фото (не больше count, без повторов).
+
+    Если различных фото меньше count, возвращается сколько есть — сборщики
+    показывают меньше фото, но не повторяют одно и то же.
+    """
+    if not images:
+        return []
+    run_dir = images[0].parent.parent
+    positions = {p.name: i for i, p in enumerate(images)}
+    ranked = None
+    if NUMPY_AVAILABLE:
+        candidates = {name for name in positions
+                      if Path(name).suffix.lower() in IMAGE_SUFFIXES and "_placeholder" not in name}
+        ranked = _load_selection(run_dir, candidates)
+        if ranked is None:
+            try:
+                ranked = build_selection(run_dir)
+            except Exception as e:
+                log.warning("selection: рейтинг недоступен (%s), беру фото по порядку", e)
+    if not ranked:
+        return list(range(min(count, len(images))))
+    best = [positions[r["name"]] for r in ranked if not r["duplicate_of"] and r["name"] in positions]
+    return best[:count]
@@ -0,0 +1,76 @@
+# app/services/posts_store.py
+"""Датасет Apify на диске: data/<run_id>/posts.ndjson, один item на строку.
+
+Раньше вебхук держал весь датасет в памяти и писал его одним posts.json с
+indent=2; сборщики потом целиком парсили этот файл, хотя почти всем нужен
+только первый item (профиль). Теперь:
+  ▸ ingest() пишет страницы датасета по мере поступления (aiofiles,
+    временный файл + os.replace);
+  ▸ iter_items() — ленивый итератор: чтение идёт построчно, и
+    next(iter_items(...)) читает только первую строку.
+Старые run_id с posts.json читаются прозрачно.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import aiofiles
+
+log = logging.getLogger("posts_store")
+
+NDJSON_NAME = "posts.ndjson"
+LEGACY_NAME = "posts.json"
+
+
+def has_items(run_dir: Path) -> bool:
+    return (run_dir / NDJSON_NAME).exists() or (run_dir / LEGACY_NAME).exists()
+
+
+def iter_items(run_dir: Path) -> Iterator[Dict[str, Any]]:
+    """Items датасета по одному; пустой итератор, если данных ещё нет."""
+    ndjson = run_dir / NDJSON_NAME
+    if ndjson.exists():
+        with open(ndjson, encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    legacy = run_dir / LEGACY_NAME
+    if legacy.exists():
+        yield from json.loads(legacy.read_text(encoding="utf-8"))
+
+
+def first_item(run_dir: Path) -> Optional[Dict[str, Any]]:
+    """Профиль (первый item датасета) без чтения остального файла."""
+    return next(iter_items(run_dir), None)
+
+
+async def ingest(run_dir: Path, pages: AsyncIterator[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Пишет страницы датасета в posts.ndjson по мере поступления.
+
+    Возвращает {"items": число items, "profile": первый item или None}.
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    target = run_dir / NDJSON_NAME
+    tmp = target.with_name(f"{NDJSON_NAME}.{os.getpid()}.tmp")
+    count = 0
+    profile = None
+    try:
+        async with aiofiles.open(tmp, "w", encoding="utf-8") as fh:
+            async for page in pages:
+                if not page:
+                    continue
+                if profile is None:
+                    profile = page[0]
+                await fh.write("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in page))
+                count += len(page)
+        os.replace(tmp, target)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    log.info("ingested %s items → %s", count, target)
+    return {"items": count, "profile": profile}
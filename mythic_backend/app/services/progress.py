@@ -0,0 +1,254 @@
+# app/services/progress.py
+"""Публикация прогресса сборки и подписка на него (SSE / WebSocket).
+
+Этапы пайплайна вызывают publish(run_id, stage, percent, message). Событие:
+  ▸ публикуется в Redis-канал ``mythic:progress:<run_id>`` — его получают
+    подписчики во всех процессах API;
+  ▸ сохраняется как «последнее состояние» (ключ с TTL), чтобы новый
+    подписчик сразу получил текущий этап;
+  ▸ дублируется локальным подписчикам процесса — так стрим работает и без
+    Redis (например, при локальной разработке).
+У события есть ``seq`` — возрастающий номер в пределах run_id (микросекунды
+публикации): подписчик отбрасывает повторы и устаревшие события.
+publish() синхронный, потокобезопасный и не блокирует: его вызывают и
+корутины (в том числе на общем цикле LLM-шлюза), и сборщики в потоках
+build_executor. Запись в Redis выполняет один фоновый поток — вызывающий
+не ждёт сети, даже если Redis недоступен.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+import redis
+
+from app.config import settings
+
+log = logging.getLogger("progress")
+
+CHANNEL_PREFIX = "mythic:progress"
+LAST_TTL = 24 * 3600
+
+# Процент по умолчанию для этапов пайплайна
+STAGE_PERCENT = {
+    "scrape_started": 5,
+    "ingesting": 10,
+    "data_collected": 20,
+    "images_downloaded": 35,
+    "building": 40,
+    "book_generated": 100,
+}
+# После этих этапов стрим закрывается; ``retrying`` — ошибка, после которой
+# очередь повторит задачу, поэтому стрим остаётся открытым
+TERMINAL_STAGES = {"book_generated", "failed"}
+
+
+def failure_stage(final: bool) -> str:
+    """Этап события об ошибке: окончательная (``failed``) или будет повтор (``retrying``)."""
+    return "failed" if final else "retrying"
+
+_sync_redis: Optional[redis.Redis] = None
+_lock = threading.Lock()
+_local_last: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_local_subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+_LOCAL_LAST_MAX = 1000
+# run_id → seq последнего события, опубликованного этим процессом
+_last_seq: "OrderedDict[str, int]" = OrderedDict()
+# После ошибки Redis не пытаемся к нему обращаться REDIS_RETRY_AFTER секунд,
+# чтобы сборка не ждала таймаут соединения на каждом событии
+REDIS_RETRY_AFTER = 30.0
+_redis_down_until = 0.0
+# События, ожидающие записи в Redis фоновым потоком
+_OUTBOX_MAX = 10000
+_outbox: "queue.Queue[Tuple[str, str]]" = queue.Queue(maxsize=_OUTBOX_MAX)
+_writer: Optional[threading.Thread] = None
+
+
+def _channel(run_id: str) -> str:
+    return f"{CHANNEL_PREFIX}:{run_id}"
+
+
+def _last_key(run_id: str) -> str:
+    return f"{CHANNEL_PREFIX}:last:{run_id}"
+
+
+def _get_sync_redis() -> Optional[redis.Redis]:
+    global _sync_redis
+    if time.monotonic() < _redis_down_until:
+        return None
+    if _sync_redis is None:
+        _sync_redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True,
+                                           socket_timeout=2, socket_connect_timeout=2)
+    return _sync_redis
+
+
+def _mark_redis_down(error: Exception):
+    global _redis_down_until
+    _redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+    log.debug("progress: Redis недоступен (%s), только локальная доставка", error)
+
+
+def _write_loop():
+    """Фоновый поток: пишет события из _outbox в Redis по порядку."""
+    while True:
+        run_id, payload = _outbox.get()
+        r = _get_sync_redis()
+        if r is None:
+            continue  # подписчики процесса уже получили событие локально
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.set(_last_key(run_id), payload, ex=LAST_TTL)
+            pipe.publish(_channel(run_id), payload)
+            pipe.execute()
+        except Exception as e:
+            _mark_redis_down(e)
+
+
+def _enqueue_write(run_id: str, payload: str):
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_loop, name="progress-writer", daemon=True)
+                _writer.start()
+    try:
+        _outbox.put_nowait((run_id, payload))
+    except queue.Full:
+        log.debug("progress: очередь записи в Redis переполнена, событие %s только локально", run_id)
+
+
+def publish(run_id: str, stage: str, percent: Optional[int] = None,
+            message: Optional[str] = None, **extra: Any) -> Dict[str, Any]:
+    """Публикует событие прогресса; ошибки Redis не прерывают сборку и не задерживают вызывающего."""
+    with _lock:
+        seq = max(time.time_ns() // 1000, _last_seq.get(run_id, 0) + 1)
+        _last_seq[run_id] = seq
+        _last_seq.move_to_end(run_id)
+        while len(_last_seq) > _LOCAL_LAST_MAX:
+            _last_seq.popitem(last=False)
+    event = {
+        "runId": run_id,
+        "seq": seq,
+        "stage": stage,
+        "percent": STAGE_PERCENT.get(stage, 0) if percent is None else max(0, min(100, int(percent))),
+        "message": message,
+        "ts": time.time(),
+        **extra,
+    }
+    _enqueue_write(run_id, json.dumps(event, ensure_ascii=False))
+
+    with _lock:
+        _local_last[run_id] = event
+        _local_last.move_to_end(run_id)
+        while len(_local_last) > _LOCAL_LAST_MAX:
+            _local_last.popitem(last=False)
+        subscribers = list(_local_subscribers.get(run_id, ()))
+    for loop, subscriber_queue in subscribers:
+        loop.call_soon_threadsafe(subscriber_queue.put_nowait, event)
+    return event
+
+
+def last_event(run_id: str) -> Optional[Dict[str, Any]]:
+    """Последнее известное событие прогресса run_id (Redis, затем память процесса)."""
+    r = _get_sync_redis()
+    if r is not None:
+        try:
+            raw = r.get(_last_key(run_id))
+            if raw:
+                return json.loads(raw)
+        except Exception as e:
+            _mark_redis_down(e)
+    with _lock:
+        return _local_last.get(run_id)
+
+
+async def _last_event_async(run_id: str, client) -> Optional[Dict[str, Any]]:
+    if client is not None:
+        try:
+            raw = await client.get(_last_key(run_id))
+            if raw:
+                return json.loads(raw)
+        except Exception as e:
+            log.debug("progress: последнее событие без Redis (%s)", e)
+    with _lock:
+        return _local_last.get(run_id)
+
+
+async def subscribe(run_id: str, heartbeat: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """Асинхронный поток событий run_id. Первым отдаёт последнее известное
+    событие (если есть), затем новые; каждые ``heartbeat`` секунд без событий
+    отдаёт None — потребитель шлёт keep-alive.
+
+    Подписка оформляется до чтения последнего события, поэтому событие,
+    опубликованное между ними, не теряется; повторы отбрасываются по seq.
+    """
+    from app.services.job_queue import get_redis
+
+    loop = asyncio.get_running_loop()
+    local_queue: asyncio.Queue = asyncio.Queue()
+    entry = (loop, local_queue)
+    with _lock:
+        _local_subscribers.setdefault(run_id, set()).add(entry)
+
+    client = None
+    pubsub = None
+    try:
+        try:
+            # Общий async-клиент процесса; у pubsub — своё соединение из его пула
+            client = get_redis()
+            pubsub = client.pubsub()
+            await pubsub.subscribe(_channel(run_id))
+        except Exception as e:
+            log.debug("progress: подписка без Redis (%s)", e)
+            pubsub = None
+
+        last_seq = -1
+        last = await _last_event_async(run_id, client if pubsub is not None else None)
+        if last:
+            last_seq = last.get("seq", last_seq)
+            yield last
+
+        while True:
+            event = None
+            if pubsub is not None:
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat)
+                except Exception as e:
+                    log.warning("progress: потеряно соединение с Redis (%s), перехожу на локальную доставку", e)
+                    pubsub = None
+                    continue
+                if message and message.get("type") == "message":
+                    event = json.loads(message["data"])
+                # Те же события уже пришли через Redis — локальную очередь просто очищаем
+                while not local_queue.empty():
+                    local_queue.get_nowait()
+            else:
+                try:
+                    event = await asyncio.wait_for(local_queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    event = None
+            seq = event.get("seq") if event else None
+            if seq is not None:
+                if seq <= last_seq:
+                    continue  # уже отдано (последнее событие) или устарело
+                last_seq = seq
+            yield event
+    finally:
+        with _lock:
+            subscribers = _local_subscribers.get(run_id)
+            if subscribers is not None:
+                subscribers.discard(entry)
+                if not subscribers:
+                    _local_subscribers.pop(run_id, None)
+        if pubsub is not None:
+            try:
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+            except Exception:
+                pass
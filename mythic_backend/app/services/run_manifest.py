@@ -0,0 +1,207 @@
+# app/services/run_manifest.py
+"""Манифест run_id — один маленький JSON со всем, что нужно /status и библиотеке.
+
+data/<run_id>/manifest.json:
+  owner      — кто создал книгу (бывший user_meta.json);
+  style/format;
+  stages     — data_collected / images_downloaded / book_generated;
+  profile    — username, fullName, followers, posts, stories;
+  files      — что уже лежит в папке (html, pdf, число фото);
+  timestamps — когда пройден каждый этап.
+
+Каждый этап обновляет манифест через update(): блокировка (поток + flock
+для API и воркеров), запись во временный файл и os.replace — читатель
+всегда видит целый файл. Для старых run_id без манифеста он один раз
+собирается из user_meta.json / style.txt / format.txt / posts.ndjson.
+"""
+from __future__ import annotations
+
+import copy
+import datetime
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows — только блокировка внутри процесса
+    fcntl = None
+
+from app.services import posts_store
+
+log = logging.getLogger("run_manifest")
+
+MANIFEST_NAME = "manifest.json"
+VERSION = 1
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def run_dir(run_id: str) -> Path:
+    return Path("data") / run_id
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat()
+
+
+def _empty(run_id: str) -> Dict[str, Any]:
+    return {
+        "version": VERSION,
+        "runId": run_id,
+        "owner": {},
+        "style": "romantic",
+        "format": "classic",
+        "stages": {"data_collected": False, "images_downloaded": False, "book_generated": False},
+        "profile": {},
+        "files": {"html": False, "pdf": False, "images": 0},
+        "timestamps": {"created": _now()},
+        "updatedAt": _now(),
+    }
+
+
+def profile_summary(items: Iterable[dict]) -> Dict[str, Any]:
+    """Краткая сводка профиля из первого элемента датасета Apify."""
+    for profile in items:
+        return {
+            "username": profile.get("username"),
+            "fullName": profile.get("fullName"),
+            "followers": profile.get("followersCount"),
+            "posts": len(profile.get("latestPosts", [])),
+            "stories": len(profile.get("stories", [])),
+        }
+    return {}
+
+
+def _from_legacy(run_id: str) -> Dict[str, Any]:
+    """Собирает манифест из отдельных файлов старых run_id."""
+    directory = run_dir(run_id)
+    manifest = _empty(run_id)
+
+    def read_text(name: str) -> Optional[str]:
+        try:
+            return (directory / name).read_text(encoding="utf-8").strip()
+        except OSError:
+            return None
+
+    try:
+        meta = json.loads(read_text("user_meta.json") or "{}")
+        manifest["owner"] = {k: meta.get(k) for k in ("user_id", "username", "is_authenticated")}
+        if meta.get("created_at"):
+            manifest["timestamps"]["created"] = meta["created_at"]
+    except ValueError:
+        pass
+    manifest["style"] = read_text("style.txt") or manifest["style"]
+    manifest["format"] = read_text("format.txt") or manifest["format"]
+
+    if posts_store.has_items(directory):
+        manifest["stages"]["data_collected"] = True
+        try:
+            manifest["profile"] = profile_summary(posts_store.iter_items(directory))
+        except ValueError:
+            pass
+
+    images_dir = directory / "images"
+    image_count = sum(1 for _ in images_dir.glob("*")) if images_dir.exists() else 0
+    manifest["files"]["images"] = image_count
+    manifest["stages"]["images_downloaded"] = image_count > 0
+
+    manifest["files"]["html"] = (directory / "book.html").exists()
+    manifest["files"]["pdf"] = (directory / "book.pdf").exists()
+    manifest["stages"]["book_generated"] = manifest["files"]["html"]
+    return manifest
+
+
+@contextmanager
+def _locked(run_id: str):
+    with _locks_guard:
+        lock = _locks.setdefault(run_id, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        lock_path = run_dir(run_id) / f"{MANIFEST_NAME}.lock"
+        with open(lock_path, "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _read(run_id: str) -> Optional[Dict[str, Any]]:
+    path = run_dir(run_id) / MANIFEST_NAME
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        log.warning("manifest %s повреждён (%s), пересобираю", run_id, e)
+        return None
+
+
+def _write(run_id: str, manifest: Dict[str, Any]):
+    path = run_dir(run_id) / MANIFEST_NAME
+    tmp = path.with_name(f"{MANIFEST_NAME}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def load(run_id: str) -> Optional[Dict[str, Any]]:
+    """Манифест run_id или None, если такого run_id нет."""
+    manifest = _read(run_id)
+    if manifest is not None:
+        return manifest
+    if not run_dir(run_id).exists():
+        return None
+    # Старый run_id — собираем манифест один раз и сохраняем
+    with _locked(run_id):
+        manifest = _read(run_id)
+        if manifest is None:
+            manifest = _from_legacy(run_id)
+            _write(run_id, manifest)
+    return manifest
+
+
+def update(run_id: str, mutate: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    """Атомарно применяет mutate(manifest) и сохраняет результат."""
+    run_dir(run_id).mkdir(parents=True, exist_ok=True)
+    with _locked(run_id):
+        manifest = _read(run_id) or _from_legacy(run_id)
+        mutate(manifest)
+        manifest["updatedAt"] = _now()
+        _write(run_id, manifest)
+    return copy.deepcopy(manifest)
+
+
+def mark_stage(run_id: str, stage: str, done: bool = True, **fields: Any) -> Dict[str, Any]:
+    """Отмечает этап пайплайна; fields — дополнительные ключи верхнего уровня
+    (style, format, profile) или files=<dict> для инвентаря файлов."""
+    files = fields.pop("files", None)
+
+    def mutate(manifest: Dict[str, Any]):
+        manifest["stages"][stage] = done
+        if done:
+            manifest["timestamps"][stage] = _now()
+        if files:
+            manifest["files"].update(files)
+        manifest.update(fields)
+
+    return update(run_id, mutate)
+
+
+def set_fields(run_id: str, **fields: Any) -> Dict[str, Any]:
+    """Обновляет ключи верхнего уровня (owner, style, format, profile) и files=<dict>."""
+    files = fields.pop("files", None)
+
+    def mutate(manifest: Dict[str, Any]):
+        if files:
+            manifest["files"].update(files)
+        manifest.update(fields)
+
+    return update(run_id, mutate)
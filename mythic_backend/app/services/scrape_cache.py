@@ -0,0 +1,153 @@
+# app/services/scrape_cache.py
+"""Кэш результатов скрапинга профиля: повторный /start-scrape без прогона Apify.
+
+Тот же профиль часто скрапится снова через несколько минут — другим
+пользователем или тем же, но с другим стилем. Ключ кэша — sha256 от
+нормализованного URL Instagram и run_input актора:
+  ▸ после приёма датасета (ingest_pipeline) remember() записывает
+    ключ → run_id в Redis с TTL SCRAPE_CACHE_TTL (без Redis — память процесса);
+  ▸ lookup() отдаёт run_id-источник, если у него пройден data_collected не
+    раньше SCRAPE_CACHE_TTL секунд назад;
+  ▸ clone_run() переносит posts.ndjson, images/, производные и selection.json
+    жёсткими ссылками (копия — если ссылку сделать нельзя). Все эти файлы
+    пишутся через os.replace и не меняются на месте, поэтому общий inode
+    безопасен.
+Новый run_id сразу получает data_collected (и images_downloaded, если фото у
+источника уже скачаны). Соответствие URL → run_id хранится вне data/ — папка
+раздаётся статикой.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+from app.config import settings
+from app.services import posts_store, run_manifest
+from app.services.downloader import start_download
+from app.services.job_queue import get_redis
+from app.services.progress import publish
+
+log = logging.getLogger("scrape_cache")
+
+KEY_PREFIX = "mythic:scrape"
+_LOCAL_MAX = 1000
+# Файлы и папки, которые переносятся из run_id-источника
+POSTS_FILES = (posts_store.NDJSON_NAME, posts_store.LEGACY_NAME)
+IMAGE_TREES = ("images", "derivatives")
+IMAGE_FILES = ("selection.json", "downloads.json")
+# ключ → (run_id, monotonic-срок жизни); фоллбэк без Redis
+_local: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+
+
+def normalize_url(url: str) -> str:
+    """https://www.Instagram.com/User/?hl=ru → instagram.com/user"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    return f"{host}{parts.path.rstrip('/').lower()}"
+
+
+def make_key(url: str, run_input: Dict[str, Any]) -> str:
+    raw = json.dumps([normalize_url(url), {k: v for k, v in run_input.items() if k != "directUrls"}],
+                     sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _is_fresh(run_id: str) -> bool:
+    manifest = run_manifest.load(run_id) or {}
+    if not manifest.get("stages", {}).get("data_collected"):
+        return False
+    if not posts_store.has_items(run_manifest.run_dir(run_id)):
+        return False
+    try:
+        collected = datetime.datetime.fromisoformat(manifest["timestamps"]["data_collected"])
+    except (KeyError, ValueError):
+        return False
+    return (datetime.datetime.now() - collected).total_seconds() <= settings.SCRAPE_CACHE_TTL
+
+
+async def lookup(key: str) -> Optional[str]:
+    """run_id со свежим результатом скрапинга для ключа или None."""
+    if settings.SCRAPE_CACHE_TTL <= 0:
+        return None
+    try:
+        source = await get_redis().get(f"{KEY_PREFIX}:{key}")
+    except Exception as e:
+        log.warning("scrape cache: Redis недоступен (%s), смотрю в памяти процесса", e)
+        entry = _local.get(key)
+        source = entry[0] if entry and entry[1] > time.monotonic() else None
+    if source and await asyncio.to_thread(_is_fresh, source):
+        return source
+    return None
+
+
+async def remember(key: str, run_id: str):
+    """Запоминает run_id как источник для ключа (после data_collected)."""
+    if settings.SCRAPE_CACHE_TTL <= 0:
+        return
+    _local[key] = (run_id, time.monotonic() + settings.SCRAPE_CACHE_TTL)
+    _local.move_to_end(key)
+    while len(_local) > _LOCAL_MAX:
+        _local.popitem(last=False)
+    try:
+        await get_redis().set(f"{KEY_PREFIX}:{key}", run_id, ex=settings.SCRAPE_CACHE_TTL)
+    except Exception as e:
+        log.warning("scrape cache: не удалось записать %s в Redis: %s", run_id, e)
+
+
+# ─────────────── перенос данных в новый run_id ──────────────────────────────
+def _link(src: Path, dst: Path):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def clone_run(source_id: str, target_id: str) -> bool:
+    """Переносит данные source_id в target_id. True — фото тоже перенесены."""
+    src = run_manifest.run_dir(source_id)
+    dst = run_manifest.run_dir(target_id)
+    for name in POSTS_FILES:
+        if (src / name).exists():
+            _link(src / name, dst / name)
+
+    manifest = run_manifest.load(source_id) or {}
+    if not manifest.get("stages", {}).get("images_downloaded"):
+        return False
+    for tree in IMAGE_TREES:
+        for path in (src / tree).rglob("*") if (src / tree).exists() else []:
+            if path.is_file() and not path.name.endswith(".tmp"):
+                _link(path, dst / path.relative_to(src))
+    for name in IMAGE_FILES:
+        if (src / name).exists():
+            _link(src / name, dst / name)
+    return True
+
+
+async def apply_hit(source_id: str, run_id: str):
+    """Переводит новый run_id в data_collected по данным source_id; фото
+    переносятся или, если у источника их ещё нет, скачиваются заново."""
+    with_images = await asyncio.to_thread(clone_run, source_id, run_id)
+    source = run_manifest.load(source_id) or {}
+    run_manifest.mark_stage(run_id, "data_collected", profile=source.get("profile") or {},
+                            scrapedFrom=source_id)
+    publish(run_id, "data_collected", message="Данные профиля уже были собраны недавно", cached=True)
+    log.info("scrape cache hit: %s → %s (images: %s)", source_id, run_id, with_images)
+
+    if not with_images:
+        start_download(run_id)
+        return
+    images = sum(1 for _ in (run_manifest.run_dir(run_id) / "images").glob("*"))
+    downloads = {**(source.get("downloads") or {}), "runId": run_id, "images": images}
+    run_manifest.mark_stage(run_id, "images_downloaded", files={"images": images}, downloads=downloads)
+    publish(run_id, "images_downloaded", message="Фотографии загружены", images=images)
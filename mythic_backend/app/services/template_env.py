@@ -0,0 +1,92 @@
+# app/services/template_env.py
+"""Общее окружение Jinja2 для всех сборщиков книг.
+
+HTML книг раньше собирался огромными f-строками внутри функций стилей,
+и только flipbook жил на своём Environment. Теперь шаблоны лежат в
+app/templates (books/ — классические книги, flipbook_*.html — флипбуки):
+  ▸ один Environment на процесс; скомпилированные шаблоны кэшируются в
+    памяти, а байткод — на диске (FileSystemBytecodeCache в
+    TEMPLATE_CACHE_DIR), так что новый процесс/воркер не парсит их заново;
+  ▸ render_to_file() пишет результат потоком generate() сразу в файл
+    (временный файл + os.replace) — целая книга не собирается в памяти
+    одной строкой;
+  ▸ warm_up() компилирует все шаблоны заранее (старт API и воркера).
+Правка вёрстки — это правка шаблона, Python трогать не нужно.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+
+from app.config import settings
+
+log = logging.getLogger("template_env")
+
+TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
+WRITE_BUFFER = 64 * 1024
+
+_env: Optional[Environment] = None
+_env_lock = threading.Lock()
+
+
+def get_env() -> Environment:
+    """Общий Environment (ленивая инициализация)."""
+    global _env
+    with _env_lock:
+        if _env is None:
+            cache_dir = Path(settings.TEMPLATE_CACHE_DIR)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            _env = Environment(
+                loader=FileSystemLoader(str(TEMPLATES_DIR)),
+                bytecode_cache=FileSystemBytecodeCache(str(cache_dir)),
+                auto_reload=settings.TEMPLATE_AUTO_RELOAD,
+                cache_size=400,
+            )
+        return _env
+
+
+def get_template(name: str) -> Template:
+    return get_env().get_template(name)
+
+
+def render(name: str, **context: Any) -> str:
+    """Шаблон целиком в строку — для небольших фрагментов."""
+    return get_template(name).render(**context)
+
+
+def render_to_file(name: str, path: Path, **context: Any) -> Path:
+    """Рендерит шаблон потоком в path: части generate() пишутся сразу в файл."""
+    return stream_to_file(get_template(name), path, **context)
+
+
+def stream_to_file(template: Template, path: Path, **context: Any) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8", buffering=WRITE_BUFFER) as fh:
+            for chunk in template.generate(**context):
+                fh.write(chunk)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return path
+
+
+def warm_up() -> int:
+    """Компилирует все шаблоны (байткод попадает в кэш на диске)."""
+    env = get_env()
+    count = 0
+    for name in env.list_templates(extensions=["html"]):
+        try:
+            env.get_template(name)
+            count += 1
+        except Exception as e:
+            log.warning("template %s не скомпилирован: %s", name, e)
+    log.info("templates warmed up: %s", count)
+    return count
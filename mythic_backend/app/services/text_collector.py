@@ -1,26 +1,25 @@
 # app/services/text_collector.py
-import json
 from pathlib import Path
+from typing import Iterator
 
-def collect_texts(posts_json_path: Path) -> list[str]:
+from app.services import posts_store
+
+def collect_texts(run_dir: Path) -> Iterator[str]:
     """
-    Из posts.json собираем все доступные подписи и сторисы в один большой список.
+    Из датасета профиля (posts.ndjson) лениво отдаём все доступные подписи и сторисы.
     Каждый элемент — это либо caption, либо текст сториса.
     """
-    if not posts_json_path.exists():
-        print(f"⚠️ Файл {posts_json_path} не найден, тексты не собраны.")
-        return []
+    if not posts_store.has_items(run_dir):
+        print(f"⚠️ Данные профиля в {run_dir} не найдены, тексты не собраны.")
+        return
         
-    items = json.loads(posts_json_path.read_text(encoding="utf-8"))
-    texts = []
-    
     # Instagram Profile Scraper actor returns a list where the first item is the profile
-    profile_data = items[0] if items else {}
+    profile_data = posts_store.first_item(run_dir) or {}
     posts = profile_data.get("latestPosts", [])
 
     for post in posts:
         if caption := post.get("caption"):
-            texts.append(caption)
+            yield caption
     
     # Stories might be in a separate key or within posts
     if stories := profile_data.get("stories"):
@@ -30,6 +29,4 @@ def collect_texts(posts_json_path: Path) -> list[str]:
             # based on real data structure from Apify.
             # For now, we assume a simple text key might exist.
             if story_text := story.get("text"): # Placeholder key
-                 texts.append(story_text)
-    
-    return texts
+                 yield story_text
@@ -1,6 +1,8 @@
 import importlib
 from pathlib import Path
 
+from app.services.build_executor import build_executor
+
 # Импортируем новую функцию генерации
 from app.services.book_builder import generate_text_pages
 from app.services.text_collector import collect_texts # Новый импорт
@@ -20,67 +22,49 @@ def fallback_pages(image_names: list[str], raw_comments: list[str]) -> list[str]
 async def build_book(style: str, run_id: str, images: list, comments: list, book_format: str, user_id: str):
     """
     Диспетчер, который выбирает и динамически импортирует нужный сборщик книги.
+
+    Ошибки сборщиков не глотаются: их получает вызывающий (задача очереди
+    повторяется). Фоллбэк на романтический стиль — только если сборщика стиля нет.
     """
     print(f"▶️ Запуск сборки: стиль='{style}', формат='{book_format}', run_id='{run_id}'")
 
     # Для flipbook отдельная логика, не зависящая от стиля
     if book_format == 'flipbook':
-        try:
-            from app.services.flipbook_builder import generate_flipbook_data, build_flipbook_html
-            
-            # 1. Асинхронно получаем структурированные данные от LLM
-            flipbook_data = await generate_flipbook_data(run_id, images)
+        from app.services.flipbook_builder import generate_flipbook_data, build_flipbook_html
 
-            # Читаем стиль из файла (гарантированно актуальный)
-            from pathlib import Path
-            style_file = Path('data') / run_id / 'style.txt'
-            style_from_file = style_file.read_text(encoding='utf-8').strip() if style_file.exists() else style
+        # 1. Асинхронно получаем структурированные данные от LLM
+        flipbook_data = await generate_flipbook_data(run_id, images)
+        if not flipbook_data:
+            raise RuntimeError("не удалось сгенерировать данные для flipbook")
 
-            # 2. Если данные получены, собираем HTML
-            if flipbook_data:
-                build_flipbook_html(run_id, flipbook_data, style_from_file)
-                print(f"✅ Flipbook для стиля '{style_from_file}' успешно сгенерирован.")
-            else:
-                print("❌ Не удалось сгенерировать данные для flipbook, сборка HTML пропущена.")
+        # Читаем стиль из файла (гарантированно актуальный)
+        style_file = Path('data') / run_id / 'style.txt'
+        style_from_file = style_file.read_text(encoding='utf-8').strip() if style_file.exists() else style
 
-        except Exception as e:
-            print(f"❌ Ошибка при создании flipbook: {e}")
+        # 2. Собираем HTML
+        build_flipbook_html(run_id, flipbook_data, style_from_file)
+        print(f"✅ Flipbook для стиля '{style_from_file}' успешно сгенерирован.")
         return
 
     # Специальная обработка для humor стиля
     if style == 'humor':
-        try:
-            from app.services.book_builder import build_humor_book
-            build_humor_book(run_id, images, comments, book_format, user_id)
-            print(f"✅ Юмористическая книга успешно сгенерирована.")
-            return
-        except Exception as e:
-            print(f"❌ Ошибка при создании юмористической книги: {e}")
-            # Фоллбэк на романтический стиль
-            from .romantic import build_romantic_book
-            build_romantic_book(run_id, images, comments, book_format, user_id)
-            return
+        from app.services.book_builder import build_humor_book
+        await build_executor.run(style, build_humor_book, run_id, images, comments, book_format, user_id)
+        print(f"✅ Юмористическая книга успешно сгенерирована.")
+        return
 
-    # Динамический импорт и вызов сборщика для классических форматов
+    # Динамический импорт сборщика для классических форматов
     try:
-        # Имя модуля соответствует стилю (e.g., 'romantic', 'fantasy')
+        # Имя модуля соответствует стилю (e.g., 'romantic', 'fantasy'),
+        # имя функции строится по шаблону 'build_STYLE_book'
         style_module = importlib.import_module(f".{style}", package="app.styles")
-        
-        # Имя функции строится по шаблону 'build_STYLE_book'
-        build_function_name = f"build_{style}_book"
-        
-        # Получаем функцию из модуля
-        build_function = getattr(style_module, build_function_name)
-        
-        # Вызываем нужный сборщик
-        build_function(run_id, images, comments, book_format, user_id)
-        
-        print(f"✅ Книга в стиле '{style}' (формат: {book_format}) успешно сгенерирована.")
-
+        build_function = getattr(style_module, f"build_{style}_book")
     except (ImportError, AttributeError):
         print(f"⚠️ Не найден сборщик для стиля '{style}'. Используется 'romantic' по умолчанию.")
         # Фоллбэк на романтический стиль, если нужный модуль или функция не найдены
         from .romantic import build_romantic_book
-        build_romantic_book(run_id, images, comments, book_format, user_id)
-    except Exception as e:
-        print(f"❌ Ошибка при сборке книги в стиле '{style}': {e}")
\ No newline at end of file
+        style, build_function = "romantic", build_romantic_book
+
+    # Вызываем нужный сборщик в пуле потоков стиля, не блокируя event loop
+    await build_executor.run(style, build_function, run_id, images, comments, book_format, user_id)
+    print(f"✅ Книга в стиле '{style}' (формат: {book_format}) успешно сгенерирована.")
@@ -0,0 +1,46 @@
+# app/worker.py
+"""mythic-worker — отдельный процесс, выполняющий приём данных и сборки книг из очереди Redis.
+
+Запуск:  python -m app.worker [--concurrency N]
+Масштабирование — добавлением контейнеров воркера (docker compose up --scale worker=N).
+"""
+import argparse
+import asyncio
+import logging
+import signal
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# Тот же .env, что и у API (на уровень выше mythic_backend)
+load_dotenv(Path(__file__).parent.parent.parent / '.env')
+
+from app.services import template_env
+from app.services.job_queue import Worker
+# Импорт регистрирует обработчики задач
+import app.services.build_pipeline  # noqa: F401
+import app.services.ingest_pipeline  # noqa: F401
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="mythic-worker", description="Воркер сборки книг Mythic")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="сколько задач выполнять одновременно (по умолчанию WORKER_CONCURRENCY)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    worker = Worker(concurrency=args.concurrency)
+    # Шаблоны книг компилируются до первой задачи (байткод — в TEMPLATE_CACHE_DIR)
+    template_env.warm_up()
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stop)
+        await worker.run()
+
+    asyncio.run(runner())
+
+
+if __name__ == "__main__":
+    main()